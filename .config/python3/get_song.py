@@ -2,23 +2,42 @@
 Download music files from URLs or based on existing audio files using yt-dlp.
 
 This script accepts either URLs or audio file paths as input. If a file path is
-given, it will attempt to extract a source URL from the file's metadata (using
-mutagen or ffmpeg) and use that for downloading. The timestamp for output files
-will be taken from the input file's name if available unless overridden.
+given, it will attempt to extract a source URL from the file's metadata (reading
+the tag headers directly, falling back to mutagen or ffprobe) and use that for
+downloading. The timestamp for output files will be taken from the input file's
+name if available unless overridden.
+
+With --refresh-dir, a whole music tree is walked and every song in it is
+re-fetched from the URL in its metadata, resuming from a checkpoint if an
+earlier refresh of the same tree got interrupted.
+
+With --playlist, playlist (album, channel...) URLs are enumerated with flat
+extraction and their entries downloaded one by one; an interrupted playlist
+download resumes with the entries not done yet.
+
+With --plan, all inputs are resolved concurrently (URL, metadata, final file
+name) into a JSON plan without downloading anything; --execute-plan later
+downloads the plan's inputs, reusing what was resolved.
+
+With --serve, the script runs as a long-lived daemon listening on a Unix
+socket; invocations with --client just queue their inputs in it (starting the
+daemon if needed) and exit right away.
 """
 
 import argparse
-import json
 import os
-import shlex
 import shutil
+import struct
 import subprocess
 import sys
-import tempfile
-from collections import deque
-from datetime import datetime
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from dataclasses import dataclass
 from pathlib import Path
-from typing import List, Optional
+from typing import Any, Callable, Iterator, List, Optional, Tuple, Union
 
 
 class UtilityRegistry:
@@ -39,84 +58,506 @@ utility_reg = UtilityRegistry()
 is_available = utility_reg.is_available
 
 
+def get_cache_dir() -> Path:
+    """Get the directory for cached data (created if missing)."""
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    cache_dir = Path(cache_home) / 'get-song'
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    return cache_dir
+
+
+def get_default_staging_dir() -> Path:
+    """Get the default staging directory - on fast, app-private storage."""
+    if os.environ.get('TMPDIR'):
+        return Path(os.environ['TMPDIR']) / 'get-song'
+    return get_cache_dir() / 'staging'
+
+
+def get_state_dir() -> Path:
+    """Get the directory for persistent state (created if missing)."""
+    state_home = os.environ.get('XDG_STATE_HOME') or Path.home() / '.local' / 'state'
+    state_dir = Path(state_home) / 'get-song'
+    state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir
+
+
+class EventRecorder:
+    """
+    Records structured events of the download pipeline: per-input stage
+    timings, subprocess runs (with durations and exit codes) and log messages.
+    Events are optionally streamed as JSON lines and stage & subprocess timings
+    are aggregated for a summary table.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._file = None
+        self._stage_stats: dict[str, List[float]] = {}
+        self._subprocess_stats: dict[str, List[float]] = {}
+        self._counters: dict[str, int] = {}
+        # [count, total bytes, total seconds] by transfer name:
+        self._transfer_stats: dict[str, List[float]] = {}
+
+    def open(self, path: str) -> None:
+        """Stream events as JSON lines to the file (or stderr for '-')."""
+        with self._lock:
+            if path == '-':
+                self._file = sys.stderr
+            else:
+                self._file = open(path, 'a', encoding='utf-8')
+
+    def close(self) -> None:
+        """Stop streaming events."""
+        with self._lock:
+            if self._file is not None and self._file is not sys.stderr:
+                self._file.close()
+            self._file = None
+
+    def emit(self, event: str, **fields: Any) -> None:
+        """Write an event (tagged with the current input) if streaming."""
+        import json
+
+        if self._file is None:
+            return
+        record = {
+            'ts': round(time.time(), 6),
+            'event': event,
+            'input': get_current_input(),
+            **fields
+        }
+        line = json.dumps(record, default=str)
+        with self._lock:
+            if self._file is not None:
+                self._file.write(line + '\n')
+                self._file.flush()
+
+    @staticmethod
+    def _add_stat(stats: dict, name: str, duration: float,
+                  failed: bool) -> None:
+        # [count, total seconds, max seconds, failures]
+        stat = stats.setdefault(name, [0, 0.0, 0.0, 0])
+        stat[0] += 1
+        stat[1] += duration
+        stat[2] = max(stat[2], duration)
+        stat[3] += failed
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[dict]:
+        """
+        Time a pipeline stage of the current input.
+
+        Yields a dict of extra event fields; setting its 'ok' to False marks
+        the stage as failed (which also happens on exceptions).
+        """
+        fields: dict = {'ok': True}
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield fields
+        except BaseException:
+            fields['ok'] = False
+            raise
+        finally:
+            duration = time.perf_counter() - started
+            with self._lock:
+                self._add_stat(self._stage_stats, name, duration,
+                               not fields['ok'])
+            self.emit('stage',
+                      stage=name,
+                      start=round(start, 6),
+                      end=round(start + duration, 6),
+                      duration=round(duration, 6),
+                      **fields)
+
+    def record_subprocess(self, cmd: List[str], start: float, duration: float,
+                          exit_code: Optional[int]) -> None:
+        """Record a finished subprocess run."""
+        name = os.path.basename(cmd[0])
+        with self._lock:
+            self._add_stat(self._subprocess_stats, name, duration,
+                           exit_code != 0)
+        self.emit('subprocess',
+                  cmd=name,
+                  args=len(cmd) - 1,
+                  start=round(start, 6),
+                  end=round(start + duration, 6),
+                  duration=round(duration, 6),
+                  exit_code=exit_code)
+
+    def record_transfer(self, name: str, size: int, duration: float) -> None:
+        """Record a finished transfer (e.g. the download of a song)."""
+        with self._lock:
+            stat = self._transfer_stats.setdefault(name, [0, 0, 0.0])
+            stat[0] += 1
+            stat[1] += size
+            stat[2] += duration
+        self.emit('transfer',
+                  name=name,
+                  bytes=size,
+                  duration=round(duration, 6),
+                  throughput=round(size / duration) if duration > 0 else None)
+
+    def count(self, name: str, **fields: Any) -> None:
+        """Count an occurrence of something (e.g. a cache hit)."""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + 1
+        self.emit('count', name=name, **fields)
+
+    def summary_lines(self, reset: bool = False) -> List[str]:
+        """Format stage & subprocess timings and counters as a table."""
+        with self._lock:
+            sections = [('stage', self._stage_stats),
+                        ('subprocess', self._subprocess_stats)]
+            lines = []
+            for title, stats in sections:
+                if not stats:
+                    continue
+                lines.append(f"{title:<20} {'count':>6} {'failed':>6} "
+                             f"{'total':>9} {'mean':>9} {'max':>9}")
+                for name, (count, total, longest, failed) in stats.items():
+                    lines.append(f"{name:<20} {count:>6} {failed:>6} "
+                                 f"{total:>8.3f}s {total / count:>8.3f}s "
+                                 f"{longest:>8.3f}s")
+            if self._transfer_stats:
+                lines.append(f"{'transfer':<20} {'count':>6} {'bytes':>10} "
+                             f"{'total':>9} {'throughput':>11}")
+                for name, (count, size, total) in self._transfer_stats.items():
+                    throughput = (format_size(size / total) +
+                                  '/s') if total > 0 else '-'
+                    lines.append(f"{name:<20} {count:>6} "
+                                 f"{format_size(size):>10} {total:>8.3f}s "
+                                 f"{throughput:>11}")
+            if self._counters:
+                lines.append(f"{'counter':<20} {'count':>6}")
+                for name, count in self._counters.items():
+                    line = f"{name:<20} {count:>6}"
+                    # cache hit rates:
+                    if name.endswith('-hit'):
+                        misses = self._counters.get(name[:-4] + '-miss', 0)
+                        line += f" ({count / (count + misses):.0%} hit rate)"
+                    lines.append(line)
+            if reset:
+                self._stage_stats = {}
+                self._subprocess_stats = {}
+                self._counters = {}
+                self._transfer_stats = {}
+        return lines
+
+    def print_summary(self, reset: bool = False) -> None:
+        """Print the timings table to stderr."""
+        lines = self.summary_lines(reset=reset)
+        if lines:
+            print('\n'.join(['Timings:', *lines]), file=sys.stderr)
+
+
+# global instance of event recorder:
+events = EventRecorder()
+
+
+def format_size(size: float) -> str:
+    """Format a byte count human-readably (e.g. 1.5MiB)."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024 or unit == 'GiB':
+            break
+        size /= 1024
+    return f"{size:.0f}{unit}" if unit == 'B' else f"{size:.1f}{unit}"
+
+
+def run_command(cmd: List[str], **kwargs: Any) -> subprocess.CompletedProcess:
+    """Run a command via subprocess.run, recording its duration & exit code."""
+    exit_code = None
+    start = time.time()
+    started = time.perf_counter()
+    try:
+        result = subprocess.run(cmd, **kwargs)
+        exit_code = result.returncode
+        return result
+    except subprocess.CalledProcessError as e:
+        exit_code = e.returncode
+        raise
+    finally:
+        events.record_subprocess(cmd, start,
+                                 time.perf_counter() - started, exit_code)
+
+
+def _pump_stdout(stream: Any, on_line: Callable[[str], bool]) -> None:
+    """Hand lines of a stdout pipe over, passing the unhandled ones through."""
+    for line in stream:
+        if not on_line(line.rstrip('\n')):
+            sys.stdout.write(line)
+            sys.stdout.flush()
+
+
+def run_command_tee_stderr(
+        cmd: List[str],
+        max_lines: int = 20,
+        on_stdout_line: Optional[Callable[[str], bool]] = None,
+        **kwargs: Any) -> Tuple[int, List[str]]:
+    """
+    Run a command passing its stderr through while keeping its last lines,
+    recording its duration & exit code.
+
+    Args:
+        on_stdout_line: If provided, stdout is read (on a separate thread) and
+            its lines are handed to this callback, which returns True for
+            lines it consumed - the others are passed through
+
+    Returns:
+        Exit code and the last `max_lines` lines of stderr
+    """
+    exit_code = None
+    start = time.time()
+    started = time.perf_counter()
+    tail: deque = deque(maxlen=max_lines)
+    try:
+        with subprocess.Popen(
+                cmd,
+                stdout=subprocess.PIPE if on_stdout_line else None,
+                stderr=subprocess.PIPE,
+                text=True,
+                errors='replace',
+                **kwargs) as proc:
+            pump = None
+            if on_stdout_line:
+                pump = threading.Thread(target=_pump_stdout,
+                                        args=(proc.stdout, on_stdout_line),
+                                        name='stdout-pump',
+                                        daemon=True)
+                pump.start()
+            for line in proc.stderr:
+                sys.stderr.write(line)
+                sys.stderr.flush()
+                tail.append(line.rstrip('\n'))
+            if pump is not None:
+                pump.join()
+        exit_code = proc.returncode
+        return exit_code, list(tail)
+    finally:
+        events.record_subprocess(cmd, start,
+                                 time.perf_counter() - started, exit_code)
+
+
+# number of log files of past runs kept:
+MAX_RUN_LOGS = 20
+
+
+def get_run_log_path(prog_name: str) -> Path:
+    """
+    Get a log file path of its own for this run - concurrent runs (e.g. a
+    manual one next to the daemon) don't overwrite each other's logs, which
+    their notifications show. Logs of old runs are pruned.
+    """
+    log_dir = get_state_dir() / 'logs'
+    log_dir.mkdir(exist_ok=True)
+    pattern = f"{prog_name}-*.log"
+
+    def mtime(path: Path) -> float:
+        try:
+            return path.stat().st_mtime
+        except OSError:
+            return 0.0
+
+    for old_log in sorted(log_dir.glob(pattern),
+                          key=mtime)[:-(MAX_RUN_LOGS - 1)]:
+        old_log.unlink(missing_ok=True)
+    return log_dir / (f"{prog_name}-{time.strftime('%Y%m%d-%H%M%S')}-"
+                      f"{os.getpid()}.log")
+
+
 class TermuxNotificationLogger:
     """
     Logger that renders logs to Android notifications via termux-notification.
-    Keeps a circular buffer of recent messages and all messages for full log view.
+    Keeps a circular buffer of recent messages and streams all messages to a log
+    file for the full log view.
+
+    Notifications are rendered by a background thread which coalesces bursts of
+    messages into at most one notification update per render interval, so that
+    logging never blocks on termux-notification.
     """
 
-    def __init__(self, prog_name: str, max_recent: int = 5):
+    def __init__(self,
+                 prog_name: str,
+                 max_recent: int = 5,
+                 render_interval: float = 1.0,
+                 log_path: Optional[Path] = None):
         """
         Initialize the notification logger.
 
         Args:
             prog_name: Program name used as notification ID and title
             max_recent: Maximum number of recent lines to show in notification
+            render_interval: Minimum seconds between notification updates
+            log_path: File to write all messages to (default: a log file of
+                this run in the state dir - see get_run_log_path())
         """
         self.prog_name = prog_name
         self.prog_label = prog_name.replace('-', ' ')
         self.max_recent = max_recent
+        self.render_interval = render_interval
         self.recent_msgs = deque(maxlen=max_recent)
-        self.all_msgs: List[str] = []
+        self.log_path = log_path or get_run_log_path(prog_name)
+        try:
+            # appending - a logger of the same run may have used the file:
+            self._log_file = open(self.log_path, 'a', encoding='utf-8')
+        except OSError as e:
+            print(f"WARN: Cannot write log file '{self.log_path}': {e}",
+                  file=sys.stderr)
+            self._log_file = None
+        # guards message buffers & renderer state - logging may happen from
+        # worker threads:
+        self._cond = threading.Condition()
+        self._dirty = False
+        self._stopping = False
+        self._renderer: Optional[threading.Thread] = None
+        # progress lines of running downloads by key (shown below the
+        # messages, never logged to the file):
+        self._progress: dict[Any, str] = {}
 
     def _escape_shell_arg(self, text: str) -> str:
         """Escape text for safe shell argument passing."""
+        import shlex
+
         return shlex.quote(text)
 
     def _build_show_all_logs_cmd(self) -> str:
-        """Build the command to show all logs in a dialog."""
-        content = '\n'.join(self.all_msgs)
+        """Build the command to show all logs (read from the log file) in a dialog."""
+        # the dialog is limited by Android's binder buffer - show the tail only
+        content = f'"$(tail -c 65536 {self._escape_shell_arg(str(self.log_path))})"'
         cmd_parts = [
             'termux-dialog', 'confirm', '-t',
             self._escape_shell_arg(f"{self.prog_label} - All Logs"), '-i',
-            self._escape_shell_arg(content)
+            content
         ]
         return ' '.join(cmd_parts)
 
-    def _show_notification(self, ongoing: bool = True) -> None:
-        """Show or update the notification with recent messages."""
-        if not self.recent_msgs:
-            return
+    def _build_notification_cmd(self, ongoing: bool) -> Optional[List[str]]:
+        """Build the notification command for the current messages."""
+        if not self.recent_msgs and not self._progress:
+            return None
 
-        content = '\n'.join(self.recent_msgs)
+        content = '\n'.join([*self.recent_msgs, *self._progress.values()])
 
         cmd = [
-            'termux-notification', '--alert-once', '--action',
-            self._build_show_all_logs_cmd(), '--id', self.prog_name, '--title',
-            self.prog_label, '--content', content
+            'termux-notification', '--alert-once', '--id', self.prog_name,
+            '--title', self.prog_label, '--content', content
         ]
 
+        if self._log_file is not None:
+            cmd[2:2] = ['--action', self._build_show_all_logs_cmd()]
         if ongoing:
             cmd.insert(1, '--ongoing')
+        return cmd
 
+    def _show_notification(self, cmd: Optional[List[str]]) -> None:
+        """Show or update the notification by running the given command."""
+        if cmd is None:
+            return
         try:
-            subprocess.run(cmd, capture_output=True, check=False)
+            run_command(cmd, capture_output=True, check=False)
         except FileNotFoundError:
             pass
 
+    def _render_loop(self) -> None:
+        """Render pending messages until the logger gets finalized."""
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self._dirty or self._stopping)
+                if self._stopping:
+                    # finalize() renders the final state itself
+                    return
+                self._dirty = False
+                cmd = self._build_notification_cmd(ongoing=True)
+            self._show_notification(cmd)
+            # let further messages pile up before the next update:
+            with self._cond:
+                self._cond.wait_for(lambda: self._stopping,
+                                    timeout=self.render_interval)
+
     def log(self, message: str) -> None:
-        """Add a log message and update the notification."""
-        # if the recent_msgs deque is full, remove the oldest message:
-        if len(self.recent_msgs) == self.recent_msgs.maxlen:
-            self.recent_msgs.popleft()
-        self.recent_msgs.append(message)
-        self.all_msgs.append(message)
-        self._show_notification(ongoing=True)
+        """Add a log message and schedule a notification update."""
+        with self._cond:
+            # if the recent_msgs deque is full, remove the oldest message:
+            if len(self.recent_msgs) == self.recent_msgs.maxlen:
+                self.recent_msgs.popleft()
+            self.recent_msgs.append(message)
+            if self._log_file is not None and not self._log_file.closed:
+                self._log_file.write(message + '\n')
+                self._log_file.flush()
+            self._schedule_render()
+
+    def set_progress(self, key: Any, line: Optional[str]) -> None:
+        """
+        Set (or remove, with None) the progress line of a running download
+        and schedule a notification update. Updates coalesce like messages -
+        at most one notification per render interval.
+        """
+        with self._cond:
+            if line is None:
+                if self._progress.pop(key, None) is None:
+                    return
+            elif self._progress.get(key) == line:
+                return
+            else:
+                self._progress[key] = line
+            self._schedule_render()
+
+    def _schedule_render(self) -> None:
+        """Mark the notification outdated (lock must be held)."""
+        self._dirty = True
+        if self._renderer is None:
+            self._renderer = threading.Thread(
+                target=self._render_loop,
+                name=f"{self.prog_name}-notification",
+                daemon=True)
+            self._renderer.start()
+        self._cond.notify_all()
 
     def finalize(self) -> None:
         """Show final notification (not ongoing) with all accumulated logs."""
-        if self.all_msgs:
-            self._show_notification(ongoing=False)
+        with self._cond:
+            renderer = self._renderer
+            self._stopping = True
+            self._cond.notify_all()
+        # wait for an in-flight update so that it can't override the final one:
+        if renderer is not None:
+            renderer.join()
+        with self._cond:
+            self._renderer = None
+            self._stopping = False
+            self._dirty = False
+            self._progress.clear()
+            cmd = self._build_notification_cmd(ongoing=False)
+        self._show_notification(cmd)
+
+    def close(self) -> None:
+        """Close the log file - later messages are shown but not logged."""
+        with self._cond:
+            if self._log_file is not None:
+                self._log_file.close()
 
 
 # Global logger instance
 _logger: Optional[TermuxNotificationLogger] = None
 
 
-def init_logger(prog_name: str = 'get-song', max_recent: int = 5) -> None:
-    """Initialize the global notification logger."""
+def _close_logger() -> None:
+    """Close the global notification logger's log file (at exit)."""
+    if _logger is not None:
+        _logger.close()
+
+
+def init_logger(prog_name: str = 'get-song',
+                max_recent: int = 5,
+                render_interval: float = 1.0) -> None:
+    """Initialize the global notification logger (closing the previous one)."""
     global _logger
-    _logger = TermuxNotificationLogger(prog_name, max_recent)
+    if _logger is not None:
+        _logger.close()
+    else:
+        import atexit
+
+        atexit.register(_close_logger)
+    _logger = TermuxNotificationLogger(prog_name, max_recent, render_interval)
 
 
 def get_logger() -> Optional[TermuxNotificationLogger]:
@@ -124,53 +565,74 @@ def get_logger() -> Optional[TermuxNotificationLogger]:
     return _logger
 
 
-def tell_debug(message: str) -> None:
-    """Print a debug message to stderr."""
-    full_msg = f"DEBUG: {message}"
+# Per-thread log context (e.g. input prefix when processing several inputs)
+_log_context = threading.local()
+
+
+def set_log_prefix(prefix: str) -> None:
+    """Set the log message prefix for the current thread."""
+    _log_context.prefix = prefix
+
+
+def get_log_prefix() -> str:
+    """Get the log message prefix of the current thread."""
+    return getattr(_log_context, 'prefix', '')
+
+
+def set_current_input(input_item: Optional[str]) -> None:
+    """Set the input the current thread is processing (for events)."""
+    _log_context.input = input_item
+
+
+def get_current_input() -> Optional[str]:
+    """Get the input the current thread is processing."""
+    return getattr(_log_context, 'input', None)
+
+
+def _tell(level: str, message: str) -> None:
+    """Print a message of the given level to stderr and the logger."""
+    full_msg = f"{level}: {get_log_prefix()}{message}"
     print(full_msg, file=sys.stderr)
+    events.emit('log', level=level, message=message)
     logger = get_logger()
     if logger:
         logger.log(full_msg)
 
 
+def tell_debug(message: str) -> None:
+    """Print a debug message to stderr."""
+    _tell('DEBUG', message)
+
+
 def tell_info(message: str) -> None:
     """Print an info message to stderr."""
-    full_msg = f"INFO: {message}"
-    print(full_msg, file=sys.stderr)
-    logger = get_logger()
-    if logger:
-        logger.log(full_msg)
+    _tell('INFO', message)
 
 
 def tell_warn(message: str) -> None:
     """Print a warning message to stderr."""
-    full_msg = f"WARN: {message}"
-    print(full_msg, file=sys.stderr)
-    logger = get_logger()
-    if logger:
-        logger.log(full_msg)
+    _tell('WARN', message)
 
 
 def tell_error(message: str) -> None:
     """Print an error message to stderr."""
-    full_msg = f"ERROR: {message}"
-    print(full_msg, file=sys.stderr)
-    logger = get_logger()
-    if logger:
-        logger.log(full_msg)
+    _tell('ERROR', message)
 
 
 def run_termux_toast(message: str,
                      background_color: str = 'green',
                      text_color: str = 'black',
                      position: str = 'bottom') -> None:
-    """Show a Termux toast notification (if possible)."""
+    """Show a Termux toast notification (if possible) without waiting."""
     if is_available('termux-toast'):
         cmd = [
             'termux-toast', '-b', background_color, '-c', text_color, '-g',
             position, message
         ]
-        subprocess.run(cmd, capture_output=True, check=False)
+        subprocess.Popen(cmd,
+                         stdin=subprocess.DEVNULL,
+                         stdout=subprocess.DEVNULL,
+                         stderr=subprocess.DEVNULL)
 
 
 def tell_success(message: str) -> None:
@@ -209,6 +671,9 @@ def check_dependencies() -> bool:
     missing = []
 
     for dep in dependencies:
+        if dep == 'yt-dlp' and is_ytdlp_module_available():
+            # can run in-process
+            continue
         if not is_available(dep):
             missing.append(dep)
 
@@ -219,463 +684,4444 @@ def check_dependencies() -> bool:
     return True
 
 
-def populate_empty_album_with_title(filepath: Path) -> bool:
-    """
-    Populate empty album metadata field with the title field.
-    Uses a fallback chain: mutagen -> ffmpeg -> warn user.
+@dataclass
+class TagView:
+    """Normalized view of an audio file's metadata, whichever backend read it."""
+    path: Path
+    # backend which read the tags - 'headers', 'mutagen' or 'ffprobe':
+    backend: str
+    album: Optional[str] = None
+    title: Optional[str] = None
+    purl: Optional[str] = None
+    comment: Optional[str] = None
+    # the parsed mutagen file (mutagen backend only), reusable for writing
+    mutagen_file: Any = None
 
-    Args:
-        filepath: Path to the audio file
+    @property
+    def comment_url(self) -> Optional[str]:
+        """URL found in the comment tag, if any."""
+        import re
 
-    Returns:
-        True if successful or album was already populated, False if failed
+        if not self.comment:
+            return None
+        if is_url(self.comment):
+            return self.comment
+        match = re.search(r'(https?://\S+)', self.comment)
+        return match.group(1) if match else None
+
+    @property
+    def source_url(self) -> Optional[str]:
+        """URL the song was downloaded from - from 'purl' or 'comment' tags."""
+        return self.purl or self.comment_url
+
+    @property
+    def filename_timestamp(self) -> Optional[str]:
+        """Timestamp from the file name prefix (YYYYMMDD...), if any."""
+        import re
+
+        match = re.match(r'^(\d{8})', self.path.name)
+        return match.group(1) if match else None
+
+
+class MetadataProbe:
     """
-    # Try mutagen first
-    try:
-        from mutagen import File as MutagenFile  # type: ignore[attr-defined]
+    Reads audio file metadata once and caches it by path, mtime and size.
+    Uses a fallback chain: built-in header reader -> mutagen -> ffprobe.
 
-        tell_debug("Using mutagen to check and populate album metadata...")
-        audio = MutagenFile(filepath)
+    The cache keeps the `max_entries` most recently probed files, so walking
+    a whole library holds on to a bounded number of tag views.
+    """
 
-        if audio is None:
-            tell_warn(f"Could not read audio file: {filepath.name}")
-            return False
+    # tag keys of the supported fields - Vorbis comments first, then MP4 & ID3:
+    _MUTAGEN_KEYS = {
+        'album': ('album', '\xa9alb', 'TALB'),
+        'title': ('title', '\xa9nam', 'TIT2'),
+        'purl': ('purl', 'WXXX:purl', 'TXXX:purl'),
+        'comment': ('comment', '\xa9cmt', 'COMM::eng', 'COMM'),
+    }
 
-        # Handle different file formats
-        album = None
-        title = None
-
-        # For Opus/Ogg Vorbis files
-        if hasattr(audio, 'tags') and audio.tags:
-            album = audio.tags.get(
-                'album', [None])[0] if 'album' in audio.tags else None
-            title = audio.tags.get(
-                'title', [None])[0] if 'title' in audio.tags else None
-
-            if not album or album.strip() == '':
-                if title and title.strip() != '':
-                    audio.tags['album'] = title
-                    audio.save()
-                    tell_info(f"Populated empty album with title: {title}")
-                    return True
-                else:
-                    tell_debug("Title is also empty, cannot populate album")
-                    return True
-            else:
-                tell_debug(f"Album already populated: {album}")
-                return True
+    def __init__(self, max_entries: int = 256):
+        self._cache: OrderedDict[tuple, TagView] = OrderedDict()
+        self._max_entries = max_entries
+        self._lock = threading.Lock()
 
-        tell_debug("No tags found in audio file")
-        return True
+    @staticmethod
+    def _cache_key(path: Path) -> tuple:
+        stat_info = path.stat()
+        return (str(path.resolve()), stat_info.st_mtime_ns, stat_info.st_size)
 
-    except ImportError:
-        tell_debug("mutagen library not available, trying ffmpeg...")
+    def probe(self, path: Path) -> Optional[TagView]:
+        """
+        Get the metadata of the given file (parsed at most once per version).
 
-        # Try ffmpeg as fallback
-        if is_available('ffmpeg'):
-            tell_debug("Using ffmpeg to check and populate album metadata...")
+        Returns:
+            The tag view or None if no backend could read the file
+        """
+        key = self._cache_key(path)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+        tag_view = self._read(path)
+        if tag_view is not None:
+            with self._lock:
+                self._cache[key] = tag_view
+                self._cache.move_to_end(key)
+                while len(self._cache) > self._max_entries:
+                    self._cache.popitem(last=False)
+        return tag_view
 
-            # First, probe the file to get current metadata
-            probe_cmd = [
-                'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                '-show_format',
-                str(filepath)
-            ]
+    def invalidate(self, path: Path) -> None:
+        """Drop cached metadata of the given file (e.g. after writing it)."""
+        resolved = str(path.resolve())
+        with self._lock:
+            for key in [key for key in self._cache if key[0] == resolved]:
+                del self._cache[key]
 
+    @classmethod
+    def _first_mutagen_value(cls, tags: Any, field: str) -> Optional[str]:
+        for key in cls._MUTAGEN_KEYS[field]:
             try:
-                probe_result = subprocess.run(probe_cmd,
-                                              capture_output=True,
-                                              text=True,
-                                              check=True)
-
-                metadata = json.loads(probe_result.stdout)
-                tags = metadata.get('format', {}).get('tags', {})
-
-                # Handle case-insensitive tag names
-                album = tags.get('album') or tags.get('ALBUM')
-                title = tags.get('title') or tags.get('TITLE')
-
-                if not album or album.strip() == '':
-                    if title and title.strip() != '':
-                        # Use ffmpeg to copy the file with updated metadata
-                        temp_output = filepath.with_suffix(filepath.suffix +
-                                                           '.tmp')
-                        ffmpeg_cmd = [
-                            'ffmpeg', '-i',
-                            str(filepath), '-c', 'copy', '-metadata',
-                            f'album={title}',
-                            str(temp_output), '-y', '-v', 'quiet'
-                        ]
-
-                        result = subprocess.run(ffmpeg_cmd,
-                                                capture_output=True,
-                                                text=True)
-
-                        if result.returncode == 0:
-                            # Replace original file with updated one
-                            temp_output.replace(filepath)
-                            tell_info(
-                                f"Populated empty album with title: {title}")
-                            return True
-                        else:
-                            tell_warn(
-                                f"ffmpeg failed to update metadata: {result.stderr}"
-                            )
-                            if temp_output.exists():
-                                temp_output.unlink()
-                            return False
-                    else:
-                        tell_debug(
-                            "Title is also empty, cannot populate album")
-                        return True
-                else:
-                    tell_debug(f"Album already populated: {album}")
-                    return True
+                value = tags.get(key)
+            except (KeyError, ValueError):
+                continue
+            if value is None:
+                continue
+            # ID3 frames keep their values in .text (or .url):
+            value = getattr(value, 'text', getattr(value, 'url', value))
+            if isinstance(value, list):
+                value = value[0] if value else None
+            if value:
+                return str(value)
+        return None
 
-            except subprocess.CalledProcessError as e:
-                tell_warn(f"ffprobe failed: {e}")
-                return False
-            except json.JSONDecodeError as e:
-                tell_warn(f"Failed to parse ffprobe output: {e}")
-                return False
-            except Exception as e:
-                tell_warn(f"Error using ffmpeg: {e}")
-                return False
-        else:
-            # Neither mutagen nor ffmpeg available
-            msg = "Cannot populate album: neither mutagen library nor ffmpeg utility available"
-            tell_warn_toast(msg)
-            return False
+    def _read(self, path: Path) -> Optional[TagView]:
+        tag_view = self._read_headers(path)
+        if tag_view is not None:
+            return tag_view
+        if not is_mutagen_available():
+            tell_debug("mutagen not available, trying ffprobe...")
+            return self._read_with_ffprobe(path)
+        return self._read_with_mutagen(path)
 
-    except Exception as e:
-        tell_warn(f"Error populating album metadata: {e}")
-        return False
+    def _read_headers(self, path: Path) -> Optional[TagView]:
+        fields = read_header_tags(path)
+        if fields is None:
+            return None
 
+        def first_value(field: str) -> Optional[str]:
+            return next((value for value in fields.get(field, []) if value),
+                        None)
 
-def transform_filename(filepath: str) -> str:
-    """
-    Transform filename according to the rules:
-    - Map % to %prcnt
-    - Replace _ with - (whitespace)
-    - Replace -- with _ (double dash)
-    - Make lowercase
-    """
-    new_filepath = filepath
+        return TagView(path=path,
+                       backend='headers',
+                       album=first_value('album'),
+                       title=first_value('title'),
+                       purl=first_value('purl'),
+                       comment=first_value('comment'))
 
-    # Temporarily map replacements to percent-prefixed phrases
-    new_filepath = new_filepath.replace('%', '%prcnt')
-    # For whitespace, yt-dlp uses underscores. Replace them with dashes
-    new_filepath = new_filepath.replace('_', '%whspc')
-    new_filepath = new_filepath.replace('--', '%ddash')
-    # Resolve percent-prefixed phrases
-    new_filepath = new_filepath.replace('%whspc', '-')
-    new_filepath = new_filepath.replace('%ddash', '_')
-    new_filepath = new_filepath.replace('%prcnt', '%')
-    # Make the whole filename lowercase
-    new_filepath = new_filepath.lower()
+    def _read_with_mutagen(self, path: Path) -> Optional[TagView]:
+        from mutagen import File as MutagenFile  # type: ignore[attr-defined]
 
-    return new_filepath
+        audio = MutagenFile(path)
+        if audio is None:
+            tell_warn(f"Could not read audio file: {path.name}")
+            return None
+        tags = getattr(audio, 'tags', None) or {}
+        return TagView(path=path,
+                       backend='mutagen',
+                       album=self._first_mutagen_value(tags, 'album'),
+                       title=self._first_mutagen_value(tags, 'title'),
+                       purl=self._first_mutagen_value(tags, 'purl'),
+                       comment=self._first_mutagen_value(tags, 'comment'),
+                       mutagen_file=audio)
 
+    def _read_with_ffprobe(self, path: Path) -> Optional[TagView]:
+        import json
 
-def download_song(url: str,
-                  target_dir: Path,
-                  timestamp: Optional[str] = None,
-                  populate_album: bool = False,
-                  mtime_shift_seconds: Optional[int] = None) -> Optional[Path]:
-    """
-    Download a single song from the given URL.
+        if not is_available('ffprobe'):
+            tell_warn(
+                "Neither mutagen nor ffprobe available to extract metadata.")
+            return None
+        probe_cmd = [
+            'ffprobe', '-v', 'quiet', '-print_format', 'json', '-show_format',
+            '-show_streams',
+            str(path)
+        ]
+        try:
+            probe_result = run_command(probe_cmd,
+                                       capture_output=True,
+                                       text=True,
+                                       check=True)
+            metadata = json.loads(probe_result.stdout)
+        except subprocess.CalledProcessError as e:
+            tell_warn(f"ffprobe failed: {e}")
+            return None
+        except json.JSONDecodeError as e:
+            tell_warn(f"Failed to parse ffprobe output: {e}")
+            return None
+        # Ogg streams carry their tags in the stream, other formats in the
+        # container; tag names are case-insensitive:
+        tags = {}
+        for stream in metadata.get('streams', []):
+            tags.update({k.lower(): v for k, v in stream.get('tags', {}).items()})
+        tags.update({
+            k.lower(): v
+            for k, v in metadata.get('format', {}).get('tags', {}).items()
+        })
+        return TagView(path=path,
+                       backend='ffprobe',
+                       album=tags.get('album') or None,
+                       title=tags.get('title') or None,
+                       purl=tags.get('purl') or None,
+                       comment=tags.get('comment') or None)
 
-    Args:
-        url: The URL to download from
-        target_dir: Directory to save the file to
-        timestamp: Optional timestamp prefix for filename
-        populate_album: If True, populate empty album metadata with title
-        mtime_shift_seconds: If provided and target file exists, shift its mtime by this many seconds
 
-    Returns:
-        Path to the downloaded file if successful, None otherwise
-    """
-    if timestamp is None:
-        timestamp = datetime.now().strftime('%Y%m%d')
+# global instance of metadata probe:
+metadata_probe = MetadataProbe()
 
-    # Create temporary file for filepath output
-    with tempfile.NamedTemporaryFile(mode='w+',
-                                     delete=False,
-                                     prefix='yt-dlp-filepath-') as tmp:
-        filepath_tmpfile = tmp.name
 
-    try:
-        # Construct output template
-        output_template = (
-            f"{timestamp}--%(artist,album_artist,channel|unknown)#S--"
-            f"%(album|unknown)#S--%(track,title|unknown)#S.%(ext)#S")
+def is_mutagen_available() -> bool:
+    """Check if the mutagen module is importable (without importing it)."""
+    import importlib.util
 
-        tell_info("Downloading the file...")
+    return importlib.util.find_spec('mutagen') is not None
 
-        # Run yt-dlp
-        cmd = [
-            'yt-dlp', '--no-playlist', '--js-runtimes', 'node',
-            '--audio-format', 'opus', '-x', '--embed-metadata',
-            '--embed-thumbnail', '--embed-subs', '-o', output_template,
-            '--print-to-file', 'after_move:filepath', filepath_tmpfile, '--',
-            url
-        ]
 
-        result = subprocess.run(
-            cmd,
-            cwd=target_dir,
-            capture_output=False,
-            text=True,
-        )
+def set_mutagen_album(tags: Any, album: str) -> None:
+    """Set the album of mutagen tags of any container (Vorbis, MP4, ID3)."""
+    tags_type = type(tags).__name__
+    if tags_type == 'MP4Tags':
+        tags['\xa9alb'] = [album]
+    elif tags_type == 'ID3':
+        from mutagen.id3 import TALB  # type: ignore[attr-defined]
+        tags.add(TALB(encoding=3, text=[album]))
+    else:
+        tags['album'] = album
 
-        if result.returncode != 0:
-            return None
 
-        # Read the filepath from temp file
-        with open(filepath_tmpfile, 'r') as f:
-            filepath = f.read().strip()
+# Ogg page header: capture pattern, version, flags, granule position, serial
+# number, page sequence number, CRC and number of segments:
+_OGG_PAGE_HEADER = struct.Struct('<4sBBqIIIB')
+_OGG_CONTINUED = 0x01
+# padding put into comment headers which have to be rewritten anyway, so that
+# later edits fit in place:
+OGG_COMMENT_PADDING = 1024
+_BIT_REVERSED_BYTES = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
 
-        if not filepath:
-            tell_error("No filepath returned from yt-dlp!")
-            return None
 
-        # Transform filename
-        new_filepath = transform_filename(filepath)
+def _ogg_crc(data: bytes) -> int:
+    """Compute the CRC of an Ogg page (with its CRC field zeroed)."""
+    import zlib
 
-        prev_stat_info = None
-        if filepath != new_filepath:
-            tell_info("Tweaking the file name...")
-            old_path = target_dir / filepath
-            new_path = target_dir / new_filepath
+    # Ogg uses the non-reflected CRC-32 without initial & final XOR. zlib's
+    # (reflected) CRC-32 of the bit-reversed data is its bit-reversed value,
+    # except for the effect of zlib's XORs - which equals the CRC of as many
+    # zero bytes:
+    crc = zlib.crc32(data.translate(_BIT_REVERSED_BYTES)) ^ zlib.crc32(
+        bytes(len(data)))
+    return int(f'{crc:032b}'[::-1], 2)
 
-            # get stat info of the previous target file if it exists:
-            if new_path.exists():
-                prev_stat_info = new_path.stat()
-            if old_path.exists():
-                old_path.rename(new_path)
-                tell_info(f"Renamed '{old_path.name}' to '{new_path.name}'.")
-                filepath = new_filepath
-            else:
-                tell_warn(f"File '{filepath}' not found, skipping rename...")
 
-        # Touch the file to update timestamp
-        final_path = target_dir / filepath
-        if final_path.exists():
-            final_path.touch()
+@dataclass
+class OggPage:
+    """A page of an Ogg bitstream."""
+    flags: int
+    granule: int
+    serial: int
+    seq: int
+    lacing: bytes
+    body: bytes
 
-        # Populate empty album with title if requested
-        if populate_album:
-            tell_info("Checking album metadata...")
-            populate_empty_album_with_title(final_path)
+    @property
+    def size(self) -> int:
+        return _OGG_PAGE_HEADER.size + len(self.lacing) + len(self.body)
 
-        # Apply mtime shifting if requested
-        if mtime_shift_seconds is not None and prev_stat_info is not None:
-            try:
-                original_mtime = prev_stat_info.st_mtime
-                shifted_mtime = original_mtime + mtime_shift_seconds
-                os.utime(final_path, (shifted_mtime, shifted_mtime))
-                tell_debug(
-                    f"Applied mtime shift of {mtime_shift_seconds}s to '{final_path.name}'")
-            except Exception as e:
-                tell_warn(f"Failed to apply mtime shift: {e}")
+    @classmethod
+    def read(cls, f: Any) -> Optional['OggPage']:
+        """Read the next page from the file, None at its end."""
+        header = f.read(_OGG_PAGE_HEADER.size)
+        if not header:
+            return None
+        if len(header) < _OGG_PAGE_HEADER.size:
+            raise ValueError('truncated Ogg page')
+        (capture, version, flags, granule, serial, seq, _,
+         segments) = _OGG_PAGE_HEADER.unpack(header)
+        if capture != b'OggS' or version != 0:
+            raise ValueError('not an Ogg page')
+        lacing = f.read(segments)
+        body = f.read(sum(lacing))
+        if len(lacing) != segments or len(body) != sum(lacing):
+            raise ValueError('truncated Ogg page')
+        return cls(flags, granule, serial, seq, lacing, body)
 
-        tell_info("Done.")
-        return final_path
+    def to_bytes(self) -> bytes:
+        """Serialize the page (computing its CRC)."""
+        data = bytearray(
+            _OGG_PAGE_HEADER.pack(b'OggS', 0, self.flags, self.granule,
+                                  self.serial, self.seq, 0, len(self.lacing)))
+        data += self.lacing
+        data += self.body
+        struct.pack_into('<I', data, 22, _ogg_crc(bytes(data)))
+        return bytes(data)
 
-    except Exception as e:
-        tell_error(str(e))
-        return None
-    finally:
-        # Clean up temp file
-        try:
-            os.unlink(filepath_tmpfile)
-        except:
-            tell_warn(f"Deleting temp file '{filepath_tmpfile}' failed.")
 
+def _ogg_header_pages_size(packet_lengths: List[int]) -> Tuple[int, int]:
+    """Get the byte size and page count of packets put by _paginate()."""
+    segments = sum(length // 255 + 1 for length in packet_lengths)
+    pages = -(-segments // 255)
+    return (pages * _OGG_PAGE_HEADER.size + segments + sum(packet_lengths),
+            pages)
 
-def main() -> int:
-    """Main entry point."""
-    parser = argparse.ArgumentParser(
-        description='Downloads music files for given URLs using yt-dlp.',
-        formatter_class=argparse.RawDescriptionHelpFormatter)
-    parser.add_argument(
-        '-d',
-        '--directory',
-        metavar='DIR',
-        default=os.getcwd(),
-        help='Directory to save downloaded files (default: current directory)')
-    parser.add_argument(
-        '-t',
-        '--timestamp',
-        metavar='DATETIME',
-        help=
-        f'Timestamp prefix for filenames (default: {datetime.now().strftime("%Y%m%d")})'
-    )
-    parser.add_argument(
-        '--notification-lines',
-        metavar='N',
-        type=int,
-        default=5,
-        help='Number of recent log lines to show in notification (default: 5)')
-    parser.add_argument(
-        '--populate-empty-album',
-        action='store_true',
-        help='Populate empty album metadata field with the title field')
-    parser.add_argument(
-        '--use-existing-target-file-mtime-shifted',
-        metavar='SECONDS',
-        type=int,
-        help='If target file exists, shift its mtime by SECONDS and apply to the downloaded file')
-    parser.add_argument(
-        'inputs',
-        metavar='URL-OR-FILE',
-        nargs='+',
-        help=
-        'URLs to download from or audio file paths to get download URLs from')
 
-    args = parser.parse_args()
+def _paginate(packets: List[bytes], serial: int,
+              first_seq: int) -> List[OggPage]:
+    """Put header packets into as few pages as possible."""
+    segments = []
+    for packet in packets:
+        lacing = [255] * (len(packet) // 255) + [len(packet) % 255]
+        for i, value in enumerate(lacing):
+            segments.append((value, i == len(lacing) - 1))
+    data = b''.join(packets)
+    pages = []
+    pos = 0
+    continued = False
+    for start in range(0, len(segments), 255):
+        chunk = segments[start:start + 255]
+        size = sum(value for value, _ in chunk)
+        # header pages have a granule position of 0 - unless no packet ends
+        # on them:
+        granule = 0 if any(last for _, last in chunk) else -1
+        pages.append(
+            OggPage(_OGG_CONTINUED if continued else 0, granule, serial,
+                    first_seq + len(pages), bytes(value for value, _ in chunk),
+                    data[pos:pos + size]))
+        pos += size
+        continued = not chunk[-1][1]
+    return pages
 
-    # Initialize the notification logger
-    init_logger(prog_name='get-song', max_recent=args.notification_lines)
 
-    # Check dependencies
-    if not check_dependencies():
-        logger = get_logger()
-        if logger:
-            logger.finalize()
-        return 1
+def _split_comment_packet(packet: bytes) -> Tuple[bytes, bytes, List[bytes],
+                                                  bytes, int]:
+    """
+    Split an Opus or Vorbis comment header packet.
+
+    Returns:
+        The magic, vendor string, comments, data to keep after the comments
+        (Vorbis framing bit, binary Opus data) and size of the padding
+    """
+    if packet.startswith(b'OpusTags'):
+        magic = b'OpusTags'
+    elif packet.startswith(b'\x03vorbis'):
+        magic = b'\x03vorbis'
+    else:
+        raise ValueError('not an Opus or Vorbis comment header')
+    pos = len(magic)
+    vendor_length, = struct.unpack_from('<I', packet, pos)
+    vendor = packet[pos + 4:pos + 4 + vendor_length]
+    pos += 4 + vendor_length
+    count, = struct.unpack_from('<I', packet, pos)
+    pos += 4
+    comments = []
+    for _ in range(count):
+        length, = struct.unpack_from('<I', packet, pos)
+        comments.append(packet[pos + 4:pos + 4 + length])
+        pos += 4 + length
+    if pos > len(packet):
+        raise ValueError('truncated comment header')
+    rest = packet[pos:]
+    if magic == b'OpusTags':
+        # data whose first byte has its lowest bit set has to be kept, other
+        # data is padding:
+        if rest and rest[0] & 1:
+            return magic, vendor, comments, rest, 0
+        return magic, vendor, comments, b'', len(rest)
+    if not rest or not rest[0] & 1:
+        raise ValueError('Vorbis comment header without framing bit')
+    # anything after the framing bit is ignored by decoders:
+    return magic, vendor, comments, rest[:1], len(rest) - 1
+
+
+def _read_ogg_header_packets(
+        f: Any) -> Optional[Tuple[OggPage, List[bytes], int, int, int]]:
+    """
+    Read the header packets of an Ogg Opus or Vorbis file.
+
+    Returns:
+        The first page, the header packets after it (comment header first),
+        the offsets of the pages holding them and their number - or None if
+        the file is not a (single stream) Ogg Opus or Vorbis file
+
+    Raises:
+        ValueError: If the file is not a valid Ogg file
+    """
+    first_page = OggPage.read(f)
+    if first_page is None or not first_page.body.startswith(
+        (b'OpusHead', b'\x01vorbis')):
+        return None
+    # Vorbis has a setup header after the comment header:
+    header_count = 2 if first_page.body.startswith(b'OpusHead') else 3
+    header_start = f.tell()
+    packets: List[bytes] = []
+    partial = b''
+    pages = 0
+    while len(packets) < header_count - 1:
+        page = OggPage.read(f)
+        if page is None or page.serial != first_page.serial:
+            return None
+        pages += 1
+        pos = 0
+        for value in page.lacing:
+            partial += page.body[pos:pos + value]
+            pos += value
+            if value < 255:
+                packets.append(partial)
+                partial = b''
+    if len(packets) != header_count - 1 or partial:
+        # audio data on the last header page
+        return None
+    return first_page, packets, header_start, f.tell(), pages
+
+
+def _read_ogg_comment_packet(f: Any) -> Optional[bytes]:
+    """
+    Read the comment header packet of an Ogg Opus or Vorbis file - reading
+    no further than the page completing it.
+
+    Returns:
+        The packet or None if the file is not a (single stream) Ogg Opus or
+        Vorbis file
+
+    Raises:
+        ValueError: If the file is not a valid Ogg file
+    """
+    first_page = OggPage.read(f)
+    if first_page is None or not first_page.body.startswith(
+        (b'OpusHead', b'\x01vorbis')):
+        return None
+    packet = b''
+    while True:
+        page = OggPage.read(f)
+        if page is None or page.serial != first_page.serial:
+            return None
+        pos = 0
+        for value in page.lacing:
+            packet += page.body[pos:pos + value]
+            pos += value
+            if value < 255:
+                return packet
+
+
+def _parse_vorbis_comments(comments: List[bytes]) -> dict[str, List[str]]:
+    """Group Vorbis comments (FIELD=value) by lowercase field name."""
+    fields: dict[str, List[str]] = {}
+    for comment in comments:
+        field, sep, value = comment.decode('utf-8', 'replace').partition('=')
+        if sep:
+            fields.setdefault(field.lower(), []).append(value)
+    return fields
+
+
+def read_ogg_comments(filepath: Path) -> Optional[dict[str, List[str]]]:
+    """
+    Read the comments of an Ogg Opus or Vorbis file.
+
+    Returns:
+        Comment values by (lowercase) field name or None if the file is not
+        a (single stream) Ogg Opus or Vorbis file
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            packet = _read_ogg_comment_packet(f)
+        if packet is None:
+            return None
+        _, _, comments, _, _ = _split_comment_packet(packet)
+    except (ValueError, struct.error) as e:
+        tell_debug(f"Cannot read Ogg headers of '{filepath.name}': {e}")
+        return None
+    return _parse_vorbis_comments(comments)
+
+
+def set_ogg_comments(filepath: Path, updates: dict) -> bool:
+    """
+    Set comments of an Ogg Opus or Vorbis file, editing its headers only.
+
+    Only the comment header pages get rewritten. If the new comments fit the
+    padding of the old header pages, they are written in place without
+    touching the audio pages. Otherwise the file is rewritten once - with
+    padding for the next time, and with page sequence numbers & CRCs of the
+    following pages fixed up if the header needs a different number of pages.
+
+    Args:
+        filepath: Path to the audio file
+        updates: Comment values by field name (replacing any existing values) -
+            a string, a list of strings or None to remove the field
+
+    Returns:
+        True if the comments were written, False if the file is not a
+        (single stream) Ogg Opus or Vorbis file
+    """
+    with open(filepath, 'rb') as f:
+        try:
+            headers = _read_ogg_header_packets(f)
+            if headers is None:
+                return False
+            first_page, packets, header_start, header_end, old_pages = headers
+            magic, vendor, comments, kept, padding = _split_comment_packet(
+                packets[0])
+        except (ValueError, struct.error) as e:
+            tell_debug(f"Cannot edit Ogg headers of '{filepath.name}': {e}")
+            return False
+
+    for field, values in updates.items():
+        prefix = field.upper().encode() + b'='
+        comments = [
+            comment for comment in comments
+            if not comment.upper().startswith(prefix)
+        ]
+        if values is None:
+            continue
+        for value in [values] if isinstance(values, str) else values:
+            comments.append(prefix + value.encode('utf-8'))
+    packet = (magic + struct.pack('<I', len(vendor)) + vendor +
+              struct.pack('<I', len(comments)) +
+              b''.join(struct.pack('<I', len(c)) + c for c in comments) + kept)
+    other_lengths = [len(p) for p in packets[1:]]
+
+    # find a padding size yielding header pages of the old size & number:
+    old_size = header_end - header_start
+    new_padding = None
+    if not (magic == b'OpusTags' and kept):
+        # each padding byte adds at least one byte - look from the largest
+        # possible padding downwards:
+        candidate = old_size - _ogg_header_pages_size([len(packet)] +
+                                                      other_lengths)[0]
+        while candidate >= 0:
+            size, pages = _ogg_header_pages_size([len(packet) + candidate] +
+                                                 other_lengths)
+            if (size, pages) == (old_size, old_pages):
+                new_padding = candidate
+                break
+            if size < old_size:
+                break
+            candidate -= 1
+    in_place = new_padding is not None
+    if not in_place:
+        new_padding = 0 if magic == b'OpusTags' and kept else OGG_COMMENT_PADDING
+    new_pages = _paginate([packet + bytes(new_padding)] + packets[1:],
+                          first_page.serial, 1)
+    header = b''.join(page.to_bytes() for page in new_pages)
+
+    if in_place:
+        with open(filepath, 'r+b') as f:
+            f.seek(header_start)
+            f.write(header)
+        tell_debug(f"Rewrote Ogg comment header of '{filepath.name}' in place.")
+        return True
+
+    seq_shift = len(new_pages) - old_pages
+    temp_path = filepath.with_name(f".{filepath.name}.get-song-tmp")
+    try:
+        with open(filepath, 'rb') as src, open(temp_path, 'wb') as dst:
+            dst.write(src.read(header_start))
+            dst.write(header)
+            src.seek(header_end)
+            if seq_shift == 0:
+                shutil.copyfileobj(src, dst, 1 << 20)
+            else:
+                while True:
+                    page = OggPage.read(src)
+                    if page is None:
+                        break
+                    if page.serial == first_page.serial:
+                        page.seq += seq_shift
+                    dst.write(page.to_bytes())
+        shutil.copymode(filepath, temp_path)
+        temp_path.replace(filepath)
+    except BaseException:
+        temp_path.unlink(missing_ok=True)
+        raise
+    tell_debug(f"Rewrote '{filepath.name}' with a larger Ogg comment header.")
+    return True
+
+
+def populate_empty_album_with_title(filepath: Path) -> bool:
+    """
+    Populate empty album metadata field with the title field.
+    Uses a fallback chain: built-in Ogg comment editor (for Opus & Vorbis
+    files) -> mutagen -> ffmpeg -> warn user.
+
+    Args:
+        filepath: Path to the audio file
+
+    Returns:
+        True if successful or album was already populated, False if failed
+    """
+    try:
+        tag_view = metadata_probe.probe(filepath)
+        if tag_view is None:
+            if not is_mutagen_available() and not is_available('ffmpeg'):
+                # Neither mutagen nor ffmpeg available
+                msg = "Cannot populate album: neither mutagen library nor ffmpeg utility available"
+                tell_warn_toast(msg)
+            return False
+
+        album = tag_view.album
+        title = tag_view.title
+        if album and album.strip() != '':
+            tell_debug(f"Album already populated: {album}")
+            return True
+        if not title or title.strip() == '':
+            tell_debug("Title is also empty, cannot populate album")
+            return True
+
+        if set_ogg_comments(filepath, {'album': title}):
+            pass
+        elif is_mutagen_available():
+            from mutagen import File as MutagenFile  # type: ignore[attr-defined]
+
+            # files read by the other backends still need parsing for writing:
+            audio = tag_view.mutagen_file or MutagenFile(filepath)
+            if not getattr(audio, 'tags', None):
+                tell_debug("No tags found in audio file")
+                return True
+            set_mutagen_album(audio.tags, title)
+            audio.save()
+        elif is_available('ffmpeg'):
+            # Use ffmpeg to copy the file with updated metadata
+            temp_output = filepath.with_suffix(filepath.suffix + '.tmp')
+            ffmpeg_cmd = [
+                'ffmpeg', '-i',
+                str(filepath), '-c', 'copy', '-metadata', f'album={title}',
+                str(temp_output), '-y', '-v', 'quiet'
+            ]
+
+            result = run_command(ffmpeg_cmd, capture_output=True, text=True)
+
+            if result.returncode != 0:
+                tell_warn(f"ffmpeg failed to update metadata: {result.stderr}")
+                if temp_output.exists():
+                    temp_output.unlink()
+                return False
+            # Replace original file with updated one
+            temp_output.replace(filepath)
+        else:
+            tell_warn_toast("Cannot populate album: ffmpeg utility not available")
+            return False
+
+        metadata_probe.invalidate(filepath)
+        tell_info(f"Populated empty album with title: {title}")
+        return True
+
+    except Exception as e:
+        tell_warn(f"Error populating album metadata: {e}")
+        return False
+
+
+@dataclass
+class AudioFingerprint:
+    """Digests of the audio payload and of the tags of an audio file."""
+    audio: str
+    tags: str
+
+
+def _hash_stream(f: Any, digest: Any, size: Optional[int] = None) -> None:
+    """Feed the next `size` bytes of the file (default: the rest) to digest."""
+    while size is None or size > 0:
+        chunk = f.read(1 << 20 if size is None else min(1 << 20, size))
+        if not chunk:
+            if size is not None:
+                raise ValueError('truncated file')
+            return
+        digest.update(chunk)
+        if size is not None:
+            size -= len(chunk)
+
+
+def _fingerprint_ogg(f: Any, audio: Any, tags: Any) -> bool:
+    headers = _read_ogg_header_packets(f)
+    if headers is None:
+        return False
+    first_page, packets, _, _, _ = headers
+    # identification & Vorbis setup headers describe the audio:
+    audio.update(first_page.body)
+    for packet in packets[1:]:
+        audio.update(packet)
+    # the order of the comments doesn't matter, the vendor string (naming
+    # the muxer) and padding don't either:
+    _, _, comments, kept, _ = _split_comment_packet(packets[0])
+    for comment in sorted(comments):
+        tags.update(struct.pack('<I', len(comment)) + comment)
+    tags.update(kept)
+    # serial numbers (random per muxing), sequence numbers and CRCs of the
+    # audio pages are left out:
+    while True:
+        page = OggPage.read(f)
+        if page is None:
+            return True
+        if page.serial != first_page.serial:
+            return False
+        audio.update(struct.pack('<q', page.granule))
+        audio.update(page.lacing)
+        audio.update(page.body)
+
+
+def _fingerprint_mp4(f: Any, audio: Any, tags: Any) -> bool:
+    while True:
+        header = f.read(8)
+        if not header:
+            return True
+        if len(header) < 8:
+            raise ValueError('truncated MP4 box')
+        size, box_type = struct.unpack('>I4s', header)
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0] - 16
+        elif size == 0:
+            size = None  # up to the end of the file
+        else:
+            size -= 8
+        if size is not None and size < 0:
+            raise ValueError('invalid MP4 box size')
+        if box_type == b'mdat':
+            _hash_stream(f, audio, size)
+        elif box_type in (b'free', b'skip'):
+            if size is None:
+                return True
+            f.seek(size, os.SEEK_CUR)
+        else:
+            # the metadata (moov) box holds the sample tables as well as the
+            # tags - any difference in it counts as a tag difference:
+            tags.update(box_type)
+            _hash_stream(f, tags, size)
+        if size is None:
+            return True
+
+
+# FLAC metadata block types describing the audio (STREAMINFO, SEEKTABLE) and
+# the padding:
+_FLAC_AUDIO_BLOCKS = (0, 3)
+_FLAC_PADDING_BLOCK = 1
+
+
+def _fingerprint_flac(f: Any, audio: Any, tags: Any) -> bool:
+    f.seek(4)
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            raise ValueError('truncated FLAC metadata block')
+        last = bool(header[0] & 0x80)
+        block_type = header[0] & 0x7f
+        size = int.from_bytes(header[1:], 'big')
+        if block_type == _FLAC_PADDING_BLOCK:
+            f.seek(size, os.SEEK_CUR)
+        else:
+            _hash_stream(f, audio if block_type in _FLAC_AUDIO_BLOCKS else tags,
+                         size)
+    _hash_stream(f, audio)
+    return True
+
+
+def fingerprint_audio(filepath: Path) -> Optional[AudioFingerprint]:
+    """
+    Fingerprint an audio file, hashing its audio payload apart from its tags
+    in a single streamed pass. Files differing in their tags only get the same
+    audio digest. Supports Ogg Opus & Vorbis, MP4 and FLAC files.
+
+    Returns:
+        The fingerprint or None if the file's format is not supported
+    """
+    import hashlib
+
+    audio = hashlib.sha256()
+    tags = hashlib.sha256()
+    try:
+        with open(filepath, 'rb') as f:
+            magic = f.read(12)
+            f.seek(0)
+            if magic.startswith(b'OggS'):
+                supported = _fingerprint_ogg(f, audio, tags)
+            elif magic[4:8] == b'ftyp':
+                supported = _fingerprint_mp4(f, audio, tags)
+            elif magic.startswith(b'fLaC'):
+                supported = _fingerprint_flac(f, audio, tags)
+            else:
+                supported = False
+    except (OSError, ValueError, struct.error) as e:
+        tell_debug(f"Cannot fingerprint '{filepath.name}': {e}")
+        return None
+    if not supported:
+        return None
+    return AudioFingerprint(audio=audio.hexdigest(), tags=tags.hexdigest())
+
+
+# FLAC metadata block type of the Vorbis comments:
+_FLAC_VORBIS_COMMENT_BLOCK = 4
+
+
+def _read_flac_tags(f: Any) -> Optional[dict[str, List[str]]]:
+    f.seek(4)
+    last = False
+    while not last:
+        header = f.read(4)
+        if len(header) < 4:
+            raise ValueError('truncated FLAC metadata block')
+        last = bool(header[0] & 0x80)
+        size = int.from_bytes(header[1:], 'big')
+        if header[0] & 0x7f == _FLAC_VORBIS_COMMENT_BLOCK:
+            block = f.read(size)
+            if len(block) < size:
+                raise ValueError('truncated FLAC metadata block')
+            # a comment header without magic & framing bit:
+            _, _, comments, _, _ = _split_comment_packet(b'OpusTags' + block)
+            return _parse_vorbis_comments(comments)
+        f.seek(size, os.SEEK_CUR)
+    return {}
+
+
+# MP4 boxes leading to the iTunes-style tags (moov/udta/meta/ilst) and the
+# tag items of the supported fields:
+_MP4_TAG_PATH = (b'moov', b'udta', b'meta', b'ilst')
+_MP4_TAG_ITEMS = {
+    b'\xa9alb': 'album',
+    b'\xa9nam': 'title',
+    b'\xa9cmt': 'comment',
+}
+
+
+def _iter_mp4_boxes(f: Any, end: Optional[int]) -> Iterator[Tuple[bytes, int]]:
+    """
+    Iterate over the boxes up to the end offset (None: the end of the file),
+    yielding their type and size and leaving the file at the box's content.
+    Boxes not read by the caller are skipped.
+    """
+    pos = f.tell()
+    while end is None or pos + 8 <= end:
+        f.seek(pos)
+        header = f.read(8)
+        if not header:
+            return
+        if len(header) < 8:
+            raise ValueError('truncated MP4 box')
+        size, box_type = struct.unpack('>I4s', header)
+        content_start = pos + 8
+        if size == 1:
+            size = struct.unpack('>Q', f.read(8))[0]
+            content_start += 8
+        elif size == 0:
+            # up to the end of the file - no box follows
+            yield box_type, -1
+            return
+        if size < content_start - pos:
+            raise ValueError('invalid MP4 box size')
+        yield box_type, size - (content_start - pos)
+        pos += size
+
+
+def _read_mp4_tags(f: Any) -> Optional[dict[str, List[str]]]:
+    end = None
+    for box_type in _MP4_TAG_PATH:
+        for found_type, size in _iter_mp4_boxes(f, end):
+            if found_type == box_type:
+                break
+        else:
+            return {}
+        end = f.tell() + size if size >= 0 else None
+        if box_type == b'meta':
+            # a full box - skip its version & flags:
+            f.seek(4, os.SEEK_CUR)
+    fields: dict[str, List[str]] = {}
+    for item_type, size in _iter_mp4_boxes(f, end):
+        field = _MP4_TAG_ITEMS.get(item_type)
+        if field is None:
+            continue
+        item_end = f.tell() + size
+        for data_type, data_size in _iter_mp4_boxes(f, item_end):
+            if data_type != b'data':
+                continue
+            data = f.read(data_size)
+            # type indicator 1: UTF-8 text (after the type & locale):
+            if len(data) >= 8 and data[:4] == b'\x00\x00\x00\x01':
+                fields.setdefault(field, []).append(
+                    data[8:].decode('utf-8', 'replace'))
+    return fields
+
+
+_ID3_ENCODINGS = ('latin-1', 'utf-16', 'utf-16-be', 'utf-8')
+
+
+def _syncsafe_int(data: bytes) -> int:
+    """Decode an ID3 synchsafe integer (7 bits per byte)."""
+    value = 0
+    for byte in data:
+        value = (value << 7) | (byte & 0x7f)
+    return value
+
+
+def _split_id3_raw(data: bytes, encoding: int) -> List[bytes]:
+    """Split null-terminated ID3 strings (the last one unterminated)."""
+    if encoding not in (1, 2):
+        return data.split(b'\x00')
+    # two-byte terminators at even offsets:
+    values = []
+    start = 0
+    for pos in range(0, len(data) - 1, 2):
+        if data[pos:pos + 2] == b'\x00\x00':
+            values.append(data[start:pos])
+            start = pos + 2
+    values.append(data[start:])
+    return values
+
+
+def _split_id3_text(data: bytes, encoding: int) -> List[str]:
+    """Split and decode null-terminated ID3 strings."""
+    return [
+        value.decode(_ID3_ENCODINGS[encoding], 'replace')
+        for value in _split_id3_raw(data, encoding)
+    ]
+
+
+def _read_id3_tags(f: Any) -> Optional[dict[str, List[str]]]:
+    header = f.read(10)
+    version, flags = header[3], header[5]
+    if version not in (3, 4) or flags & 0x80:
+        # ID3v2.2 or unsynchronised tags - leave them to mutagen:
+        return None
+    tag = f.read(_syncsafe_int(header[6:10]))
+    pos = 0
+    if flags & 0x40:
+        # skip the extended header:
+        if version == 4:
+            pos = _syncsafe_int(tag[:4])
+        else:
+            pos = 4 + int.from_bytes(tag[:4], 'big')
+    fields: dict[str, List[str]] = {}
+    while pos + 10 <= len(tag) and tag[pos] != 0:
+        frame_id = tag[pos:pos + 4]
+        raw_size = tag[pos + 4:pos + 8]
+        size = (_syncsafe_int(raw_size)
+                if version == 4 else int.from_bytes(raw_size, 'big'))
+        format_flags = tag[pos + 9]
+        data = tag[pos + 10:pos + 10 + size]
+        pos += 10 + size
+        # skip grouped, compressed, encrypted & unsynchronised frames (v2.4
+        # has format flags in the low bits, v2.3 in the high ones):
+        if format_flags & (0x4f if version == 4 else 0xe0) or not data:
+            continue
+        encoding = data[0]
+        if encoding >= len(_ID3_ENCODINGS):
+            continue
+        if frame_id in (b'TALB', b'TIT2'):
+            field = 'album' if frame_id == b'TALB' else 'title'
+            fields.setdefault(field, []).append(
+                _split_id3_text(data[1:], encoding)[0])
+        elif frame_id == b'TXXX':
+            description, value = (_split_id3_text(data[1:], encoding) +
+                                  [''])[:2]
+            if description.lower() == 'purl':
+                fields.setdefault('purl', []).append(value)
+        elif frame_id == b'WXXX':
+            # the URL is always Latin-1 - after the encoded description:
+            description = _split_id3_raw(data[1:], encoding)[0]
+            if description.decode(_ID3_ENCODINGS[encoding],
+                                  'replace').lower() == 'purl':
+                terminator = 2 if encoding in (1, 2) else 1
+                url = data[1 + len(description) + terminator:]
+                fields.setdefault('purl', []).append(
+                    url.split(b'\x00')[0].decode('latin-1'))
+        elif frame_id == b'COMM':
+            # language, then the (empty for the main comment) description:
+            description, value = (_split_id3_text(data[4:], encoding) +
+                                  [''])[:2]
+            if not description:
+                fields.setdefault('comment', []).append(value)
+    return fields
+
+
+def read_header_tags(filepath: Path) -> Optional[dict[str, List[str]]]:
+    """
+    Read tags of an audio file reading its headers only - the comment header
+    of Ogg Opus & Vorbis files, the metadata blocks of FLAC files, the tag
+    boxes of MP4 files (seeking past the audio) or the ID3v2 tag of a file.
+
+    Returns:
+        Tag values by lowercase field name - Vorbis comment names for Ogg &
+        FLAC files, 'album', 'title', 'purl' & 'comment' for the others - or
+        None if the file's format is not supported
+    """
+    try:
+        with open(filepath, 'rb') as f:
+            magic = f.read(12)
+            f.seek(0)
+            if magic.startswith(b'OggS'):
+                packet = _read_ogg_comment_packet(f)
+                if packet is None:
+                    return None
+                _, _, comments, _, _ = _split_comment_packet(packet)
+                return _parse_vorbis_comments(comments)
+            if magic[4:8] == b'ftyp':
+                return _read_mp4_tags(f)
+            if magic.startswith(b'fLaC'):
+                return _read_flac_tags(f)
+            if magic.startswith(b'ID3'):
+                return _read_id3_tags(f)
+    except (OSError, ValueError, IndexError, struct.error) as e:
+        tell_debug(f"Cannot read the tags of '{filepath.name}': {e}")
+    return None
+
+
+class UnchangedFile(type(Path())):
+    """
+    Path of an existing target file a download kept instead of replacing it
+    (see keep_unchanged_target()) - left alone by the post-download stages.
+    """
+
+
+def keep_unchanged_target(new_path: Path, target_path: Path) -> bool:
+    """
+    Keep the existing target file instead of a new download of it if their
+    audio is identical, merging the tag changes into the existing file (in
+    place, for Ogg files only). The kept file keeps its modification time.
+
+    Args:
+        new_path: Path to the new download (removed if the target is kept)
+        target_path: Path to the existing target file
+
+    Returns:
+        True if the target file was kept, False if the new download has to
+        replace it
+    """
+    new_fingerprint = fingerprint_audio(new_path)
+    if new_fingerprint is None:
+        return False
+    old_fingerprint = fingerprint_audio(target_path)
+    if old_fingerprint is None or old_fingerprint.audio != new_fingerprint.audio:
+        return False
+    if old_fingerprint.tags != new_fingerprint.tags:
+        new_comments = read_ogg_comments(new_path)
+        old_comments = read_ogg_comments(target_path)
+        if new_comments is None or old_comments is None:
+            tell_debug("Tags changed and cannot be merged, replacing the file.")
+            return False
+        updates: dict = {field: None for field in old_comments}
+        updates.update(new_comments)
+        target_stat = target_path.stat()
+        try:
+            if not set_ogg_comments(target_path, updates):
+                return False
+            os.utime(target_path,
+                     ns=(target_stat.st_atime_ns, target_stat.st_mtime_ns))
+        except OSError as e:
+            tell_warn(f"Failed to merge tag changes: {e}")
+            return False
+        metadata_probe.invalidate(target_path)
+        tell_info(f"Merged tag changes into '{target_path.name}'.")
+    new_path.unlink()
+    events.count('audio-unchanged')
+    tell_info(f"Audio of '{target_path.name}' is unchanged, keeping the "
+              "existing file.")
+    return True
+
+
+def transform_filename(filepath: str) -> str:
+    """
+    Transform filename according to the rules:
+    - Map % to %prcnt
+    - Replace _ with - (whitespace)
+    - Replace -- with _ (double dash)
+    - Make lowercase
+    """
+    new_filepath = filepath
+
+    # Temporarily map replacements to percent-prefixed phrases
+    new_filepath = new_filepath.replace('%', '%prcnt')
+    # For whitespace, yt-dlp uses underscores. Replace them with dashes
+    new_filepath = new_filepath.replace('_', '%whspc')
+    new_filepath = new_filepath.replace('--', '%ddash')
+    # Resolve percent-prefixed phrases
+    new_filepath = new_filepath.replace('%whspc', '-')
+    new_filepath = new_filepath.replace('%ddash', '_')
+    new_filepath = new_filepath.replace('%prcnt', '%')
+    # Make the whole filename lowercase
+    new_filepath = new_filepath.lower()
+
+    return new_filepath
+
+
+def make_archive_id(extractor_key: Optional[str],
+                    video_id: Optional[str]) -> Optional[str]:
+    """
+    Build the archive ID of a video the way yt-dlp's download archive does -
+    the lowercase extractor key and the (case-sensitive) video ID.
+    """
+    if not extractor_key or not video_id or extractor_key == 'NA':
+        return None
+    return f"{extractor_key.lower()} {video_id}"
+
+
+class DownloadArchive:
+    """
+    Persistent archive of downloaded songs, kept in an SQLite database.
+
+    Songs are keyed by target directory and yt-dlp's archive ID (lowercase
+    extractor key and video ID). Each entry remembers the final file path,
+    mtime and size, so a song whose file is still intact gets skipped before
+    any network work. URLs seen before are mapped to their archive IDs, which
+    covers sites whose video ID can't be derived from the URL.
+    """
+
+    # YouTube URLs are by far the most common ones - derive their ID locally:
+    _YOUTUBE_ID_RE = (r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)'
+                      r'|youtu\.be/)([0-9A-Za-z_-]{11})')
+
+    def __init__(self, db_path: Path):
+        self.db_path = db_path
+        self._initialized = False
+
+    def _connect(self):
+        """Open a connection to the archive database (creating its tables)."""
+        import sqlite3
+
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        if not self._initialized:
+            with conn:
+                conn.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                             'target_dir TEXT NOT NULL, '
+                             'archive_id TEXT NOT NULL, '
+                             'path TEXT NOT NULL, '
+                             'mtime REAL NOT NULL, '
+                             'size INTEGER NOT NULL, '
+                             'downloaded_at REAL NOT NULL, '
+                             'PRIMARY KEY (target_dir, archive_id))')
+                conn.execute('CREATE TABLE IF NOT EXISTS urls ('
+                             'target_dir TEXT NOT NULL, '
+                             'url TEXT NOT NULL, '
+                             'archive_id TEXT NOT NULL, '
+                             'PRIMARY KEY (target_dir, url))')
+            self._initialized = True
+        return conn
+
+    @classmethod
+    def guess_archive_id(cls, url: str) -> Optional[str]:
+        """Derive the archive ID from the URL alone, if possible."""
+        import re
+
+        match = re.search(cls._YOUTUBE_ID_RE, url)
+        if match:
+            return f"youtube {match.group(1)}"
+        return None
+
+    def lookup(self, url: str, target_dir: Path) -> Optional[Path]:
+        """
+        Find an intact, previously downloaded file for the URL.
+
+        Returns:
+            Path to the file if it is unchanged since its download, else None
+        """
+        conn = self._connect()
+        try:
+            archive_id = self.guess_archive_id(url)
+            if archive_id is None:
+                row = conn.execute(
+                    'SELECT archive_id FROM urls '
+                    'WHERE target_dir = ? AND url = ?',
+                    (str(target_dir), url)).fetchone()
+                if row is None:
+                    return None
+                archive_id = row[0]
+            row = conn.execute(
+                'SELECT path, mtime, size FROM downloads '
+                'WHERE target_dir = ? AND archive_id = ?',
+                (str(target_dir), archive_id)).fetchone()
+        finally:
+            conn.close()
+        if row is None:
+            return None
+        path = Path(row[0])
+        try:
+            stat_info = path.stat()
+        except OSError:
+            return None
+        if stat_info.st_mtime != row[1] or stat_info.st_size != row[2]:
+            return None
+        return path
+
+    def record(self, url: str, target_dir: Path, archive_id: str,
+               path: Path) -> None:
+        """Record a finished download of the URL into the given file."""
+        stat_info = path.stat()
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO downloads '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (str(target_dir), archive_id, str(path),
+                     stat_info.st_mtime, stat_info.st_size, time.time()))
+                conn.execute('INSERT OR REPLACE INTO urls VALUES (?, ?, ?)',
+                             (str(target_dir), url, archive_id))
+        finally:
+            conn.close()
+
+
+class InfoCache:
+    """
+    Cache of the info JSON yt-dlp extracted per video, so that retries and
+    re-runs skip the metadata extraction (and JS signature solving).
+
+    Entries are keyed by the video's archive ID if it can be derived from the
+    URL (the normalized URL otherwise). They expire after `ttl` seconds -
+    the media URLs in them are only valid for a few hours - and the oldest
+    entries get evicted once the cache exceeds `max_bytes`.
+    """
+
+    def __init__(self, cache_dir: Path, ttl: float, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def _key(url: str) -> str:
+        import hashlib
+        from urllib.parse import urlsplit, urlunsplit
+
+        key = DownloadArchive.guess_archive_id(url)
+        if key is None:
+            parts = urlsplit(url.strip())
+            key = urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                              parts.path.rstrip('/'), parts.query, ''))
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def path_for(self, url: str) -> Path:
+        """Get the path the info JSON of the URL is cached at."""
+        return self.cache_dir / f"{self._key(url)}.info.json"
+
+    def lookup(self, url: str) -> Optional[Path]:
+        """Get the cached info JSON of the URL unless missing or expired."""
+        path = self.path_for(url)
+        try:
+            age = time.time() - path.stat().st_mtime
+        except FileNotFoundError:
+            events.count('info-cache-miss')
+            return None
+        if age > self.ttl:
+            self.invalidate(url)
+            events.count('info-cache-miss', expired=True)
+            return None
+        events.count('info-cache-hit')
+        return path
+
+    def store(self, url: str, info: dict) -> None:
+        """Cache info of the URL extracted other than by a download."""
+        import json
+
+        path = self.path_for(url)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(info, f)
+        tmp_path.replace(path)
+        self.evict()
+
+    def invalidate(self, url: str) -> None:
+        """Drop the cached info JSON of the URL."""
+        self.path_for(url).unlink(missing_ok=True)
+
+    def evict(self) -> None:
+        """Remove expired entries and the oldest ones beyond the size limit."""
+        entries = []
+        now = time.time()
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if not entry.name.endswith('.info.json'):
+                        continue
+                    try:
+                        stat = entry.stat()
+                    except OSError:
+                        continue
+                    if now - stat.st_mtime > self.ttl:
+                        os.unlink(entry.path)
+                    else:
+                        entries.append((stat.st_mtime, stat.st_size,
+                                        entry.path))
+        except OSError as e:
+            tell_warn(f"Cannot clean up info cache: {e}")
+            return
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+
+
+class ThumbnailCache:
+    """
+    Content-addressed cache of the (converted) cover images of songs, so that
+    artwork shared by several tracks is fetched and converted only once.
+
+    Images are stored under the hash of their content, with an index mapping
+    thumbnail URLs to them. Used images are touched, and the least recently
+    used ones get evicted once the cache exceeds `max_bytes`.
+    """
+
+    # thumbnail formats embeddable without conversion - others become PNG:
+    CONVERT_THUMBNAILS = 'jpg>jpg/png'
+
+    def __init__(self, cache_dir: Path, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def _index_path(self, url: str) -> Path:
+        import hashlib
+
+        return (self.cache_dir / 'by-url' /
+                hashlib.sha1(url.encode()).hexdigest())
+
+    def lookup(self, url: str) -> Optional[Path]:
+        """Get the cached image of the thumbnail URL, if any."""
+        try:
+            name = self._index_path(url).read_text().strip()
+            path = self.cache_dir / name
+            os.utime(path)
+        except (OSError, ValueError):
+            events.count('thumbnail-cache-miss')
+            return None
+        events.count('thumbnail-cache-hit')
+        return path
+
+    def patch_info(self, info: dict) -> bool:
+        """
+        Point the thumbnail of yt-dlp's info at its cached image, if any.
+
+        The info has to be loaded with file:// URLs enabled then. The original
+        thumbnail URL is kept in its 'thumbnail' field.
+
+        Returns:
+            True if the info got patched
+        """
+        url = info.get('thumbnail')
+        if not url and info.get('thumbnails'):
+            url = info['thumbnails'][-1].get('url')
+        if not url:
+            return False
+        path = self.lookup(url)
+        if path is None:
+            return False
+        info['thumbnail'] = url
+        info['thumbnails'] = [{'id': 'cached', 'url': path.as_uri()}]
+        return True
+
+    def make_scratch_dir(self) -> Path:
+        """
+        Create a directory for yt-dlp to write the thumbnail of a download to
+        (to be removed after the download). Ones left by killed downloads
+        are removed along the way.
+        """
+        import tempfile
+
+        incoming_dir = self.cache_dir / 'incoming'
+        incoming_dir.mkdir(parents=True, exist_ok=True)
+        stale_before = time.time() - 24 * 3600
+        try:
+            with os.scandir(incoming_dir) as it:
+                for entry in it:
+                    if entry.stat().st_mtime < stale_before:
+                        shutil.rmtree(entry.path, ignore_errors=True)
+        except OSError:
+            pass
+        return Path(tempfile.mkdtemp(dir=incoming_dir))
+
+    def store(self, url: str, image_path: Path) -> None:
+        """Move an image written by yt-dlp for the thumbnail URL into cache."""
+        import hashlib
+
+        digest = hashlib.sha256()
+        with open(image_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 16), b''):
+                digest.update(chunk)
+        name = digest.hexdigest()[:32] + image_path.suffix.lower()
+        path = self.cache_dir / name
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if path.exists():
+            image_path.unlink()
+            os.utime(path)
+        else:
+            shutil.move(str(image_path), path)
+        index_path = self._index_path(url)
+        index_path.parent.mkdir(exist_ok=True)
+        index_path.write_text(name)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used images beyond the size limit."""
+        entries = []
+        try:
+            with os.scandir(self.cache_dir) as it:
+                for entry in it:
+                    if entry.is_file():
+                        stat = entry.stat()
+                        entries.append(
+                            (stat.st_mtime, stat.st_size, entry.path))
+        except OSError as e:
+            tell_warn(f"Cannot clean up thumbnail cache: {e}")
+            return
+        total = sum(size for _, size, _ in entries)
+        evicted = set()
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                continue
+            total -= size
+            evicted.add(os.path.basename(path))
+        if evicted:
+            self._prune_index(evicted)
+
+    def _prune_index(self, evicted: set) -> None:
+        """Remove the index entries pointing at the given evicted images."""
+        try:
+            with os.scandir(self.cache_dir / 'by-url') as it:
+                for entry in it:
+                    try:
+                        with open(entry.path, encoding='utf-8') as f:
+                            if f.read().strip() in evicted:
+                                os.unlink(entry.path)
+                    except OSError:
+                        continue
+        except OSError as e:
+            tell_warn(f"Cannot clean up thumbnail cache index: {e}")
+
+
+class TransientDownloadError(Exception):
+    """A download failed in a way worth retrying later (e.g. network error)."""
+    # staging work directory kept for the retry to resume (if any):
+    work_dir: Optional[Path] = None
+
+
+# yt-dlp error messages telling a download failed for good:
+_PERMANENT_ERROR_PATTERNS = (
+    'unsupported url', 'is not a valid url', 'video unavailable',
+    'private video', 'has been removed', 'not available in your country',
+    'sign in to confirm your age', 'members-only', 'copyright',
+    'http error 404', 'http error 410', 'requested format is not available',
+    'http error 403', 'certificate verify failed', 'ffmpeg not found',
+    'no space left on device')
+# ... and ones telling it failed because of a (likely) temporary problem:
+_TRANSIENT_ERROR_PATTERNS = (
+    'timed out', 'timeout', 'connection reset', 'connection aborted',
+    'connection refused', 'remote end closed connection', 'broken pipe',
+    'incompleteread', 'incomplete read', 'network is unreachable',
+    'no route to host', 'temporary failure in name resolution',
+    'name or service not known', 'failed to resolve', 'unable to connect',
+    'http error 429', 'http error 500', 'http error 502', 'http error 503',
+    'http error 504', 'got server http error', 'giving up after',
+    'eof occurred', 'ssl: unexpected_eof', 'ssleoferror', 'sslerror',
+    'content too short', 'did not get any data', 'bytes, expected',
+    'got error: <urlopen error')
+
+
+def is_transient_error(message: str) -> bool:
+    """Classify a yt-dlp error message as transient (worth a retry) or not."""
+    message = message.lower()
+    if any(pattern in message for pattern in _PERMANENT_ERROR_PATTERNS):
+        return False
+    return any(pattern in message for pattern in _TRANSIENT_ERROR_PATTERNS)
+
+
+@dataclass
+class RetryPolicy:
+    """
+    Exponential backoff (with jitter) for retrying transient download
+    failures, capped by the number of attempts and the total retry time.
+    """
+    max_attempts: int = 5
+    base_delay: float = 5.0
+    max_delay: float = 120.0
+    max_total: float = 900.0
+
+    @classmethod
+    def from_args(cls, args: argparse.Namespace) -> 'RetryPolicy':
+        return cls(max_attempts=args.retries + 1,
+                   base_delay=args.retry_delay,
+                   max_total=args.retry_total)
+
+    def next_delay(self, attempt: int,
+                   first_failure: float) -> Optional[float]:
+        """
+        Get the delay before the next attempt, None when giving up.
+
+        Args:
+            attempt: Number of the attempt that failed (starting at 1)
+            first_failure: Time of the first failed attempt (time.time())
+        """
+        import random
+
+        if attempt >= self.max_attempts:
+            return None
+        ceiling = min(self.max_delay, self.base_delay * 2**(attempt - 1))
+        delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+        if time.time() + delay - first_failure > self.max_total:
+            return None
+        return delay
+
+
+def retry_later(policy: RetryPolicy, attempt: int, first_failure: float,
+                error: Exception, resubmit: Callable[[], Any]) -> bool:
+    """
+    Schedule another attempt of a download which failed transiently.
+
+    The attempt is started from a timer thread, so no worker is blocked
+    during the backoff and other inputs keep progressing.
+
+    Returns:
+        True if the retry got scheduled, False when giving up
+    """
+    delay = policy.next_delay(attempt, first_failure)
+    if delay is None:
+        tell_warn(f"{error} - giving up after {attempt} attempt(s).")
+        events.count('retry-exhausted')
+        work_dir = getattr(error, 'work_dir', None)
+        if work_dir is not None:
+            # nothing resumes the partial download anymore:
+            remove_work_dir(work_dir)
+        return False
+    tell_warn(f"{error} - retrying in {delay:.1f}s "
+              f"(attempt {attempt + 1}/{policy.max_attempts})...")
+    events.count('retry')
+    timer = threading.Timer(delay, resubmit)
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+# prefix of the progress lines the subprocess engine has yt-dlp print:
+PROGRESS_PREFIX = 'get-song-progress '
+PROGRESS_TEMPLATE = (
+    'download:' + PROGRESS_PREFIX + '%(progress.status)s '
+    '%(progress.downloaded_bytes)s '
+    '%(progress.total_bytes,progress.total_bytes_estimate)s '
+    '%(progress.speed)s %(progress.eta)s %(progress.elapsed)s')
+
+
+class DownloadProgress:
+    """
+    Progress of a download as reported by yt-dlp: shown as a progress line of
+    the notification (updated at most every `interval` seconds, so that
+    following it costs next to nothing) and recorded as a transfer once the
+    download is done.
+    """
+
+    def __init__(self, interval: float = 1.0):
+        self.interval = interval
+        self.prefix = get_log_prefix()
+        # bytes & seconds of the files downloaded completely:
+        self.size = 0
+        self.duration = 0.0
+        self._shown_at = 0.0
+        self._key = object()
+
+    def update(self, status: Optional[str], downloaded: Optional[float],
+               total: Optional[float], speed: Optional[float],
+               eta: Optional[float], elapsed: Optional[float]) -> None:
+        """Take a progress update of the file being downloaded."""
+        if status == 'finished':
+            # files found downloaded already are reported without a duration:
+            if elapsed is not None:
+                self.size += int(downloaded or total or 0)
+                self.duration += elapsed
+            return
+        if status != 'downloading':
+            return
+        now = time.monotonic()
+        if now - self._shown_at < self.interval:
+            return
+        self._shown_at = now
+        logger = get_logger()
+        if logger:
+            logger.set_progress(self._key,
+                                self.format(downloaded, total, speed, eta))
+
+    def format(self, downloaded: Optional[float], total: Optional[float],
+               speed: Optional[float], eta: Optional[float]) -> str:
+        """Format a progress line, e.g. '[####------] 42% 1.2MiB/s ETA 0:07'."""
+        if total:
+            percent = min(100.0, 100.0 * (downloaded or 0) / total)
+            filled = int(percent // 10)
+            parts = [f"[{'#' * filled}{'-' * (10 - filled)}] {percent:.0f}%"]
+        else:
+            parts = [format_size(downloaded or 0)]
+        if speed:
+            parts.append(format_size(speed) + '/s')
+        if eta is not None:
+            parts.append(f"ETA {int(eta) // 60}:{int(eta) % 60:02d}")
+        return self.prefix + ' '.join(parts)
+
+    def handle_line(self, line: str) -> bool:
+        """Take a progress line printed by yt-dlp, False for other lines."""
+        if not line.startswith(PROGRESS_PREFIX):
+            return False
+        fields = line[len(PROGRESS_PREFIX):].split()
+        if len(fields) == 6:
+            try:
+                numbers = [
+                    None if field == 'NA' else float(field)
+                    for field in fields[1:]
+                ]
+            except ValueError:
+                return True
+            self.update(fields[0], *numbers)
+        return True
+
+    def hook(self, status: dict) -> None:
+        """Take a progress update from a yt_dlp progress hook."""
+        self.update(status.get('status'), status.get('downloaded_bytes'),
+                    status.get('total_bytes') or
+                    status.get('total_bytes_estimate'), status.get('speed'),
+                    status.get('eta'), status.get('elapsed'))
+
+    def finish(self) -> None:
+        """Remove the progress line and record the transfer."""
+        logger = get_logger()
+        if logger:
+            logger.set_progress(self._key, None)
+        if self.size:
+            events.record_transfer('download', self.size, self.duration)
+            throughput = (f" at {format_size(self.size / self.duration)}/s"
+                          if self.duration > 0 else '')
+            tell_debug(f"Downloaded {format_size(self.size)}{throughput}.")
+
+
+@dataclass
+class YtDlpResult:
+    """Outcome of a successful yt-dlp download."""
+    # path of the final file (after all post-processing)
+    filepath: Path
+    # yt-dlp's archive ID of the video ("<extractor key> <video ID>")
+    archive_id: Optional[str] = None
+    # ID and audio codec of the downloaded source format
+    format_id: Optional[str] = None
+    acodec: Optional[str] = None
+    # URL of the embedded thumbnail and the image file yt-dlp left of it
+    thumbnail_url: Optional[str] = None
+    thumbnail_path: Optional[Path] = None
+
+
+class OutputPlan:
+    """
+    The final file name of a download, planned as soon as yt-dlp's info is
+    known: the output template's file name normalized by transform_filename().
+    yt-dlp then writes the file under its final name right away, and the
+    existing target file is looked at before any media bytes are fetched.
+    """
+
+    def __init__(self, stem_template: str, target_dir: Path, work_dir: Path,
+                 transcode: bool):
+        # output template without the extension:
+        self.stem_template = stem_template
+        self.target_dir = target_dir
+        self.work_dir = work_dir
+        self.transcode = transcode
+        # normalized file name without extension (None until planned):
+        self.stem: Optional[str] = None
+        # file name stem yt-dlp downloads to:
+        self.download_stem: Optional[str] = None
+        # planned final file name (None if the extension isn't known):
+        self.name: Optional[str] = None
+        # stat of the target file existing before the download:
+        self.prev_stat: Optional[os.stat_result] = None
+
+    def plan(self, stem: str, acodec: Optional[str]) -> str:
+        """
+        Plan the output of a download.
+
+        Args:
+            stem: The file name stem the output template evaluated to
+            acodec: Audio codec of the format to download
+
+        Returns:
+            yt-dlp output template for the download
+        """
+        self.stem = self.download_stem = transform_filename(stem)
+        self.name = self.prev_stat = None
+        codec = (acodec or '').split('.')[0].lower()
+        ext = 'opus' if self.transcode else COPYABLE_AUDIO_CODECS.get(codec)
+        if ext is not None:
+            self.name = f"{self.stem}.{ext}"
+            try:
+                self.prev_stat = (self.target_dir / self.name).stat()
+            except FileNotFoundError:
+                pass
+            if self.prev_stat is not None and self.work_dir == self.target_dir:
+                # keep yt-dlp from taking the existing file for the download
+                # (and keep it until the new one is complete):
+                self.download_stem = f".{self.stem}.get-song-new"
+        return self.download_stem.replace('%', '%%') + '.%(ext)s'
+
+
+class YtDlpEngine(ABC):
+    """Base class of the ways to run yt-dlp."""
+    name = 'base'
+
+    @abstractmethod
+    def download(
+            self,
+            url: str,
+            target_dir: Path,
+            ytdlp_args: List[str],
+            info_json: Optional[Path] = None,
+            thumbnail_cache: Optional[ThumbnailCache] = None,
+            output_plan: Optional[OutputPlan] = None
+    ) -> Optional[YtDlpResult]:
+        """
+        Download the URL into the target directory.
+
+        Args:
+            url: The URL to download from
+            target_dir: Directory to save the file to
+            ytdlp_args: yt-dlp command-line options (without the URL)
+            info_json: If provided, download based on this info JSON written
+                by yt-dlp earlier instead of extracting the URL again
+            thumbnail_cache: If provided, embed the cached cover image of the
+                thumbnail instead of fetching it (when the info is known
+                before downloading); the arguments have to make yt-dlp keep
+                the thumbnail file (--write-thumbnail)
+            output_plan: If provided, plan the output file name with it (when
+                the info is known before downloading)
+
+        Returns:
+            The download result if successful, None otherwise
+
+        Raises:
+            TransientDownloadError: If the download failed in a way worth
+                retrying later
+        """
+
+    @abstractmethod
+    def extract_info(self, url: str,
+                     ytdlp_args: List[str]) -> Optional[dict]:
+        """
+        Extract the info of the URL without downloading anything.
+
+        Args:
+            url: The URL to extract
+            ytdlp_args: yt-dlp command-line options (selecting the format)
+
+        Returns:
+            The (sanitized) info, as in the info JSON yt-dlp writes, or None
+            if the extraction failed
+        """
+
+    @abstractmethod
+    def list_entries(self, url: str) -> Optional[List[str]]:
+        """
+        Enumerate the entries of a playlist (or album, channel...) with flat
+        extraction, i.e. without extracting the entries themselves.
+
+        Returns:
+            The entry URLs (just the URL itself if it is no playlist) or None
+            if the extraction failed
+        """
+
+
+# yt-dlp options of flat playlist extraction:
+FLAT_PLAYLIST_ARGS = ['--flat-playlist', '--js-runtimes', 'node']
+
+
+def _playlist_entry_urls(info: dict, url: str) -> List[str]:
+    """Get the (unique) entry URLs of flatly extracted playlist info."""
+    if info.get('_type') != 'playlist':
+        return [info.get('webpage_url') or url]
+    entry_urls = []
+    for entry in info.get('entries') or []:
+        entry_url = entry and (entry.get('url') or entry.get('webpage_url'))
+        if entry_url and entry_url not in entry_urls:
+            entry_urls.append(entry_url)
+    return entry_urls
+
+
+class SubprocessYtDlpEngine(YtDlpEngine):
+    """Runs a yt-dlp process per download."""
+    name = 'subprocess'
+
+    def download(
+            self,
+            url: str,
+            target_dir: Path,
+            ytdlp_args: List[str],
+            info_json: Optional[Path] = None,
+            thumbnail_cache: Optional[ThumbnailCache] = None,
+            output_plan: Optional[OutputPlan] = None
+    ) -> Optional[YtDlpResult]:
+        import json
+        import tempfile
+
+        # Create temporary file for filepath output
+        with tempfile.NamedTemporaryFile(mode='w+',
+                                         delete=False,
+                                         prefix='yt-dlp-filepath-') as tmp:
+            filepath_tmpfile = tmp.name
+        patched_info_json = None
+        output_args = []
+
+        try:
+            info = None
+            if info_json is not None and (thumbnail_cache is not None or
+                                          output_plan is not None):
+                with open(info_json, encoding='utf-8') as f:
+                    info = json.load(f)
+            if info is not None and output_plan is not None:
+                outtmpl = self._plan_output(info, output_plan)
+                if outtmpl is not None:
+                    output_args = ['-o', outtmpl]
+            if info is not None and thumbnail_cache is not None:
+                if thumbnail_cache.patch_info(info):
+                    with tempfile.NamedTemporaryFile(
+                            mode='w',
+                            delete=False,
+                            prefix='yt-dlp-info-',
+                            suffix='.info.json') as tmp:
+                        json.dump(info, tmp)
+                    patched_info_json = info_json = Path(tmp.name)
+
+            cmd = [
+                'yt-dlp', *ytdlp_args, *output_args, '--newline',
+                '--progress-template', PROGRESS_TEMPLATE, '--print-to-file',
+                'after_move:filepath', filepath_tmpfile, '--print-to-file',
+                'after_move:%(extractor_key)s %(id)s', filepath_tmpfile,
+                '--print-to-file', 'after_move:%(format_id)s %(acodec)s',
+                filepath_tmpfile, '--print-to-file', 'after_move:%(thumbnail)s',
+                filepath_tmpfile, '--print-to-file',
+                'after_move:%(thumbnails.-1.filepath)s', filepath_tmpfile
+            ]
+            if patched_info_json is not None:
+                # the cached image is referenced by a file:// URL:
+                cmd += ['--enable-file-urls']
+            if info_json is not None:
+                cmd += ['--load-info-json', str(info_json)]
+            else:
+                cmd += ['--', url]
+
+            # stderr is passed through, its tail is kept to classify errors;
+            # the progress lines on stdout are followed:
+            progress = DownloadProgress()
+            try:
+                exit_code, stderr_tail = run_command_tee_stderr(
+                    cmd, cwd=target_dir, on_stdout_line=progress.handle_line)
+            finally:
+                progress.finish()
+
+            if exit_code != 0:
+                errors = [
+                    line for line in stderr_tail if line.startswith('ERROR:')
+                ]
+                # killed by a signal or failed with a network error (exit
+                # code 2 means invalid options):
+                if exit_code < 0 or (exit_code == 1 and
+                                     is_transient_error('\n'.join(errors))):
+                    raise TransientDownloadError(
+                        errors[-1][len('ERROR: '):] if errors else
+                        f"yt-dlp exited with code {exit_code}")
+                return None
+
+            # Read the filepath, the extractor key & video ID and the format
+            # ID & audio codec from temp file
+            with open(filepath_tmpfile, 'r') as f:
+                printed_lines = f.read().splitlines()
+            filepath = printed_lines[0].strip() if printed_lines else ''
+            archive_id = None
+            if len(printed_lines) > 1:
+                extractor_key, _, video_id = printed_lines[1].strip().partition(
+                    ' ')
+                archive_id = make_archive_id(extractor_key, video_id)
+            format_id, acodec = None, None
+            if len(printed_lines) > 2:
+                format_id, _, acodec = printed_lines[2].strip().partition(' ')
+            thumbnail_url, thumbnail_path = [
+                line.strip() if line.strip() not in ('', 'NA') else None
+                for line in (printed_lines[3:5] + ['', ''])[:2]
+            ]
+
+            if not filepath:
+                tell_error("No filepath returned from yt-dlp!")
+                return None
+            return YtDlpResult(
+                filepath=target_dir / filepath,
+                archive_id=archive_id,
+                format_id=format_id or None,
+                acodec=acodec or None,
+                thumbnail_url=thumbnail_url,
+                thumbnail_path=(target_dir /
+                                thumbnail_path if thumbnail_path else None))
+        finally:
+            # Clean up temp files
+            try:
+                os.unlink(filepath_tmpfile)
+            except:
+                tell_warn(f"Deleting temp file '{filepath_tmpfile}' failed.")
+            if patched_info_json is not None:
+                patched_info_json.unlink(missing_ok=True)
+
+    @staticmethod
+    def _plan_output(info: dict, output_plan: OutputPlan) -> Optional[str]:
+        """Plan the output of a download from its cached info, if possible."""
+        stem = evaluate_output_stem(output_plan.stem_template, info)
+        if stem is None:
+            return None
+        return output_plan.plan(stem, info.get('acodec'))
+
+    def extract_info(self, url: str,
+                     ytdlp_args: List[str]) -> Optional[dict]:
+        return self._dump_json(['yt-dlp', *ytdlp_args, '-J', '--', url])
+
+    def list_entries(self, url: str) -> Optional[List[str]]:
+        info = self._dump_json(['yt-dlp', *FLAT_PLAYLIST_ARGS, '-J', '--', url])
+        return _playlist_entry_urls(info, url) if info is not None else None
+
+    @staticmethod
+    def _dump_json(cmd: List[str]) -> Optional[dict]:
+        """Run yt-dlp printing info JSON (-J), returning the parsed info."""
+        import json
+
+        result = run_command(cmd, capture_output=True, text=True)
+        if result.returncode != 0:
+            errors = [
+                line for line in result.stderr.splitlines()
+                if line.startswith('ERROR:')
+            ]
+            tell_error(errors[-1] if errors else
+                       f"yt-dlp exited with code {result.returncode}")
+            return None
+        try:
+            return json.loads(result.stdout)
+        except ValueError as e:
+            tell_error(f"Failed to parse yt-dlp output: {e}")
+            return None
+
+
+class InProcessYtDlpEngine(YtDlpEngine):
+    """
+    Drives yt_dlp.YoutubeDL in-process, saving the per-song startup cost.
+
+    Each thread reuses a YoutubeDL instance per set of options across its
+    downloads; the final file path is taken from the post-processing hooks.
+    """
+    name = 'in-process'
+
+    def __init__(self):
+        self._local = threading.local()
+
+    def _post_hook(self, filepath: str) -> None:
+        """Remember the final file path of the current download."""
+        self._local.filepaths.append(filepath)
+
+    def _progress_hook(self, status: dict) -> None:
+        """Follow the progress of the current download."""
+        progress = getattr(self._local, 'progress', None)
+        if progress is not None:
+            progress.hook(status)
+
+    def _get_ydl(self, ytdlp_args: List[str]):
+        """Get the YoutubeDL instance of the current thread for the options."""
+        # output templates differ between downloads - they are set per
+        # download, the other options (format, post-processors...) key the
+        # instances:
+        key = []
+        args = iter(ytdlp_args)
+        for arg in args:
+            if arg == '-o':
+                next(args, None)
+            else:
+                key.append(arg)
+        ydls = getattr(self._local, 'ydls', None)
+        if ydls is None:
+            ydls = self._local.ydls = {}
+        ydl = ydls.get(tuple(key))
+        if ydl is None:
+            import yt_dlp
+
+            ydl_opts = yt_dlp.parse_options(ytdlp_args).ydl_opts
+            ydl_opts['post_hooks'] = [self._post_hook]
+            ydl_opts['progress_hooks'] = [self._progress_hook]
+            ydl = ydls[tuple(key)] = yt_dlp.YoutubeDL(ydl_opts)
+        return ydl
+
+    @staticmethod
+    def _enable_file_urls(ydl, enabled: bool) -> None:
+        """Allow file:// URLs (for cached thumbnails) in the next download."""
+        if ydl.params.get('enable_file_urls', False) != enabled:
+            ydl.params['enable_file_urls'] = enabled
+            # the request handlers are set up from the params on first use:
+            director = ydl.__dict__.pop('_request_director', None)
+            if director is not None:
+                director.close()
+
+    def download(
+            self,
+            url: str,
+            target_dir: Path,
+            ytdlp_args: List[str],
+            info_json: Optional[Path] = None,
+            thumbnail_cache: Optional[ThumbnailCache] = None,
+            output_plan: Optional[OutputPlan] = None
+    ) -> Optional[YtDlpResult]:
+        import json
+        import yt_dlp
+
+        ydl = self._get_ydl(ytdlp_args)
+        # the output templates (with their timestamp) and the target
+        # directory differ between downloads - update them in the reused
+        # instance:
+        ydl_opts = yt_dlp.parse_options(ytdlp_args).ydl_opts
+        ydl.params['outtmpl'] = ydl_opts['outtmpl']
+        ydl.params['paths'] = {'home': str(target_dir)}
+        self._local.filepaths = []
+        self._local.progress = DownloadProgress()
+        clean_infojson = ydl.params.get('clean_infojson', True)
+        try:
+            info = None
+            if info_json is not None:
+                try:
+                    with open(info_json, encoding='utf-8') as f:
+                        info = ydl.sanitize_info(json.load(f), clean_infojson)
+                except (OSError, ValueError) as e:
+                    tell_error(f"Loading cached info failed: {e}")
+                    return None
+            elif thumbnail_cache is not None or output_plan is not None:
+                # extract before downloading, so that the thumbnail can be
+                # taken from the cache and the output file name planned:
+                info = ydl.sanitize_info(ydl.extract_info(url, download=False),
+                                         clean_infojson)
+            if info is not None:
+                if output_plan is not None:
+                    stem = ydl.evaluate_outtmpl(output_plan.stem_template,
+                                                info,
+                                                sanitize=True)
+                    ydl.params['outtmpl'] = {
+                        **ydl_opts['outtmpl'], 'default':
+                            output_plan.plan(stem, info.get('acodec'))
+                    }
+                self._enable_file_urls(
+                    ydl, thumbnail_cache is not None and
+                    thumbnail_cache.patch_info(info))
+                info = ydl.process_ie_result(info, download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+        except yt_dlp.utils.YoutubeDLError as e:
+            if is_transient_error(str(e)):
+                raise TransientDownloadError(str(e)) from e
+            tell_error(f"yt-dlp failed: {e}")
+            return None
+        finally:
+            self._local.progress.finish()
+            self._local.progress = None
+        if not info:
+            # yt-dlp reported the error itself already
+            return None
+        if not self._local.filepaths:
+            tell_error("No filepath returned from yt-dlp!")
+            return None
+        archive_id = make_archive_id(info.get('extractor_key'),
+                                     info.get('id'))
+        downloaded_format = (info.get('requested_downloads') or [info])[-1]
+        thumbnail_path = next((thumbnail['filepath']
+                               for thumbnail in reversed(
+                                   info.get('thumbnails') or [])
+                               if thumbnail.get('filepath')), None)
+        return YtDlpResult(
+            filepath=Path(self._local.filepaths[-1]),
+            archive_id=archive_id,
+            format_id=downloaded_format.get('format_id'),
+            acodec=downloaded_format.get('acodec'),
+            thumbnail_url=info.get('thumbnail'),
+            thumbnail_path=Path(thumbnail_path) if thumbnail_path else None)
+
+    def extract_info(self, url: str,
+                     ytdlp_args: List[str]) -> Optional[dict]:
+        import yt_dlp
+
+        ydl_opts = yt_dlp.parse_options([*ytdlp_args, '--quiet']).ydl_opts
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.extract_info(url, download=False)
+                return ydl.sanitize_info(info) if info else None
+        except yt_dlp.utils.YoutubeDLError as e:
+            tell_error(f"yt-dlp failed: {e}")
+            return None
+
+    def list_entries(self, url: str) -> Optional[List[str]]:
+        import yt_dlp
+
+        ydl_opts = yt_dlp.parse_options([*FLAT_PLAYLIST_ARGS,
+                                         '--quiet']).ydl_opts
+        try:
+            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                info = ydl.sanitize_info(ydl.extract_info(url,
+                                                          download=False))
+        except yt_dlp.utils.YoutubeDLError as e:
+            tell_error(f"yt-dlp failed: {e}")
+            return None
+        if not info:
+            return None
+        return _playlist_entry_urls(info, url)
+
+
+# yt-dlp engines by name, created on first use:
+_ytdlp_engines: dict[str, YtDlpEngine] = {}
+_ytdlp_engines_lock = threading.Lock()
+
+
+def is_ytdlp_module_available() -> bool:
+    """Check if the yt_dlp module is importable (without importing it)."""
+    import importlib.util
+
+    return importlib.util.find_spec('yt_dlp') is not None
+
+
+def get_ytdlp_engine(name: str = 'auto') -> YtDlpEngine:
+    """
+    Get the (shared) yt-dlp engine of the given name.
+
+    The 'auto' engine is the in-process one if the yt_dlp module is
+    importable, falling back to the subprocess one otherwise.
+    """
+    if name == 'auto':
+        name = 'in-process' if is_ytdlp_module_available() else 'subprocess'
+    elif name == 'in-process' and not is_ytdlp_module_available():
+        tell_warn("yt_dlp module not importable, running yt-dlp processes.")
+        name = 'subprocess'
+    with _ytdlp_engines_lock:
+        if name not in _ytdlp_engines:
+            engine_cls = (InProcessYtDlpEngine
+                          if name == 'in-process' else SubprocessYtDlpEngine)
+            _ytdlp_engines[name] = engine_cls()
+        return _ytdlp_engines[name]
+
+
+def is_same_filesystem(path_a: Path, path_b: Path) -> bool:
+    """Check if both (existing) paths are on the same filesystem."""
+    return os.stat(path_a).st_dev == os.stat(path_b).st_dev
+
+
+# name prefix of the work directories in the staging directory:
+WORK_DIR_PREFIX = 'song-'
+
+
+def _lock_work_dir(work_dir: Path) -> Optional[Any]:
+    """
+    Create and exclusively lock a staging work directory.
+
+    Returns:
+        The open lock file (closing it releases the lock) or None if another
+        download holds the lock
+    """
+    import fcntl
+
+    while True:
+        work_dir.mkdir(exist_ok=True)
+        lock_path = work_dir / '.lock'
+        try:
+            lock_file = open(lock_path, 'a')
+        except FileNotFoundError:
+            # removed by its previous owner in the meantime
+            continue
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            lock_file.close()
+            return None
+        try:
+            locked_current = (os.stat(lock_path).st_ino == os.fstat(
+                lock_file.fileno()).st_ino)
+        except FileNotFoundError:
+            locked_current = False
+        if locked_current:
+            return lock_file
+        # locked the lock file of a directory removed by its previous owner:
+        lock_file.close()
+
+
+def claim_work_dir(staging_dir: Path, url: str) -> Tuple[Path, Any]:
+    """
+    Claim a work directory for downloading the URL in the staging directory.
+
+    The directory is named after the URL, so that a retry resumes the .part
+    files of an earlier attempt. Concurrent downloads of the same URL don't
+    share it though - they get directories of their own.
+
+    Returns:
+        The work directory and its lock file, to be closed when done
+    """
+    import hashlib
+
+    name = WORK_DIR_PREFIX + hashlib.sha1(url.encode()).hexdigest()[:16]
+    work_dir = staging_dir / name
+    suffix = 1
+    while True:
+        lock_file = _lock_work_dir(work_dir)
+        if lock_file is not None:
+            return work_dir, lock_file
+        suffix += 1
+        work_dir = staging_dir / f"{name}-{suffix}"
+
+
+def remove_work_dir(work_dir: Path) -> bool:
+    """
+    Remove a work directory unless a download is using it.
+
+    Returns:
+        True if the directory was removed
+    """
+    try:
+        lock_file = _lock_work_dir(work_dir)
+    except OSError as e:
+        tell_debug(f"Cannot lock '{work_dir}': {e}")
+        return False
+    if lock_file is None:
+        return False
+    try:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    finally:
+        lock_file.close()
+    return True
+
+
+def sweep_staging_dir(staging_dir: Path, max_age: float) -> None:
+    """
+    Remove work directories left in the staging directory by downloads given
+    up or interrupted - ones unused for longer than retries may take.
+    """
+    deadline = time.time() - max_age
+    try:
+        entries = list(os.scandir(staging_dir))
+    except OSError:
+        return
+    removed = 0
+    for entry in entries:
+        try:
+            if (not entry.name.startswith(WORK_DIR_PREFIX) or
+                    not entry.is_dir(follow_symlinks=False) or
+                    entry.stat(follow_symlinks=False).st_mtime > deadline):
+                continue
+        except OSError:
+            continue
+        removed += remove_work_dir(Path(entry.path))
+    if removed:
+        tell_debug(f"Removed {removed} stale work directories from staging.")
+
+
+def get_staging_dir(args: argparse.Namespace) -> Optional[Path]:
+    """Get the staging directory configured by the arguments (if any)."""
+    if not (args.stage or args.staging_dir):
+        return None
+    staging_dir = Path(args.staging_dir or get_default_staging_dir())
+    staging_dir.mkdir(parents=True, exist_ok=True)
+    return staging_dir
+
+
+def move_into_place(src: Path, dst: Path) -> None:
+    """
+    Move a file to another filesystem, replacing the destination atomically.
+
+    The file is copied next to the destination under a temporary name first,
+    so that the destination never contains a partially written file.
+    """
+    tmp_dst = dst.with_name(f".{dst.name}.get-song-tmp")
+    try:
+        shutil.copyfile(src, tmp_dst)
+        tmp_dst.replace(dst)
+    except BaseException:
+        tmp_dst.unlink(missing_ok=True)
+        raise
+    src.unlink()
+
+
+# format selection of the no-transcode mode - native Opus if there is one:
+NATIVE_AUDIO_FORMAT = 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio/best'
+
+# audio codecs yt-dlp extracts without re-encoding (with --audio-format best)
+# and the extensions of the extracted files:
+COPYABLE_AUDIO_CODECS = {
+    'opus': 'opus',
+    'vorbis': 'ogg',
+    'mp4a': 'm4a',
+    'aac': 'm4a',
+    'mp3': 'mp3',
+    'flac': 'flac',
+    'alac': 'm4a',
+    'wav': 'wav'
+}
+
+
+def get_output_stem_template(timestamp: str) -> str:
+    """Get the yt-dlp output template of songs without the extension."""
+    return (f"{timestamp}--%(artist,album_artist,channel|unknown)#S--"
+            f"%(album|unknown)#S--%(track,title|unknown)#S")
+
+
+def get_extraction_args(transcode: bool) -> List[str]:
+    """Get the yt-dlp options selecting the song's format and extracting it."""
+    if transcode:
+        audio_args = ['--audio-format', 'opus', '-x']
+    else:
+        # the "best" audio format extracts the audio stream as it is
+        audio_args = ['-f', NATIVE_AUDIO_FORMAT, '--audio-format', 'best', '-x']
+    return ['--no-playlist', '--js-runtimes', 'node', *audio_args]
+
+
+def evaluate_output_stem(stem_template: str, info: dict) -> Optional[str]:
+    """
+    Evaluate an output template against yt-dlp info (None if the yt_dlp
+    module is not available).
+    """
+    if not is_ytdlp_module_available():
+        return None
+    import yt_dlp
+
+    with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
+        return ydl.evaluate_outtmpl(stem_template, info, sanitize=True)
+
+
+def _download_with_info_cache(
+    engine: YtDlpEngine,
+    url: str,
+    work_dir: Path,
+    ytdlp_args: List[str],
+    info_cache: Optional[InfoCache],
+    info_json: Optional[Path],
+    thumbnail_cache: Optional[ThumbnailCache] = None,
+    output_plan: Optional[OutputPlan] = None
+) -> Optional[YtDlpResult]:
+    """
+    Run the yt-dlp engine, using and filling the info cache if given.
+
+    A download based on cached info which fails (e.g. because its media URLs
+    expired early) is retried once with a fresh extraction.
+    """
+    if info_json is not None:
+        result = engine.download(url, work_dir, ytdlp_args, info_json,
+                                 thumbnail_cache, output_plan)
+        if result is not None:
+            return result
+        tell_warn("Download with cached video info failed, extracting again...")
+        events.count('info-cache-stale')
+        info_cache.invalidate(url)
+    if info_cache is None:
+        return engine.download(url,
+                               work_dir,
+                               ytdlp_args,
+                               thumbnail_cache=thumbnail_cache,
+                               output_plan=output_plan)
+    info_cache.cache_dir.mkdir(parents=True, exist_ok=True)
+    # yt-dlp appends the .info.json extension itself:
+    info_template = str(info_cache.path_for(url))[:-len('.info.json')]
+    try:
+        return engine.download(url,
+                               work_dir, [
+                                   *ytdlp_args, '--write-info-json', '-o',
+                                   'infojson:' +
+                                   info_template.replace('%', '%%')
+                               ],
+                               thumbnail_cache=thumbnail_cache,
+                               output_plan=output_plan)
+    finally:
+        info_cache.evict()
+
+
+def download_song(url: str,
+                  target_dir: Path,
+                  timestamp: Optional[str] = None,
+                  populate_album: bool = False,
+                  mtime_shift_seconds: Optional[int] = None,
+                  archive: Optional[DownloadArchive] = None,
+                  engine: Optional['YtDlpEngine'] = None,
+                  transcode: bool = True,
+                  staging_dir: Optional[Path] = None,
+                  info_cache: Optional[InfoCache] = None,
+                  thumbnail_cache: Optional[ThumbnailCache] = None
+                  ) -> Optional[Path]:
+    """
+    Download a single song from the given URL.
+
+    If the target file exists already and the new download's audio is
+    identical to it, the existing file is kept (with any tag changes merged
+    into it) - sparing media scanners and file syncing the unchanged file.
+
+    Args:
+        url: The URL to download from
+        target_dir: Directory to save the file to
+        timestamp: Optional timestamp prefix for filename
+        populate_album: If True, populate empty album metadata with title
+        mtime_shift_seconds: If provided and target file exists, shift its mtime by this many seconds
+        archive: If provided, skip songs already downloaded according to it
+            and record the new download in it
+        engine: yt-dlp engine to download with (default: auto-selected)
+        transcode: If True, convert the audio to Opus; otherwise keep the
+            source stream (preferring Opus), just remuxing it
+        staging_dir: If provided, download and post-process the song in a
+            scratch directory in it and move the result into the target
+            directory at the end (unless both are on the same filesystem)
+        info_cache: If provided, download based on the cached info of the URL
+            (skipping the extraction) and cache the info of new extractions
+        thumbnail_cache: If provided, embed cached cover images instead of
+            fetching & converting them again, and cache new ones
+
+    Returns:
+        Path to the downloaded file if successful (an UnchangedFile if the
+        existing target file was kept), None otherwise
+
+    Raises:
+        TransientDownloadError: If yt-dlp failed in a way worth retrying
+            (partial downloads are kept, so that the retry resumes them)
+    """
+    from datetime import datetime
+
+    if archive is not None:
+        with events.stage('archive-lookup') as stage:
+            try:
+                archived_path = archive.lookup(url, target_dir)
+            except Exception as e:
+                tell_warn(f"Download archive lookup failed: {e}")
+                archived_path = None
+            stage['hit'] = archived_path is not None
+        if archived_path is not None:
+            tell_info(f"Already downloaded as '{archived_path.name}', "
+                      "skipping (use --force to download again).")
+            return archived_path
+
+    if timestamp is None:
+        timestamp = datetime.now().strftime('%Y%m%d')
+    if engine is None:
+        engine = get_ytdlp_engine('auto')
+
+    # directory yt-dlp and the post-processing work in:
+    work_dir = target_dir
+    work_dir_lock = None
+    if staging_dir is not None:
+        if is_same_filesystem(staging_dir, target_dir):
+            tell_debug("Staging directory is on the target's filesystem, "
+                       "downloading in place.")
+        else:
+            work_dir, work_dir_lock = claim_work_dir(staging_dir, url)
+    keep_work_dir = False
+    # directory yt-dlp writes the thumbnail to (for the cache):
+    thumbnail_dir = None
+
+    try:
+        # Construct output template
+        stem_template = get_output_stem_template(timestamp)
+        output_template = f"{stem_template}.%(ext)#S"
+        output_plan = OutputPlan(stem_template, target_dir, work_dir,
+                                 transcode)
+
+        tell_info("Downloading the file...")
+
+        # Run yt-dlp
+        ytdlp_args = [
+            *get_extraction_args(transcode), '--embed-metadata',
+            '--embed-thumbnail', '--embed-subs', '-o', output_template
+        ]
+        if thumbnail_cache is not None:
+            try:
+                thumbnail_dir = thumbnail_cache.make_scratch_dir()
+            except OSError as e:
+                tell_warn(f"Cannot use the thumbnail cache: {e}")
+                thumbnail_cache = None
+        if thumbnail_dir is not None:
+            # keep the (converted) thumbnail for the cache - away from the
+            # audio file, so that a failed download leaves no image behind:
+            ytdlp_args += [
+                '--write-thumbnail', '--convert-thumbnails',
+                ThumbnailCache.CONVERT_THUMBNAILS, '-o',
+                f"thumbnail:{str(thumbnail_dir).replace('%', '%%')}"
+                f"{os.sep}cover.%(ext)s"
+            ]
+        info_json = info_cache.lookup(url) if info_cache is not None else None
+        if info_json is not None:
+            tell_debug("Using cached video info.")
+        with events.stage('yt-dlp') as stage:
+            stage['engine'] = engine.name
+            stage['cached_info'] = info_json is not None
+            result = _download_with_info_cache(engine, url, work_dir,
+                                               ytdlp_args, info_cache,
+                                               info_json, thumbnail_cache,
+                                               output_plan)
+            stage['planned'] = output_plan.stem is not None
+            stage['ok'] = result is not None
+        if result is None:
+            return None
+
+        if (thumbnail_cache is not None and result.thumbnail_path and
+                result.thumbnail_path.exists()):
+            try:
+                if result.thumbnail_url:
+                    thumbnail_cache.store(result.thumbnail_url,
+                                          result.thumbnail_path)
+                else:
+                    result.thumbnail_path.unlink()
+            except OSError as e:
+                tell_warn(f"Failed to cache the thumbnail: {e}")
+
+        source_codec = (result.acodec or 'unknown').split('.')[0].lower()
+        if transcode:
+            transcoded = source_codec != 'opus'
+        else:
+            transcoded = source_codec not in COPYABLE_AUDIO_CODECS
+        tell_info(f"Audio format: {result.format_id or 'unknown'} "
+                  f"({source_codec} -> {result.filepath.suffix.lstrip('.')}), "
+                  f"transcoded: {'yes' if transcoded else 'no'}")
+
+        filepath = result.filepath.name
+        archive_id = result.archive_id
+
+        if output_plan.stem is not None:
+            # yt-dlp wrote the file under its final name already (or under a
+            # temporary one next to the existing target file)
+            new_filepath = output_plan.stem + result.filepath.suffix
+        else:
+            # Transform filename
+            new_filepath = transform_filename(filepath)
+        # the target file was looked at when planning the download:
+        planned = new_filepath == output_plan.name
+        prev_stat_info = output_plan.prev_stat if planned else None
+        # whether the existing target file was kept (with identical audio):
+        unchanged = False
+
+        if work_dir != target_dir:
+            staged_path = work_dir / filepath
+            if filepath != new_filepath:
+                tell_info("Tweaking the file name...")
+                with events.stage('rename'):
+                    staged_path = staged_path.rename(work_dir / new_filepath)
+
+            # Populate empty album with title if requested
+            if populate_album:
+                tell_info("Checking album metadata...")
+                with events.stage('populate-album') as stage:
+                    stage['ok'] = populate_empty_album_with_title(staged_path)
+
+            final_path = target_dir / new_filepath
+            # get stat info of the previous target file if it exists:
+            if not planned and final_path.exists():
+                prev_stat_info = final_path.stat()
+            if prev_stat_info is not None:
+                with events.stage('fingerprint') as stage:
+                    unchanged = keep_unchanged_target(staged_path, final_path)
+                    stage['changed'] = not unchanged
+            if not unchanged:
+                tell_info(f"Moving '{final_path.name}' into place...")
+                with events.stage('move'):
+                    move_into_place(staged_path, final_path)
+                    final_path.touch()
+        else:
+            old_path = target_dir / filepath
+            new_path = target_dir / new_filepath
+            # get stat info of the previous target file if it exists:
+            if not planned and filepath != new_filepath and new_path.exists():
+                prev_stat_info = new_path.stat()
+
+            # Populate empty album with title if requested (before comparing
+            # with the previous target file)
+            if populate_album and old_path.exists():
+                tell_info("Checking album metadata...")
+                with events.stage('populate-album') as stage:
+                    stage['ok'] = populate_empty_album_with_title(old_path)
+
+            if (filepath != new_filepath and prev_stat_info is not None and
+                    old_path.exists()):
+                with events.stage('fingerprint') as stage:
+                    unchanged = keep_unchanged_target(old_path, new_path)
+                    stage['changed'] = not unchanged
+                if unchanged:
+                    filepath = new_filepath
+            if filepath != new_filepath:
+                tell_info("Tweaking the file name...")
+                with events.stage('rename'):
+                    if old_path.exists():
+                        old_path.rename(new_path)
+                        tell_info(
+                            f"Renamed '{old_path.name}' to '{new_path.name}'.")
+                        filepath = new_filepath
+                    else:
+                        tell_warn(
+                            f"File '{filepath}' not found, skipping rename...")
+
+            # Touch the file to update timestamp
+            final_path = target_dir / filepath
+            if final_path.exists() and not unchanged:
+                final_path.touch()
+
+        # Apply mtime shifting if requested (the kept target file has its
+        # mtime already)
+        if (mtime_shift_seconds is not None and prev_stat_info is not None and
+                not unchanged):
+            with events.stage('mtime-shift') as stage:
+                try:
+                    original_mtime = prev_stat_info.st_mtime
+                    shifted_mtime = original_mtime + mtime_shift_seconds
+                    os.utime(final_path, (shifted_mtime, shifted_mtime))
+                    tell_debug(
+                        f"Applied mtime shift of {mtime_shift_seconds}s to '{final_path.name}'")
+                except Exception as e:
+                    stage['ok'] = False
+                    tell_warn(f"Failed to apply mtime shift: {e}")
+
+        if archive is not None and archive_id and final_path.exists():
+            try:
+                archive.record(url, target_dir, archive_id, final_path)
+            except Exception as e:
+                tell_warn(f"Failed to record download in archive: {e}")
+
+        tell_info("Done.")
+        return UnchangedFile(final_path) if unchanged else final_path
+
+    except TransientDownloadError as e:
+        # keep the partial download for the retry (removed when giving up):
+        keep_work_dir = True
+        if work_dir != target_dir:
+            e.work_dir = work_dir
+        raise
+    except Exception as e:
+        tell_error(str(e))
+        return None
+    finally:
+        if work_dir != target_dir and not keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if thumbnail_dir is not None:
+            shutil.rmtree(thumbnail_dir, ignore_errors=True)
+        if work_dir_lock is not None:
+            work_dir_lock.close()
+
+
+def is_url(text: str) -> bool:
+    """Check if the given text looks like a downloadable URL."""
+    import re
+    return re.match(r'^(https?|ftp)://', text) is not None
+
+
+@dataclass
+class ResolvedInput:
+    """What an input resolves to: the URL to download and its timestamp."""
+    url: str
+    timestamp: Optional[str]
+    # where the URL came from - 'input' (a URL itself), 'purl' or 'comment':
+    source: str
+
+
+def resolve_input(input_item: str,
+                  args: argparse.Namespace) -> Optional[ResolvedInput]:
+    """
+    Resolve an input (URL or file path) to the URL to download and the file
+    name timestamp.
+
+    Returns:
+        The resolved input or None if no URL was found
+    """
+    if is_url(input_item):
+        tell_info(f"Processing URL '{input_item}'...")
+        return ResolvedInput(url=input_item,
+                             timestamp=args.timestamp,
+                             source='input')
+    else:
+        # Treat as file path
+        file_path = Path(input_item)
+        if not file_path.exists():
+            tell_warn(f"File does not exist: {file_path}")
+            return None
+        tell_info(f"Processing file '{file_path}'...")
+        url = None
+        timestamp = args.timestamp  # Use command-line timestamp if provided
+        with events.stage('probe') as stage:
+            tag_view = metadata_probe.probe(file_path)
+            stage['ok'] = tag_view is not None
+        if tag_view is not None:
+            url = tag_view.source_url
+            # Use timestamp from filename if possible (YYYYMMDD...)
+            # but only if no timestamp was provided via command-line
+            if not args.timestamp and tag_view.filename_timestamp:
+                timestamp = tag_view.filename_timestamp
+        if not url:
+            tell_warn(f"No URL found in metadata for file: {file_path}")
+            return None
+        return ResolvedInput(url=url,
+                             timestamp=timestamp,
+                             source='purl' if tag_view.purl else 'comment')
+
+
+def get_info_cache(args: argparse.Namespace) -> Optional[InfoCache]:
+    """Get the info cache configured by the arguments (None if disabled)."""
+    if args.no_info_cache:
+        return None
+    return InfoCache(get_cache_dir() / 'info',
+                     ttl=args.info_cache_ttl,
+                     max_bytes=int(args.info_cache_size * 1024**2))
+
+
+def process_input(input_item: str,
+                  target_dir: Path,
+                  args: argparse.Namespace,
+                  resolved: Optional[ResolvedInput] = None) -> Optional[Path]:
+    """
+    Process a single input (URL or file path) and download its song.
+
+    Args:
+        input_item: URL to download from or audio file path to get the URL from
+        target_dir: Directory to save the file to
+        args: Parsed command-line arguments
+        resolved: If provided, what the input resolved to already (e.g. when
+            executing a plan)
+
+    Returns:
+        Path to the downloaded file if successful, None otherwise
+    """
+    if resolved is None:
+        resolved = resolve_input(input_item, args)
+        if resolved is None:
+            return None
+    else:
+        tell_info(f"Processing '{input_item}' as planned...")
+    url, timestamp = resolved.url, resolved.timestamp
+    staging_dir = get_staging_dir(args)
+    archive = None
+    if not args.force:
+        archive = DownloadArchive(get_state_dir() / 'archive.sqlite3')
+    info_cache = get_info_cache(args)
+    thumbnail_cache = None
+    if not args.no_thumbnail_cache:
+        thumbnail_cache = ThumbnailCache(
+            get_cache_dir() / 'thumbnails',
+            max_bytes=int(args.thumbnail_cache_size * 1024**2))
+    downloaded_file = download_song(url, target_dir, timestamp,
+                                    args.populate_empty_album,
+                                    args.use_existing_target_file_mtime_shifted,
+                                    archive, get_ytdlp_engine(args.engine),
+                                    not args.no_transcode, staging_dir,
+                                    info_cache, thumbnail_cache)
+    if not downloaded_file:
+        tell_warn(f"Failed to download '{input_item}'!")
+    elif args.remove_input_on_success and not is_url(input_item):
+        try:
+            Path(input_item).unlink()
+            tell_debug(f"Removed input file '{input_item}'.")
+        except OSError as e:
+            tell_warn(f"Failed to remove input file '{input_item}': {e}")
+    return downloaded_file
+
+
+def process_inputs(
+        inputs: List[str],
+        target_dir: Path,
+        args: argparse.Namespace,
+        jobs: int = 1,
+        on_downloaded: Optional[Callable[[Path], None]] = None,
+        on_input_done: Optional[Callable[[str, Path], None]] = None,
+        resolved: Optional[dict[str, ResolvedInput]] = None
+) -> List[Optional[Path]]:
+    """
+    Process all inputs, running up to `jobs` of them concurrently.
+
+    Log messages of each input are prefixed with its position when there is
+    more than one input, so that interleaved output stays attributable.
+    Inputs failing transiently are retried according to the retry options
+    while the other inputs keep going.
+
+    Args:
+        on_downloaded: Called with each downloaded file as soon as it is done
+            (but not with existing files kept unchanged)
+        on_input_done: Called with each successful input and its downloaded
+            file as soon as it is done
+        resolved: What inputs resolved to already, by input
+
+    Returns:
+        Per-input results (in input order) - downloaded file path or None
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    policy = RetryPolicy.from_args(args)
+    results: List[Optional[Path]] = [None] * len(inputs)
+    remaining = threading.Semaphore(0)
+
+    def process_nth(index: int,
+                    input_item: str,
+                    attempt: int = 1,
+                    first_failure: float = 0.0) -> None:
+        if len(inputs) > 1:
+            set_log_prefix(f"[{index + 1}/{len(inputs)}] ")
+        set_current_input(input_item)
+        retrying = False
+        try:
+            with events.stage('input') as stage:
+                downloaded_file = process_input(
+                    input_item, target_dir, args,
+                    resolved.get(input_item) if resolved else None)
+                stage['ok'] = downloaded_file is not None
+            results[index] = downloaded_file
+            if downloaded_file and on_input_done:
+                on_input_done(input_item, downloaded_file)
+            if (downloaded_file and on_downloaded and
+                    not isinstance(downloaded_file, UnchangedFile)):
+                on_downloaded(downloaded_file)
+        except TransientDownloadError as e:
+            first_failure = first_failure or time.time()
+            retrying = retry_later(
+                policy, attempt, first_failure, e,
+                lambda: executor.submit(process_nth, index, input_item,
+                                        attempt + 1, first_failure))
+        except Exception as e:
+            tell_error(f"Failed to process '{input_item}': {e}")
+        finally:
+            set_log_prefix('')
+            set_current_input(None)
+            if not retrying:
+                remaining.release()
+
+    with ThreadPoolExecutor(max_workers=jobs,
+                            thread_name_prefix='get-song') as executor:
+        for i, item in enumerate(inputs):
+            executor.submit(process_nth, i, item)
+        # retries are submitted later on - wait for the final outcomes before
+        # shutting the executor down:
+        for _ in inputs:
+            remaining.acquire()
+    return results
+
+
+# version of the plan files written by --plan:
+PLAN_VERSION = 1
+
+
+def plan_input(input_item: str, target_dir: Path, args: argparse.Namespace,
+               archive: Optional[DownloadArchive],
+               info_cache: Optional[InfoCache]) -> dict:
+    """
+    Resolve an input the way processing it would, without downloading: find
+    its URL & timestamp, extract the URL's info (metadata only - cached for
+    the download) and work out the final file name.
+
+    Returns:
+        The plan entry of the input - with an 'error' if it cannot be
+        downloaded
+    """
+    import json
+    from datetime import datetime
+
+    entry: dict = {'input': input_item, 'error': None}
+    with events.stage('plan-resolve') as stage:
+        resolved = resolve_input(input_item, args)
+        stage['ok'] = resolved is not None
+    if resolved is None:
+        entry['error'] = 'no URL found'
+        return entry
+    # the timestamp of the day of planning, so that executing the plan later
+    # yields the planned file names:
+    timestamp = resolved.timestamp or datetime.now().strftime('%Y%m%d')
+    entry.update(url=resolved.url, source=resolved.source, timestamp=timestamp)
+    if archive is not None:
+        try:
+            archived_path = archive.lookup(resolved.url, target_dir)
+        except Exception as e:
+            tell_warn(f"Download archive lookup failed: {e}")
+            archived_path = None
+        entry['archived'] = str(archived_path) if archived_path else None
+
+    info = None
+    info_json = info_cache.lookup(resolved.url) if info_cache else None
+    if info_json is not None:
+        try:
+            with open(info_json, encoding='utf-8') as f:
+                info = json.load(f)
+        except (OSError, ValueError) as e:
+            tell_warn(f"Failed to read cached info: {e}")
+    if info is None:
+        with events.stage('plan-extract') as stage:
+            info = get_ytdlp_engine(args.engine).extract_info(
+                resolved.url, get_extraction_args(not args.no_transcode))
+            stage['ok'] = info is not None
+        if info is None:
+            entry['error'] = 'extraction failed'
+            return entry
+        if info_cache is not None:
+            try:
+                info_cache.store(resolved.url, info)
+            except OSError as e:
+                tell_warn(f"Failed to cache the info: {e}")
+    entry.update(title=info.get('title'),
+                 duration=info.get('duration'),
+                 acodec=info.get('acodec'))
+
+    output_plan = OutputPlan(get_output_stem_template(timestamp), target_dir,
+                             target_dir, not args.no_transcode)
+    stem = evaluate_output_stem(output_plan.stem_template, info)
+    if stem is not None:
+        output_plan.plan(stem, info.get('acodec'))
+        entry['filename'] = output_plan.name
+        entry['target_exists'] = output_plan.prev_stat is not None
+    return entry
+
+
+def plan_inputs(inputs: List[str], target_dir: Path,
+                args: argparse.Namespace) -> dict:
+    """
+    Resolve all inputs concurrently into a plan (see plan_input()), which
+    --execute-plan downloads later without resolving the inputs again.
+
+    Returns:
+        The plan - the target directory and the entries in input order
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from datetime import datetime
+
+    archive = None
+    if not args.force:
+        archive = DownloadArchive(get_state_dir() / 'archive.sqlite3')
+    info_cache = get_info_cache(args)
+
+    def plan_nth(index: int, input_item: str) -> dict:
+        if len(inputs) > 1:
+            set_log_prefix(f"[{index + 1}/{len(inputs)}] ")
+        set_current_input(input_item)
+        try:
+            return plan_input(input_item, target_dir, args, archive,
+                              info_cache)
+        except Exception as e:
+            tell_error(f"Failed to plan '{input_item}': {e}")
+            return {'input': input_item, 'error': str(e)}
+        finally:
+            set_log_prefix('')
+            set_current_input(None)
+
+    # resolving is mostly waiting for extractions - more of them than
+    # downloads may run at once:
+    with ThreadPoolExecutor(max_workers=max(4, args.jobs),
+                            thread_name_prefix='get-song-plan') as executor:
+        entries = list(executor.map(plan_nth, range(len(inputs)), inputs))
+    return {
+        'version': PLAN_VERSION,
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'target_dir': str(target_dir),
+        'transcode': not args.no_transcode,
+        'entries': entries
+    }
+
+
+def load_plan(path: str) -> dict:
+    """
+    Load a plan written by --plan ('-' for stdin).
+
+    Raises:
+        OSError: If the file cannot be read
+        ValueError: If it is no plan of a supported version
+    """
+    import json
+
+    if path == '-':
+        plan = json.load(sys.stdin)
+    else:
+        with open(path, encoding='utf-8') as f:
+            plan = json.load(f)
+    if not isinstance(plan, dict) or plan.get('version') != PLAN_VERSION:
+        raise ValueError(f"not a plan of version {PLAN_VERSION}")
+    return plan
+
+
+def execute_plan(plan: dict,
+                 target_dir: Path,
+                 args: argparse.Namespace,
+                 jobs: int = 1,
+                 on_downloaded: Optional[Callable[[Path], None]] = None) -> bool:
+    """
+    Download the entries of a plan, skipping the resolution of the inputs.
+
+    Returns:
+        True if all entries of the plan were downloaded successfully
+    """
+    # download with the settings the entries were resolved for:
+    plan_args = argparse.Namespace(**vars(args))
+    plan_args.no_transcode = not plan.get('transcode', True)
+
+    resolved = {}
+    success = True
+    for entry in plan['entries']:
+        if entry.get('error') or not entry.get('url'):
+            tell_warn(f"Skipping '{entry.get('input')}' "
+                      f"({entry.get('error') or 'no URL'}).")
+            success = False
+            continue
+        resolved[entry['input']] = ResolvedInput(url=entry['url'],
+                                                 timestamp=entry['timestamp'],
+                                                 source=entry['source'])
+    results = process_inputs(list(resolved),
+                             target_dir,
+                             plan_args,
+                             jobs=jobs,
+                             on_downloaded=on_downloaded,
+                             resolved=resolved)
+    return success and all(results)
+
+
+REFRESH_EXTENSIONS = ('.opus', '.ogg', '.m4a', '.mp3', '.webm')
+
+
+def iter_library_files(root: Path,
+                       extensions: List[str],
+                       older_than: Optional[float] = None) -> Iterator[Path]:
+    """
+    Lazily walk a music tree yielding the audio files in it.
+
+    Directories are scanned one at a time with os.scandir (in sorted order so
+    that consecutive walks visit files the same way), so memory use is bounded
+    by the largest directory rather than the whole tree. Hidden files and
+    directories are skipped.
+
+    Args:
+        root: Directory to walk
+        extensions: Lower-case file name suffixes to yield
+        older_than: Only yield files last modified before this timestamp
+    """
+    pending = [root]
+    while pending:
+        directory = pending.pop()
+        try:
+            with os.scandir(directory) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            tell_warn(f"Cannot scan '{directory}': {e}")
+            continue
+        subdirs = []
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.append(Path(entry.path))
+                    continue
+                if (not entry.is_file() or os.path.splitext(
+                        entry.name)[1].lower() not in extensions):
+                    continue
+                if (older_than is not None and
+                        entry.stat().st_mtime >= older_than):
+                    continue
+            except OSError:
+                continue
+            yield Path(entry.path)
+        # visit subdirectories depth-first, in sorted order:
+        pending.extend(reversed(subdirs))
+
+
+class RefreshCheckpoint:
+    """
+    Append-only record of the files a library refresh (or the entries a
+    playlist download) is done with, so that an interrupted run can resume
+    where it left off.
+    """
+
+    def __init__(self, path: Path, restart: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._done = set()
+        if restart:
+            path.unlink(missing_ok=True)
+        try:
+            with open(path, encoding='utf-8') as f:
+                self._done = {line.rstrip('\n') for line in f if line.strip()}
+        except FileNotFoundError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def __len__(self) -> int:
+        return len(self._done)
+
+    def is_done(self, path: Union[Path, str]) -> bool:
+        return str(path) in self._done
+
+    def mark_done(self, path: Union[Path, str]) -> None:
+        with self._lock:
+            self._done.add(str(path))
+            self._file.write(f"{path}\n")
+            self._file.flush()
+
+    def close(self, completed: bool = False) -> None:
+        """Close the checkpoint, removing it if the run is complete."""
+        self._file.close()
+        if completed:
+            self.path.unlink(missing_ok=True)
+
+
+def get_refresh_checkpoint_path(root: Path) -> Path:
+    """Get the checkpoint path of refreshing the given music tree."""
+    import hashlib
+    digest = hashlib.sha1(str(root).encode()).hexdigest()[:16]
+    return get_state_dir() / 'refresh' / f"{digest}.done"
+
+
+def refresh_library(
+        root: Path,
+        args: argparse.Namespace,
+        jobs: int = 1,
+        on_downloaded: Optional[Callable[[Path], None]] = None) -> int:
+    """
+    Re-fetch the songs of a music tree from the URLs in their metadata.
+
+    The tree is walked lazily and its files stream through two stages: a
+    probe pool extracting source URLs and filename timestamps (and applying
+    the --refresh-* filters), and `jobs` download workers. At most a few items
+    per worker are in flight at any time, so memory stays bounded regardless
+    of the size of the library. Finished files are recorded in a checkpoint;
+    once all files got refreshed, the checkpoint is removed.
+
+    Args:
+        root: Music tree to refresh (songs are downloaded next to the originals)
+        args: Parsed command-line arguments
+        jobs: Number of concurrent downloads
+        on_downloaded: Called with each downloaded file as soon as it is done
+            (but not with existing files kept unchanged)
+
+    Returns:
+        Number of files which failed to refresh
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    extensions = [('.' + ext.lower().lstrip('.'))
+                  for ext in args.refresh_ext] if args.refresh_ext else list(
+                      REFRESH_EXTENSIONS)
+    older_than = None
+    if args.refresh_older_than is not None:
+        older_than = time.time() - args.refresh_older_than * 86400
+    checkpoint = RefreshCheckpoint(get_refresh_checkpoint_path(root),
+                                   restart=args.refresh_restart)
+    if len(checkpoint):
+        tell_info(f"Resuming refresh of '{root}' "
+                  f"({len(checkpoint)} file(s) already done)...")
+    else:
+        tell_info(f"Refreshing '{root}'...")
+
+    # the originals are the inputs - always re-download, never remove them
+    # up front, but replace them once a refreshed file got a different name:
+    refresh_args = argparse.Namespace(**vars(args))
+    refresh_args.force = True
+    refresh_args.remove_input_on_success = False
+
+    policy = RetryPolicy.from_args(args)
+    probe_jobs = max(2, jobs)
+    slots = threading.BoundedSemaphore(probe_jobs + 4 * jobs)
+    counts = {'refreshed': 0, 'skipped': 0, 'failed': 0}
+    counts_lock = threading.Lock()
+
+    def count(outcome: str) -> None:
+        with counts_lock:
+            counts[outcome] += 1
+
+    def download(path: Path,
+                 attempt: int = 1,
+                 first_failure: float = 0.0) -> None:
+        set_log_prefix(f"[{path.name}] ")
+        set_current_input(str(path))
+        retrying = False
+        try:
+            with events.stage('input') as stage:
+                downloaded_file = process_input(str(path), path.parent,
+                                                refresh_args)
+                stage['ok'] = downloaded_file is not None
+            if downloaded_file is None:
+                count('failed')
+                return
+            if downloaded_file != path:
+                if path.exists():
+                    path.unlink()
+                    tell_debug(f"Removed outdated file '{path.name}'.")
+                # do not refresh the new file again when resuming:
+                checkpoint.mark_done(downloaded_file)
+            checkpoint.mark_done(path)
+            count('refreshed')
+            if on_downloaded and not isinstance(downloaded_file, UnchangedFile):
+                on_downloaded(downloaded_file)
+        except TransientDownloadError as e:
+            first_failure = first_failure or time.time()
+            retrying = retry_later(
+                policy, attempt, first_failure, e,
+                lambda: download_executor.submit(download, path, attempt + 1,
+                                                 first_failure))
+            if not retrying:
+                count('failed')
+        except Exception as e:
+            tell_error(f"Failed to refresh '{path}': {e}")
+            count('failed')
+        finally:
+            set_log_prefix('')
+            set_current_input(None)
+            if not retrying:
+                slots.release()
+
+    def probe(path: Path) -> None:
+        queued = False
+        try:
+            with events.stage('refresh-probe'):
+                tag_view = metadata_probe.probe(path)
+            if tag_view is None or not tag_view.source_url:
+                tell_debug(f"No URL found in metadata of '{path}', skipping.")
+            elif args.refresh_missing_album and tag_view.album:
+                pass
+            else:
+                download_executor.submit(download, path)
+                queued = True
+                return
+            checkpoint.mark_done(path)
+            count('skipped')
+        except Exception as e:
+            tell_error(f"Failed to probe '{path}': {e}")
+            count('failed')
+        finally:
+            if not queued:
+                slots.release()
+
+    # set once the whole tree has been walked and all its files processed:
+    completed = False
+    try:
+        with ThreadPoolExecutor(max_workers=jobs,
+                                thread_name_prefix='get-song') as \
+                download_executor:
+            with ThreadPoolExecutor(
+                    max_workers=probe_jobs,
+                    thread_name_prefix='get-song-probe') as probe_executor:
+                for path in iter_library_files(root, extensions, older_than):
+                    if checkpoint.is_done(path):
+                        continue
+                    slots.acquire()
+                    probe_executor.submit(probe, path)
+            # retries are submitted later on - wait for all items to finish
+            # before shutting the download executor down:
+            for _ in range(probe_jobs + 4 * jobs):
+                slots.acquire()
+        completed = True
+    finally:
+        # keep the checkpoint of interrupted runs & of failed files' retries:
+        checkpoint.close(completed=completed and counts['failed'] == 0)
+    tell_info(f"Refreshed {counts['refreshed']} file(s), skipped "
+              f"{counts['skipped']}, {counts['failed']} failed.")
+    return counts['failed']
+
+
+class PlaylistState:
+    """
+    The entries of a playlist being downloaded and which of them are done,
+    persisted so that an interrupted download resumes without enumerating the
+    playlist again. The state is removed once all entries are done.
+    """
+
+    def __init__(self, url: str, restart: bool = False):
+        import hashlib
+        import json
+
+        self.url = url
+        digest = hashlib.sha1(url.encode()).hexdigest()[:16]
+        self.entries_path = get_state_dir() / 'playlist' / f"{digest}.json"
+        self.checkpoint = RefreshCheckpoint(
+            get_state_dir() / 'playlist' / f"{digest}.done", restart)
+        self.entries: Optional[List[str]] = None
+        if restart:
+            self.entries_path.unlink(missing_ok=True)
+        try:
+            with open(self.entries_path, encoding='utf-8') as f:
+                self.entries = json.load(f)['entries']
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError) as e:
+            tell_warn(f"Failed to read the playlist state: {e}")
+
+    def set_entries(self, entries: List[str]) -> None:
+        """Record the enumerated entries."""
+        import json
+
+        self.entries = entries
+        tmp_path = self.entries_path.with_suffix('.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'url': self.url, 'entries': entries}, f)
+        tmp_path.replace(self.entries_path)
+
+    def pending(self) -> List[str]:
+        """Get the entries not done yet."""
+        return [
+            entry for entry in self.entries or []
+            if not self.checkpoint.is_done(entry)
+        ]
+
+    def mark_done(self, entry: str) -> None:
+        self.checkpoint.mark_done(entry)
+
+    def close(self) -> None:
+        """Close the state, removing it if all entries are done."""
+        completed = self.entries is not None and not self.pending()
+        self.checkpoint.close(completed=completed)
+        if completed:
+            self.entries_path.unlink(missing_ok=True)
+
+
+def open_playlist(url: str, args: argparse.Namespace) -> Optional[PlaylistState]:
+    """
+    Get the state of downloading the given playlist, enumerating its entries
+    unless an interrupted download of it left them behind.
+
+    Returns:
+        The playlist state or None if the enumeration failed
+    """
+    state = PlaylistState(url, restart=args.playlist_restart)
+    if state.entries is not None:
+        done = len(state.entries) - len(state.pending())
+        tell_info(f"Resuming playlist '{url}' ({done} of "
+                  f"{len(state.entries)} song(s) already done)...")
+        return state
+    tell_info(f"Enumerating playlist '{url}'...")
+    with events.stage('playlist-enumerate') as stage:
+        entries = get_ytdlp_engine(args.engine).list_entries(url)
+        stage['ok'] = entries is not None
+    if entries is None:
+        tell_warn(f"Failed to enumerate playlist '{url}'!")
+        state.close()
+        return None
+    tell_info(f"Found {len(entries)} song(s) in the playlist.")
+    state.set_entries(entries)
+    return state
+
+
+def process_playlists(
+        inputs: List[str],
+        target_dir: Path,
+        args: argparse.Namespace,
+        jobs: int = 1,
+        on_downloaded: Optional[Callable[[Path], None]] = None) -> bool:
+    """
+    Download the entries of the playlist URLs among the inputs (other inputs
+    are processed as they are). The entries of all playlists are enumerated
+    up front and then downloaded as individual inputs, recording the done
+    ones in the playlist's state.
+
+    Returns:
+        True if all inputs (and entries) were downloaded successfully
+    """
+    states: List[PlaylistState] = []
+    # playlist states by entry (an entry may be part of several playlists):
+    entry_states: dict[str, List[PlaylistState]] = {}
+    all_inputs: List[str] = []
+    success = True
+    try:
+        for input_item in inputs:
+            if not is_url(input_item):
+                all_inputs.append(input_item)
+                continue
+            state = open_playlist(input_item, args)
+            if state is None:
+                success = False
+                continue
+            states.append(state)
+            for entry in state.pending():
+                if entry not in entry_states:
+                    all_inputs.append(entry)
+                entry_states.setdefault(entry, []).append(state)
+
+        def on_input_done(input_item: str, downloaded_file: Path) -> None:
+            for state in entry_states.get(input_item, []):
+                state.mark_done(input_item)
+
+        results = process_inputs(all_inputs,
+                                 target_dir,
+                                 args,
+                                 jobs=jobs,
+                                 on_downloaded=on_downloaded,
+                                 on_input_done=on_input_done)
+    finally:
+        for state in states:
+            state.close()
+    return success and all(results)
+
+
+class BatchingStage(ABC):
+    """
+    Pipeline stage which processes submitted items in batches on a background
+    thread. A batch is handed over once it has `max_batch` items or its oldest
+    item waited for `max_latency` seconds, whichever comes first.
+    """
+
+    def __init__(self, name: str, max_batch: int = 10,
+                 max_latency: float = 2.0):
+        self.name = name
+        self.max_batch = max(1, max_batch)
+        self.max_latency = max_latency
+        self._cond = threading.Condition()
+        self._items: list = []
+        self._first_at = 0.0
+        self._busy = False
+        self._flushing = 0
+        self._closed = False
+        self._thread = threading.Thread(target=self._run,
+                                        name=name,
+                                        daemon=True)
+        self._thread.start()
+
+    @abstractmethod
+    def handle_batch(self, items: list) -> None:
+        """Process a batch of items (runs on the stage's thread)."""
+
+    def submit(self, item: Any) -> None:
+        """Queue an item for processing."""
+        with self._cond:
+            if not self._items:
+                self._first_at = time.monotonic()
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def flush(self) -> None:
+        """Hand over queued items right away and wait until they're processed."""
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not self._items and not self._busy)
+            self._flushing -= 1
+
+    def close(self) -> None:
+        """Process all queued items and stop the stage."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join()
+
+    def _batch_ready(self) -> bool:
+        return bool(self._items) and (
+            self._closed or self._flushing > 0 or
+            len(self._items) >= self.max_batch or
+            time.monotonic() - self._first_at >= self.max_latency)
+
+    def _run(self) -> None:
+        while True:
+            with self._cond:
+                while not self._batch_ready():
+                    if self._closed and not self._items:
+                        return
+                    timeout = None
+                    if self._items:
+                        timeout = max(
+                            self._first_at + self.max_latency -
+                            time.monotonic(), 0.01)
+                    self._cond.wait(timeout=timeout)
+                batch = self._items[:self.max_batch]
+                del self._items[:self.max_batch]
+                self._first_at = time.monotonic()
+                self._busy = True
+            try:
+                self.handle_batch(batch)
+            except Exception as e:
+                tell_warn(f"{self.name} failed: {e}")
+            finally:
+                with self._cond:
+                    self._busy = False
+                    self._cond.notify_all()
+
+
+class MediaScanStage(BatchingStage):
+    """
+    Runs termux-media-scan on downloaded files as they come, several files per
+    invocation, so that songs show up in the music player early.
+    """
 
-    # Convert target directory to Path and ensure it exists
-    target_dir = Path(args.directory).resolve()
+    def __init__(self, max_batch: int = 10, max_latency: float = 2.0):
+        super().__init__('media-scan', max_batch, max_latency)
+        self._available = True
+
+    def _scan(self, files: List[Path]) -> bool:
+        """Scan the given files, returning True if it succeeded."""
+        result = run_command(
+            ['termux-media-scan', '-v', *[str(path) for path in files]],
+            capture_output=True,
+            text=True)
+        return result.returncode == 0
+
+    def handle_batch(self, items: list) -> None:
+        if not self._available:
+            return
+        with events.stage('media-scan') as stage:
+            stage['files'] = len(items)
+            self._scan_batch(items)
+
+    def _scan_batch(self, items: List[Path]) -> None:
+        tell_info("Scanning files for Android media library...")
+        try:
+            if self._scan(items):
+                for file_path in items:
+                    tell_info(f"Media scan completed for '{file_path.name}'")
+                return
+            # find out which files failed by scanning them one by one:
+            for file_path in items:
+                if len(items) > 1 and self._scan([file_path]):
+                    tell_info(f"Media scan completed for '{file_path.name}'")
+                else:
+                    tell_warn(f"Media scan failed for '{file_path.name}'")
+        except FileNotFoundError:
+            tell_warn("termux-media-scan not found, skipping media scan")
+            self._available = False
+
+
+def get_syncthing_config_path() -> Optional[Path]:
+    """Find the config file of the local Syncthing (None if there is none)."""
+    candidates = []
+    if os.environ.get('STHOMEDIR'):
+        candidates.append(Path(os.environ['STHOMEDIR']))
+    state_home = os.environ.get('XDG_STATE_HOME') or Path.home() / '.local' / 'state'
+    config_home = os.environ.get('XDG_CONFIG_HOME') or Path.home() / '.config'
+    # newer Syncthing versions default to the state directory:
+    candidates += [
+        Path(state_home) / 'syncthing',
+        Path(config_home) / 'syncthing'
+    ]
+    for candidate in candidates:
+        if (candidate / 'config.xml').is_file():
+            return candidate / 'config.xml'
+    return None
+
+
+@dataclass
+class SyncthingConfig:
+    """What it takes to talk to the REST API of the local Syncthing."""
+    url: str
+    api_key: str
+    # folder IDs by (resolved) folder path:
+    folders: dict[Path, str]
+
+    @classmethod
+    def load(cls, path: Path) -> 'SyncthingConfig':
+        """
+        Read the GUI address, API key and folders from Syncthing's config.xml
+        (the GUI address & API key can be overridden by the STGUIADDRESS and
+        STGUIAPIKEY environment variables, as for Syncthing itself).
+
+        Raises:
+            OSError: If the file cannot be read
+            ValueError: If the config is invalid or lacks the API key
+        """
+        import xml.etree.ElementTree as ElementTree
+
+        try:
+            root = ElementTree.parse(path).getroot()
+        except ElementTree.ParseError as e:
+            raise ValueError(f"invalid config: {e}") from e
+        gui = root.find('gui')
+        if gui is None:
+            gui = ElementTree.Element('gui')
+        address = (os.environ.get('STGUIADDRESS') or gui.findtext('address') or
+                   '127.0.0.1:8384')
+        api_key = os.environ.get('STGUIAPIKEY') or gui.findtext('apikey')
+        if not api_key:
+            raise ValueError("no API key configured")
+        if '://' in address:
+            scheme, address = address.split('://', 1)
+            if scheme not in ('http', 'https'):
+                raise ValueError(
+                    f"unsupported GUI address: {scheme}://{address}")
+        else:
+            tls = gui.get('tls', 'false').lower() == 'true'
+            scheme = 'https' if tls else 'http'
+        host, _, port = address.rpartition(':')
+        # listening on all interfaces - connect over the loopback interface:
+        host = {'0.0.0.0': '127.0.0.1', '[::]': '[::1]', '': '127.0.0.1'}.get(
+            host, host)
+        folders = {
+            Path(folder.get('path')).expanduser().resolve(): folder.get('id')
+            for folder in root.iter('folder')
+            if folder.get('id') and folder.get('path')
+        }
+        return cls(url=f"{scheme}://{host}:{port}", api_key=api_key,
+                   folders=folders)
+
+    def is_loopback(self) -> bool:
+        """Check whether the API is reached over the loopback interface."""
+        import ipaddress
+        import urllib.parse
+
+        host = urllib.parse.urlsplit(self.url).hostname or ''
+        if host == 'localhost':
+            return True
+        try:
+            return ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            return False
+
+    def locate(self, path: Path) -> Optional[Tuple[str, str]]:
+        """Get the folder ID and path in the folder of the given file."""
+        path = path.resolve()
+        for parent in path.parents:
+            if parent in self.folders:
+                return self.folders[parent], path.relative_to(parent).as_posix()
+        return None
+
+
+class SyncthingScanStage(BatchingStage):
+    """
+    Asks the local Syncthing to rescan downloaded files as they come - just
+    their paths, several files per request - so that new songs reach other
+    devices right away instead of after Syncthing's next (full) folder scan.
+    """
+
+    def __init__(self,
+                 config_path: Optional[Path] = None,
+                 max_batch: int = 50,
+                 max_latency: float = 5.0):
+        super().__init__('syncthing-scan', max_batch, max_latency)
+        self.config_path = config_path
+        self._config: Optional[SyncthingConfig] = None
+        self._available = True
+
+    def _load_config(self) -> Optional[SyncthingConfig]:
+        config_path = self.config_path or get_syncthing_config_path()
+        if config_path is None:
+            tell_warn("Syncthing config not found, skipping Syncthing rescans")
+            return None
+        try:
+            return SyncthingConfig.load(config_path)
+        except (OSError, ValueError) as e:
+            tell_warn(f"Cannot use Syncthing config '{config_path}': {e}")
+            return None
+
+    def _scan(self, folder: str, subs: List[str]) -> None:
+        """Ask Syncthing to rescan the given paths of the given folder."""
+        import ssl
+        import urllib.parse
+        import urllib.request
+
+        query = urllib.parse.urlencode([('folder', folder)] +
+                                       [('sub', sub) for sub in subs])
+        request = urllib.request.Request(
+            f"{self._config.url}/rest/db/scan?{query}",
+            method='POST',
+            headers={'X-API-Key': self._config.api_key})
+        context = None
+        if self._config.url.startswith('https:'):
+            context = ssl.create_default_context()
+            if self._config.is_loopback():
+                # the GUI's certificate is self-signed, so there is nothing to
+                # verify it against - and over the loopback interface there is
+                # no one in between to verify it for:
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+        with urllib.request.urlopen(request, timeout=10, context=context):
+            pass
+
+    def handle_batch(self, items: list) -> None:
+        if not self._available:
+            return
+        if self._config is None:
+            self._config = self._load_config()
+            if self._config is None:
+                self._available = False
+                return
+        subs_by_folder: dict[str, List[str]] = {}
+        for file_path in items:
+            location = self._config.locate(file_path)
+            if location is None:
+                tell_debug(f"'{file_path.name}' is not in a Syncthing folder.")
+                continue
+            folder, sub = location
+            if sub not in subs_by_folder.setdefault(folder, []):
+                subs_by_folder[folder].append(sub)
+        for folder, subs in subs_by_folder.items():
+            with events.stage('syncthing-scan') as stage:
+                stage['files'] = len(subs)
+                try:
+                    self._scan(folder, subs)
+                    tell_debug(f"Syncthing rescanning {len(subs)} file(s) "
+                               f"of folder '{folder}'.")
+                except OSError as e:
+                    stage['ok'] = False
+                    tell_warn(f"Syncthing rescan of folder '{folder}' "
+                              f"failed: {e}")
+
+
+def build_post_download_stages(args: argparse.Namespace) -> List[BatchingStage]:
+    """Create the stages downloaded files are handed over to."""
+    stages: List[BatchingStage] = [
+        MediaScanStage(max_batch=args.media_scan_batch,
+                       max_latency=args.media_scan_latency)
+    ]
+    if args.syncthing_rescan:
+        stages.append(
+            SyncthingScanStage(config_path=Path(args.syncthing_config)
+                               if args.syncthing_config else None,
+                               max_latency=args.syncthing_latency))
+    return stages
+
+
+def resolve_target_dir(directory: Path) -> Optional[Path]:
+    """Resolve the target directory, returning None if it is not usable."""
+    target_dir = directory.resolve()
     if not target_dir.exists():
         print(f"ERROR: Directory does not exist: {target_dir}",
               file=sys.stderr)
+        return None
+    if not target_dir.is_dir():
+        print(f"ERROR: Not a directory: {target_dir}", file=sys.stderr)
+        return None
+    return target_dir
+
+
+def get_default_socket_path() -> Path:
+    """Get the default path of the daemon's Unix socket."""
+    import tempfile
+
+    runtime_dir = (os.environ.get('XDG_RUNTIME_DIR') or
+                   os.environ.get('TMPDIR') or tempfile.gettempdir())
+    return Path(runtime_dir) / 'get-song.sock'
+
+
+def get_socket_path(args: argparse.Namespace) -> Path:
+    """Get the daemon's socket path configured by the arguments."""
+    return Path(args.socket) if args.socket else get_default_socket_path()
+
+
+# error of requests to a daemon which is exiting (worth starting a new one):
+DAEMON_SHUTTING_DOWN = 'daemon is shutting down'
+
+
+class DownloadQueue:
+    """
+    Work queue of the get_song daemon.
+
+    Runs submitted inputs with bounded concurrency, drops inputs identical to
+    ones already queued or running and journals pending work to a state file,
+    so that it is picked up again after a daemon restart.
+    """
+
+    def __init__(self, jobs: int, journal_path: Path,
+                 stages: List[BatchingStage]):
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.journal_path = journal_path
+        # post-download stages:
+        self.stages = stages
+        self._executor = ThreadPoolExecutor(max_workers=jobs,
+                                            thread_name_prefix='get-song')
+        self._cond = threading.Condition()
+        self._pending: dict[str, dict] = {}
+        self._results: List[bool] = []
+        # states of the playlists with queued entries by playlist URL:
+        self._playlists: dict[str, PlaylistState] = {}
+        self._closed = False
+        self._last_activity = time.monotonic()
+
+    def _save_journal(self) -> None:
+        """Write pending jobs to the journal file (lock must be held)."""
+        import json
+
+        tmp_path = self.journal_path.with_suffix('.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(list(self._pending.values()), f)
+        tmp_path.replace(self.journal_path)
+
+    def restore(self) -> int:
+        """Re-queue jobs left in the journal by a previous daemon."""
+        import json
+
+        try:
+            with open(self.journal_path) as f:
+                jobs = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            tell_warn(f"Failed to read the queue journal: {e}")
+            return 0
+        restored = sum(self._enqueue(job) for job in jobs)
+        if restored:
+            tell_info(f"Restored {restored} queued input(s).")
+        return restored
+
+    def submit(self, cwd: str, argv: List[str]) -> dict:
+        """
+        Queue the inputs of a client request.
+
+        Relative input file paths and directory are resolved against the
+        client's working directory.
+
+        Returns:
+            Response for the client with numbers of queued and duplicate inputs
+        """
+        args = build_parser().parse_args(argv)
+        directory = str(Path(cwd, args.directory or '.').resolve())
+        queued = duplicates = 0
+        for input_item in args.inputs:
+            if not is_url(input_item):
+                input_item = str(Path(cwd, input_item).resolve())
+            job = {'argv': argv, 'directory': directory, 'input': input_item}
+            if self._enqueue(job):
+                queued += 1
+            else:
+                duplicates += 1
+        return {'queued': queued, 'duplicates': duplicates}
+
+    def _enqueue(self, job: dict) -> bool:
+        """Queue a job unless an identical one is pending."""
+        key = f"{job['directory']}\0{job['input']}"
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(DAEMON_SHUTTING_DOWN)
+            if key in self._pending:
+                return False
+            self._pending[key] = job
+            self._last_activity = time.monotonic()
+            try:
+                self._save_journal()
+            except OSError:
+                # not queued - the client gets the error instead:
+                del self._pending[key]
+                raise
+        self._executor.submit(self._run, key, job)
+        return True
+
+    def _retry(self, key: str, job: dict) -> None:
+        """Run a job again after its backoff."""
+        with self._cond:
+            job['attempt'] += 1
+            self._last_activity = time.monotonic()
+            self._save_journal()
+        self._executor.submit(self._run, key, job)
+
+    def _expand_playlist(self, job: dict, args: argparse.Namespace) -> bool:
+        """Queue the entries of a playlist job, returning False on failure."""
+        state = open_playlist(job['input'], args)
+        if state is None:
+            return False
+        entries = state.pending()
+        if not entries:
+            state.close()
+            return True
+        with self._cond:
+            old_state = self._playlists.pop(job['input'], None)
+            self._playlists[job['input']] = state
+        if old_state is not None:
+            old_state.close()
+        for entry in entries:
+            self._enqueue({
+                'argv': job['argv'],
+                'directory': job['directory'],
+                'input': entry,
+                'playlist': job['input']
+            })
+        return True
+
+    def _playlist_entry_done(self, url: str, entry: str) -> None:
+        """Record a downloaded playlist entry in the playlist's state."""
+        with self._cond:
+            state = self._playlists.get(url)
+            if state is None:
+                # queued by an earlier daemon:
+                state = self._playlists[url] = PlaylistState(url)
+            state.mark_done(entry)
+            if not state.pending():
+                del self._playlists[url]
+                state.close()
+
+    def _run(self, key: str, job: dict) -> None:
+        """Process a single queued job."""
+        input_item = job['input']
+        set_log_prefix(f"[{Path(input_item).name}] ")
+        set_current_input(input_item)
+        downloaded_file = None
+        expanded = False
+        try:
+            args = build_parser().parse_args(job['argv'])
+            try:
+                target_dir = resolve_target_dir(Path(job['directory']))
+                if not target_dir:
+                    pass
+                elif (args.playlist and 'playlist' not in job and
+                      is_url(input_item)):
+                    # the entries are queued as jobs of their own:
+                    expanded = self._expand_playlist(job, args)
+                else:
+                    with events.stage('input') as stage:
+                        downloaded_file = process_input(
+                            input_item, target_dir, args)
+                        stage['ok'] = downloaded_file is not None
+            except TransientDownloadError as e:
+                # the job stays pending (and journaled) during the backoff:
+                job['attempt'] = job.get('attempt', 1)
+                job['first_failure'] = job.get('first_failure') or time.time()
+                if retry_later(RetryPolicy.from_args(args), job['attempt'],
+                               job['first_failure'], e,
+                               lambda: self._retry(key, job)):
+                    return
+            if downloaded_file:
+                if 'playlist' in job:
+                    self._playlist_entry_done(job['playlist'], input_item)
+                if not isinstance(downloaded_file, UnchangedFile):
+                    for stage in self.stages:
+                        stage.submit(downloaded_file)
+        except Exception as e:
+            tell_error(f"Failed to process '{input_item}': {e}")
+        finally:
+            set_log_prefix('')
+            set_current_input(None)
+        with self._cond:
+            del self._pending[key]
+            self._results.append(downloaded_file is not None or expanded)
+            self._last_activity = time.monotonic()
+            self._save_journal()
+            if self._pending:
+                return
+            results, self._results = self._results, []
+            self._cond.notify_all()
+        # the queue got drained - report the outcome of the batch:
+        for stage in self.stages:
+            stage.flush()
+        events.print_summary(reset=True)
+        if all(results):
+            tell_success("Song(s) downloaded successfully.")
+        else:
+            tell_failure("Failed to download some songs!")
         logger = get_logger()
         if logger:
             logger.finalize()
+
+    def wait_until_idle(self, idle_timeout: float) -> None:
+        """Block until the queue has been empty for `idle_timeout` seconds."""
+        with self._cond:
+            while True:
+                idle_for = time.monotonic() - self._last_activity
+                if not self._pending and idle_for >= idle_timeout:
+                    # refuse new jobs - clients will spawn a new daemon:
+                    self._closed = True
+                    break
+                self._cond.wait(timeout=max(idle_timeout - idle_for, 1.0))
+        self._executor.shutdown(wait=True)
+        # keep the states of playlists with failed entries for the next time:
+        for state in self._playlists.values():
+            state.close()
+
+
+def _send_to_daemon(socket_path: Path, request: dict) -> Optional[dict]:
+    """Send a request to the daemon, returning None if it is not reachable."""
+    import json
+    import socket
+
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(10)
+            sock.connect(str(socket_path))
+            sock.sendall((json.dumps(request) + '\n').encode())
+            with sock.makefile('rb') as f:
+                response = f.readline()
+    except OSError:
+        return None
+    if not response:
+        return None
+    return json.loads(response)
+
+
+def serve(args: argparse.Namespace) -> int:
+    """Run the get_song daemon listening for client requests."""
+    import json
+    import socketserver
+
+    socket_path = get_socket_path(args)
+    if socket_path.exists():
+        if _send_to_daemon(socket_path, {'ping': True}) is not None:
+            tell_error(f"Daemon already listening on '{socket_path}'.")
+            return 1
+        # a stale socket of a daemon which did not exit cleanly:
+        socket_path.unlink()
+
+    stages = build_post_download_stages(args)
+    queue = DownloadQueue(jobs=args.jobs,
+                          journal_path=get_state_dir() / 'queue.json',
+                          stages=stages)
+
+    class RequestHandler(socketserver.StreamRequestHandler):
+
+        def handle(self) -> None:
+            try:
+                request = json.loads(self.rfile.readline())
+                if request.get('ping'):
+                    response = {'pong': True}
+                else:
+                    response = queue.submit(request['cwd'], request['argv'])
+            except (Exception, SystemExit) as e:
+                response = {'error': str(e) or type(e).__name__}
+            self.wfile.write((json.dumps(response) + '\n').encode())
+
+    server = socketserver.ThreadingUnixStreamServer(str(socket_path),
+                                                    RequestHandler)
+    server.daemon_threads = True
+    # identifies the socket file as this daemon's - a new daemon may have
+    # replaced it by the time this one exits:
+    socket_ino = os.stat(socket_path).st_ino
+    server_thread = threading.Thread(target=server.serve_forever,
+                                     name='get-song-server',
+                                     daemon=True)
+    server_thread.start()
+    tell_debug(f"Listening on '{socket_path}'...")
+    try:
+        queue.restore()
+        queue.wait_until_idle(args.idle_timeout)
+    finally:
+        server.shutdown()
+        server.server_close()
+        try:
+            if os.stat(socket_path).st_ino == socket_ino:
+                socket_path.unlink()
+        except FileNotFoundError:
+            pass
+        for stage in stages:
+            stage.close()
+    tell_debug("Daemon idle, exiting.")
+    events.close()
+    return 0
+
+
+def _spawn_daemon(args: argparse.Namespace) -> None:
+    """Start a detached daemon with the given arguments."""
+    log_path = get_state_dir() / 'daemon.log'
+    with open(log_path, 'ab') as log_file:
+        subprocess.Popen([
+            sys.executable,
+            os.path.abspath(__file__), '--serve', '--socket',
+            str(get_socket_path(args)),
+            '--jobs',
+            str(args.jobs), '--idle-timeout',
+            str(args.idle_timeout), '--notification-lines',
+            str(args.notification_lines), '--notification-interval',
+            str(args.notification_interval), '--media-scan-batch',
+            str(args.media_scan_batch), '--media-scan-latency',
+            str(args.media_scan_latency), '--syncthing-latency',
+            str(args.syncthing_latency)
+        ] + (['--syncthing-rescan'] if args.syncthing_rescan else []) + ([
+            '--syncthing-config',
+            os.path.abspath(args.syncthing_config)
+        ] if args.syncthing_config else []) + ([
+            '--metrics-file',
+            args.metrics_file if args.metrics_file == '-' else os.path.
+            abspath(args.metrics_file)
+        ] if args.metrics_file else []),
+                         stdin=subprocess.DEVNULL,
+                         stdout=log_file,
+                         stderr=log_file,
+                         start_new_session=True)
+
+
+def run_client(args: argparse.Namespace, argv: List[str]) -> int:
+    """
+    Hand the inputs over to the daemon, starting it if it is not running.
+
+    Returns:
+        0 if the inputs got queued, 1 otherwise
+    """
+    socket_path = get_socket_path(args)
+    request = {'cwd': os.getcwd(), 'argv': argv}
+    response = _send_to_daemon(socket_path, request)
+    deadline = time.monotonic() + 10
+    spawned_at = None
+    while ((response is None or
+            response.get('error') == DAEMON_SHUTTING_DOWN) and
+           time.monotonic() < deadline):
+        # no daemon (or one which is just exiting) - start a new one:
+        if spawned_at is None or time.monotonic() - spawned_at > 1:
+            _spawn_daemon(args)
+            spawned_at = time.monotonic()
+        time.sleep(0.05)
+        response = _send_to_daemon(socket_path, request)
+    if response is None:
+        print(f"ERROR: Daemon not reachable on '{socket_path}'",
+              file=sys.stderr)
+        return 1
+    if 'error' in response:
+        print(f"ERROR: Daemon refused the request: {response['error']}",
+              file=sys.stderr)
         return 1
+    print(f"INFO: Queued {response['queued']} input(s), "
+          f"skipped {response['duplicates']} duplicate(s).",
+          file=sys.stderr)
+    return 0
 
-    if not target_dir.is_dir():
-        print(f"ERROR: Not a directory: {target_dir}", file=sys.stderr)
+
+def build_parser() -> argparse.ArgumentParser:
+    """Build the command-line argument parser."""
+    parser = argparse.ArgumentParser(
+        description='Downloads music files for given URLs using yt-dlp.',
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument(
+        '-d',
+        '--directory',
+        metavar='DIR',
+        help='Directory to save downloaded files (default: current directory)')
+    parser.add_argument(
+        '-t',
+        '--timestamp',
+        metavar='DATETIME',
+        help="Timestamp prefix for filenames (default: today's date, as "
+        "YYYYMMDD)")
+    parser.add_argument(
+        '-j',
+        '--jobs',
+        metavar='N',
+        type=int,
+        default=1,
+        help='Number of inputs to download concurrently (default: 1)')
+    parser.add_argument(
+        '--notification-lines',
+        metavar='N',
+        type=int,
+        default=5,
+        help='Number of recent log lines to show in notification (default: 5)')
+    parser.add_argument(
+        '--notification-interval',
+        metavar='SECONDS',
+        type=float,
+        default=1.0,
+        help='Minimum seconds between notification updates (default: 1.0)')
+    parser.add_argument(
+        '--populate-empty-album',
+        action='store_true',
+        help='Populate empty album metadata field with the title field')
+    parser.add_argument(
+        '--use-existing-target-file-mtime-shifted',
+        metavar='SECONDS',
+        type=int,
+        help='If target file exists, shift its mtime by SECONDS and apply to the downloaded file')
+    parser.add_argument(
+        '--metrics-file',
+        metavar='FILE',
+        help="Write structured events (stage timings, subprocess runs, log "
+        "messages) as JSON lines to FILE ('-' for stderr)")
+    parser.add_argument(
+        '--media-scan-batch',
+        metavar='N',
+        type=int,
+        default=10,
+        help='Maximum number of files per termux-media-scan run (default: 10)')
+    parser.add_argument(
+        '--media-scan-latency',
+        metavar='SECONDS',
+        type=float,
+        default=2.0,
+        help='Maximum seconds a downloaded file waits for its media scan '
+        '(default: 2.0)')
+    parser.add_argument(
+        '--syncthing-rescan',
+        action='store_true',
+        help="Ask the local Syncthing (via its REST API) to rescan downloaded "
+        "files right away instead of waiting for its own folder scans")
+    parser.add_argument(
+        '--syncthing-config',
+        metavar='FILE',
+        help="Syncthing's config.xml to read the API address, key and folders "
+        "from (default: Syncthing's own default location)")
+    parser.add_argument(
+        '--syncthing-latency',
+        metavar='SECONDS',
+        type=float,
+        default=5.0,
+        help='Maximum seconds a downloaded file waits for its Syncthing '
+        'rescan, batching the rescans of files coming in meanwhile '
+        '(default: 5.0)')
+    parser.add_argument(
+        '--no-transcode',
+        action='store_true',
+        help='Keep the source audio stream (native Opus if available, else '
+        'e.g. M4A) instead of re-encoding it to Opus')
+    parser.add_argument(
+        '--refresh-dir',
+        metavar='DIR',
+        help='Re-fetch every song below DIR from the URL in its metadata '
+        '(resumes an interrupted refresh of the same DIR)')
+    parser.add_argument(
+        '--refresh-older-than',
+        metavar='DAYS',
+        type=float,
+        help='With --refresh-dir, only refresh files last modified more than '
+        'DAYS ago')
+    parser.add_argument(
+        '--refresh-ext',
+        metavar='EXT',
+        action='append',
+        help='With --refresh-dir, only refresh files with this extension '
+        f'(repeatable, default: {" ".join(REFRESH_EXTENSIONS)})')
+    parser.add_argument(
+        '--refresh-missing-album',
+        action='store_true',
+        help='With --refresh-dir, only refresh files without an album tag')
+    parser.add_argument(
+        '--refresh-restart',
+        action='store_true',
+        help='With --refresh-dir, discard the checkpoint of an earlier '
+        'refresh and start over')
+    parser.add_argument(
+        '--playlist',
+        action='store_true',
+        help='Download all entries of playlist (album, channel...) URLs: the '
+        'entries are enumerated once and downloaded one by one, resuming an '
+        'interrupted download of the playlist')
+    parser.add_argument(
+        '--playlist-restart',
+        action='store_true',
+        help='With --playlist, discard the state of an earlier download of '
+        'the playlists and enumerate them again')
+    plan_group = parser.add_mutually_exclusive_group()
+    plan_group.add_argument(
+        '--plan',
+        metavar='FILE',
+        help="Don't download anything, but resolve all inputs (concurrently, "
+        "extracting metadata only) and write what would be done as a JSON "
+        "plan to FILE ('-' for stdout)")
+    plan_group.add_argument(
+        '--execute-plan',
+        metavar='FILE',
+        help="Download the inputs of a plan written by --plan, skipping their "
+        "resolution, with its target directory and transcoding ('-' for "
+        "stdin)")
+    parser.add_argument(
+        '--stage',
+        action='store_true',
+        help='Download and post-process songs on fast local storage, moving '
+        'only the finished files into DIR')
+    parser.add_argument(
+        '--staging-dir',
+        metavar='DIR',
+        help='Directory for staged downloads; implies --stage '
+        '(default: $TMPDIR/get-song or the XDG cache directory)')
+    parser.add_argument(
+        '--engine',
+        choices=['auto', 'in-process', 'subprocess'],
+        default='auto',
+        help='How to run yt-dlp: in-process via the yt_dlp module or as a '
+        'process per song; auto prefers in-process (default: auto)')
+    parser.add_argument(
+        '--retries',
+        metavar='N',
+        type=int,
+        default=4,
+        help='Times to retry a download failing with a network error, with '
+        'exponential backoff, resuming partial downloads (default: 4)')
+    parser.add_argument(
+        '--retry-delay',
+        metavar='SECONDS',
+        type=float,
+        default=5.0,
+        help='Backoff before the first retry, doubling with each further one '
+        '(default: 5)')
+    parser.add_argument(
+        '--retry-total',
+        metavar='SECONDS',
+        type=float,
+        default=900.0,
+        help='Give up retrying a download after this many seconds '
+        '(default: 900)')
+    parser.add_argument(
+        '--info-cache-ttl',
+        metavar='SECONDS',
+        type=float,
+        default=3 * 3600,
+        help='Seconds extracted video info is reused for retries and re-runs '
+        '(default: 10800, media URLs in it expire after a few hours)')
+    parser.add_argument(
+        '--info-cache-size',
+        metavar='MB',
+        type=float,
+        default=50,
+        help='Size limit of the extracted video info cache (default: 50)')
+    parser.add_argument('--no-info-cache',
+                        action='store_true',
+                        help='Neither use nor fill the extracted video info '
+                        'cache')
+    parser.add_argument(
+        '--thumbnail-cache-size',
+        metavar='MB',
+        type=float,
+        default=100,
+        help='Size limit of the cover image cache (default: 100)')
+    parser.add_argument('--no-thumbnail-cache',
+                        action='store_true',
+                        help='Neither use nor fill the cover image cache')
+    parser.add_argument(
+        '-f',
+        '--force',
+        action='store_true',
+        help='Download songs even if the download archive has them already')
+    parser.add_argument(
+        '--remove-input-on-success',
+        action='store_true',
+        help='Remove input audio files once their song got downloaded')
+    mode_group = parser.add_mutually_exclusive_group()
+    mode_group.add_argument(
+        '--serve',
+        action='store_true',
+        help='Run as a daemon processing inputs sent by --client invocations')
+    mode_group.add_argument(
+        '--client',
+        action='store_true',
+        help='Queue inputs in the daemon (started if not running) and exit')
+    parser.add_argument(
+        '--socket',
+        metavar='PATH',
+        help='Unix socket of the daemon (default: get-song.sock in '
+        '$XDG_RUNTIME_DIR, $TMPDIR or the temporary directory)')
+    parser.add_argument(
+        '--idle-timeout',
+        metavar='SECONDS',
+        type=float,
+        default=300,
+        help='Seconds after which an idle daemon exits (default: 300)')
+    parser.add_argument(
+        'inputs',
+        metavar='URL-OR-FILE',
+        nargs='*',
+        help=
+        'URLs to download from or audio file paths to get download URLs from')
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Main entry point."""
+    import json
+
+    if argv is None:
+        argv = sys.argv[1:]
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1')
+    if args.refresh_dir:
+        if args.inputs:
+            parser.error('--refresh-dir cannot be combined with URL-OR-FILE')
+        if args.serve or args.client:
+            parser.error('--refresh-dir cannot be combined with --serve or '
+                         '--client')
+    elif not args.serve and not args.inputs and not args.execute_plan:
+        parser.error('at least one URL-OR-FILE is required')
+    if args.playlist_restart and not args.playlist:
+        parser.error('--playlist-restart requires --playlist')
+    if args.plan or args.execute_plan:
+        if args.refresh_dir or args.playlist or args.serve or args.client:
+            parser.error('--plan and --execute-plan cannot be combined with '
+                         '--refresh-dir, --playlist, --serve or --client')
+        if args.execute_plan and args.inputs:
+            parser.error('--execute-plan cannot be combined with URL-OR-FILE')
+
+    if args.client:
+        return run_client(args, [arg for arg in argv if arg != '--client'])
+
+    if args.metrics_file:
+        events.open(args.metrics_file)
+
+    # Initialize the notification logger
+    init_logger(prog_name='get-song',
+                max_recent=args.notification_lines,
+                render_interval=args.notification_interval)
+
+    # Check dependencies
+    if not check_dependencies():
         logger = get_logger()
         if logger:
             logger.finalize()
         return 1
 
-    # Process each input (URL or file path)
-    import re
+    staging_dir = get_staging_dir(args)
+    if staging_dir is not None:
+        # work directories of downloads given up (or interrupted) earlier:
+        sweep_staging_dir(staging_dir, args.retry_total)
 
-    def is_url(s):
-        return re.match(r'^(https?|ftp)://', s)
+    if args.serve:
+        return serve(args)
 
-    all_success = True
-    downloaded_files = []
-    for input_item in args.inputs:
-        if is_url(input_item):
-            tell_info(f"Processing URL '{input_item}'...")
-            url = input_item
-            timestamp = args.timestamp
-        else:
-            # Treat as file path
-            file_path = Path(input_item)
-            if not file_path.exists():
-                tell_warn(f"File does not exist: {file_path}")
-                all_success = False
-                continue
-            tell_info(f"Processing file '{file_path}'...")
-            url = None
-            timestamp = args.timestamp  # Use command-line timestamp if provided
-            # Try mutagen first
-            try:
-                from mutagen import File as MutagenFile  # type: ignore[attr-defined]
-                audio = MutagenFile(file_path)
-                tags = getattr(audio, 'tags', {}) or {}
-                # Try 'purl' or 'comment' tags for URL
-                url = tags.get('purl', [None])[0] if 'purl' in tags else None
-                comment = None
-                if not url:
-                    comment = tags.get(
-                        'comment', [None])[0] if 'comment' in tags else None
-                    if comment and is_url(comment):
-                        url = comment
-                # Try to extract URL from comment if it contains one
-                if not url and comment:
-                    match = re.search(r'(https?://\S+)', comment)
-                    if match:
-                        url = match.group(1)
-                # Use timestamp from filename if possible (YYYYMMDD...)
-                # but only if no timestamp was provided via command-line
-                if not args.timestamp:
-                    match = re.match(r'^(\d{8})', file_path.name)
-                    if match:
-                        timestamp = match.group(1)
-            except ImportError:
-                tell_debug("mutagen not available, trying ffprobe...")
-                # Try ffprobe
-                if is_available('ffprobe'):
-                    probe_cmd = [
-                        'ffprobe', '-v', 'quiet', '-print_format', 'json',
-                        '-show_format',
-                        str(file_path)
-                    ]
-                    try:
-                        probe_result = subprocess.run(probe_cmd,
-                                                      capture_output=True,
-                                                      text=True,
-                                                      check=True)
-                        metadata = json.loads(probe_result.stdout)
-                        tags = metadata.get('format', {}).get('tags', {})
-                        url = tags.get('purl') or None
-                        comment = tags.get('comment') or None
-                        if not url and comment and is_url(comment):
-                            url = comment
-                        if not url and comment:
-                            match = re.search(r'(https?://\S+)', comment)
-                            if match:
-                                url = match.group(1)
-                        # Use timestamp from filename if no command-line timestamp
-                        if not args.timestamp:
-                            match = re.match(r'^(\d{8})', file_path.name)
-                            if match:
-                                timestamp = match.group(1)
-                    except Exception as e:
-                        tell_warn(f"ffprobe failed to extract metadata: {e}")
-                else:
-                    tell_warn(
-                        "Neither mutagen nor ffprobe available to extract metadata."
-                    )
-            if not url:
-                tell_warn(f"No URL found in metadata for file: {file_path}")
-                all_success = False
-                continue
-        downloaded_file = download_song(url, target_dir, timestamp,
-                                        args.populate_empty_album,
-                                        args.use_existing_target_file_mtime_shifted)
-        if downloaded_file:
-            downloaded_files.append(downloaded_file)
+    plan = None
+    if args.execute_plan:
+        try:
+            plan = load_plan(args.execute_plan)
+        except (OSError, ValueError) as e:
+            tell_error(f"Cannot load plan '{args.execute_plan}': {e}")
+            logger = get_logger()
+            if logger:
+                logger.finalize()
+            return 1
+        # the plan's entries were resolved (and their files named) for its
+        # settings - do not mix in others silently:
+        if args.no_transcode and plan.get('transcode', True):
+            tell_error(f"Plan '{args.execute_plan}' was made for transcoding "
+                       "downloads - make it again with --no-transcode.")
+            logger = get_logger()
+            if logger:
+                logger.finalize()
+            return 1
+        if (args.directory and plan.get('target_dir') and
+                Path(args.directory).resolve() != Path(
+                    plan['target_dir']).resolve()):
+            tell_warn(f"Downloading to '{args.directory}' instead of the "
+                      f"plan's '{plan['target_dir']}'.")
+
+    # Convert target directory to Path and ensure it exists
+    target_dir = resolve_target_dir(
+        Path(args.refresh_dir or args.directory or
+             (plan['target_dir'] if plan else None) or os.getcwd()))
+    if target_dir is None:
+        logger = get_logger()
+        if logger:
+            logger.finalize()
+        return 1
+
+    if args.plan:
+        plan = plan_inputs(args.inputs, target_dir, args)
+        plan_json = json.dumps(plan, indent=2)
+        if args.plan == '-':
+            print(plan_json)
         else:
-            all_success = False
-            tell_warn(f"Failed to download '{input_item}'!")
+            Path(args.plan).write_text(plan_json + '\n', encoding='utf-8')
+            tell_info(f"Wrote plan of {len(plan['entries'])} input(s) to "
+                      f"'{args.plan}'.")
+        events.print_summary()
+        logger = get_logger()
+        if logger:
+            logger.finalize()
+        events.close()
+        return 0 if all(not entry['error'] for entry in plan['entries']) else 1
 
-    # Run termux-media-scan on downloaded files
-    if downloaded_files:
-        tell_info("Scanning files for Android media library...")
-        for file_path in downloaded_files:
-            try:
-                result = subprocess.run(
-                    ['termux-media-scan', '-v',
-                     str(file_path)],
-                    capture_output=True,
-                    text=True)
-                if result.returncode == 0:
-                    tell_info(f"Media scan completed for '{file_path.name}'")
-                else:
-                    tell_warn(f"Media scan failed for '{file_path.name}'")
-            except FileNotFoundError:
-                tell_warn("termux-media-scan not found, skipping media scan")
-                break
-            except Exception as e:
-                tell_warn(f"Media scan error for '{file_path.name}': {e}")
+    # Process each input (URL or file path), running termux-media-scan on
+    # downloaded files (and having Syncthing rescan them) as they come
+    stages = build_post_download_stages(args)
+
+    def on_downloaded(file_path: Path) -> None:
+        for stage in stages:
+            stage.submit(file_path)
+
+    try:
+        if args.refresh_dir:
+            all_success = refresh_library(
+                target_dir,
+                args,
+                jobs=args.jobs,
+                on_downloaded=on_downloaded) == 0
+        elif plan is not None:
+            all_success = execute_plan(plan,
+                                       target_dir,
+                                       args,
+                                       jobs=args.jobs,
+                                       on_downloaded=on_downloaded)
+        elif args.playlist:
+            all_success = process_playlists(args.inputs,
+                                            target_dir,
+                                            args,
+                                            jobs=args.jobs,
+                                            on_downloaded=on_downloaded)
+        else:
+            all_success = all(
+                process_inputs(args.inputs,
+                               target_dir,
+                               args,
+                               jobs=args.jobs,
+                               on_downloaded=on_downloaded))
+    finally:
+        for stage in stages:
+            stage.close()
+    events.print_summary()
 
     if all_success:
         tell_success("Song(s) downloaded successfully.")
@@ -688,6 +5134,7 @@ def main() -> int:
     logger = get_logger()
     if logger:
         logger.finalize()
+    events.close()
 
     return result_code
 
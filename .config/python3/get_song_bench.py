@@ -0,0 +1,1010 @@
+"""
+Benchmark get_song end-to-end against fake external tools.
+
+Puts fake yt-dlp, ffprobe, ffmpeg, termux-notification, termux-toast and
+termux-media-scan executables (with tunable latency and output file size) on
+PATH and drives get_song.download_song() and get_song.main() over batches of
+URLs and input files. Reports wall time, subprocess counts, time spent in the
+notification logger and peak RSS as JSON, so that results of different
+revisions can be compared (see --compare).
+
+The errors scenario checks which yt-dlp errors get_song retries (taking them
+for transient network problems) and which it gives up on right away.
+
+The tags scenario compares the per-file latency of get_song's tag reading
+backends (built-in header reader, mutagen, ffprobe) on input files.
+
+The startup scenario runs `python3 -m get_song` in fresh interpreters instead,
+tracking the import time of get_song and of parsing its arguments (from
+-X importtime, with the modules parsing imported) and the time until its first
+subprocess starts - what every share intent pays before any work.
+
+With --serve-flaky, serves a file over HTTP instead, dropping the first
+connections part-way through - a stand-in for a flaky mobile network to try
+get_song's retries (and their resuming of partial downloads) against.
+
+With --serve-syncthing, stands in for the REST API of a local Syncthing (with
+a config.xml pointing at it) and prints the rescans get_song asks for.
+"""
+
+import argparse
+import json
+import os
+import resource
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+# fake tools put on PATH - each one logs its invocation and sleeps:
+FAKE_TOOLS = [
+    'yt-dlp', 'ffprobe', 'ffmpeg', 'termux-notification', 'termux-toast',
+    'termux-media-scan'
+]
+
+FAKE_TOOL_SCRIPT = r'''#!{python}
+"""Fake {name} for get_song benchmarks."""
+import json
+import os
+import sys
+import time
+
+spawned = time.time()
+sys.path.insert(0, {bench_dir!r})
+import get_song_bench
+
+name = os.path.basename(sys.argv[0])
+started = time.time()
+env_name = name.upper().replace('-', '_')
+latency = float(os.environ.get(f'GET_SONG_BENCH_LATENCY_{{env_name}}',
+                               os.environ.get('GET_SONG_BENCH_LATENCY', '0')))
+time.sleep(latency)
+exit_code = get_song_bench.fake_tool_main(name, sys.argv[1:])
+with open(os.environ['GET_SONG_BENCH_LOG'], 'a') as log:
+    log.write(f"{{name}} {{started}} {{time.time()}} {{spawned}}\n")
+sys.exit(exit_code)
+'''
+
+
+def _make_ogg_crc_table() -> List[int]:
+    table = []
+    for byte in range(256):
+        crc = byte << 24
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x04c11db7) if crc & 0x80000000 else crc << 1
+        table.append(crc & 0xffffffff)
+    return table
+
+
+_OGG_CRC_TABLE = _make_ogg_crc_table()
+
+
+def _ogg_crc(data: bytes) -> int:
+    """Compute the Ogg page checksum."""
+    crc = 0
+    for byte in data:
+        crc = ((crc << 8) & 0xffffffff) ^ _OGG_CRC_TABLE[(crc >> 24) ^ byte]
+    return crc
+
+
+def _ogg_page(packet: bytes, seq: int, granule: int, flags: int = 0) -> bytes:
+    """Build an Ogg page holding a single (< 64 KiB) packet."""
+    lacing = bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+    header = struct.pack('<4sBBqIIIB', b'OggS', 0, flags, granule, 0x6e6f73,
+                         seq, 0, len(lacing)) + lacing
+    page = header + packet
+    return page[:22] + struct.pack('<I', _ogg_crc(page)) + page[26:]
+
+
+def write_fake_opus(path: Path, size: int, tags: List[str]) -> None:
+    """Write an Ogg Opus file of about `size` bytes with the given tags."""
+    head = b'OpusHead' + bytes([1, 2]) + struct.pack('<HIhB', 312, 48000, 0, 0)
+    comments = b''.join(
+        struct.pack('<I', len(tag.encode())) + tag.encode() for tag in tags)
+    opus_tags = (b'OpusTags' + struct.pack('<I', 5) + b'bench' +
+                 struct.pack('<I', len(tags)) + comments)
+    pages = [_ogg_page(head, 0, 0, flags=2), _ogg_page(opus_tags, 1, 0)]
+    # audio pages with (random) 4000 byte packets:
+    seq, granule, written = 2, 0, sum(map(len, pages))
+    while written < size:
+        granule += 48000
+        packet = os.urandom(min(4000, max(size - written, 1)))
+        pages.append(_ogg_page(packet, seq, granule))
+        written += len(pages[-1])
+        seq += 1
+    with open(path, 'wb') as f:
+        f.write(b''.join(pages))
+
+
+# yt-dlp errors the fake yt-dlp fails with for these video IDs, and whether
+# get_song should retry them:
+FAKE_YTDLP_ERRORS = {
+    'error-forbidden':
+        ('ERROR: [download] Got error: HTTP Error 403: Forbidden', False),
+    'error-certificate':
+        ('ERROR: [generic] Unable to download webpage: [SSL: '
+         'CERTIFICATE_VERIFY_FAILED] certificate verify failed: unable to get '
+         'local issuer certificate (_ssl.c:1006)', False),
+    'error-unavailable': ('ERROR: [youtube] error-unavailable: Video '
+                          'unavailable', False),
+    'error-ssl-eof':
+        ('ERROR: unable to download video data: <urlopen error [SSL: '
+         'UNEXPECTED_EOF_WHILE_READING] EOF occurred in violation of protocol '
+         '(_ssl.c:1006)>', True),
+    'error-reset': ('ERROR: [download] Got error: <urlopen error [Errno 104] '
+                    'Connection reset by peer>', True),
+    'error-503': ('ERROR: unable to download video data: HTTP '
+                              'Error 503: Service Unavailable', True),
+}
+
+
+def _fake_ytdlp(argv: List[str]) -> int:
+    output_template = None
+    info_template = None
+    print_files = []
+    url = argv[-1]
+    i = 0
+    while i < len(argv):
+        if argv[i] == '-o':
+            if argv[i + 1].startswith('infojson:'):
+                info_template = argv[i + 1][len('infojson:'):]
+            elif argv[i + 1].startswith('thumbnail:'):
+                pass
+            else:
+                output_template = argv[i + 1]
+            i += 2
+        elif argv[i] == '--print-to-file':
+            print_files.append((argv[i + 1], argv[i + 2]))
+            i += 3
+        elif argv[i] == '--load-info-json':
+            with open(argv[i + 1]) as f:
+                url = json.load(f)['webpage_url']
+            i += 2
+        else:
+            i += 1
+    if info_template is not None and '--write-info-json' in argv:
+        with open(info_template.replace('%%', '%') + '.info.json', 'w') as f:
+            json.dump({'webpage_url': url, 'acodec': 'opus'}, f)
+    video_id = url.rstrip('/').rsplit('/', 1)[-1].rsplit('=', 1)[-1]
+    if video_id in FAKE_YTDLP_ERRORS:
+        print(FAKE_YTDLP_ERRORS[video_id][0], file=sys.stderr)
+        return 1
+    prefix = (output_template or 'NA').split('--', 1)[0]
+    filename = f"{prefix}--Bench_Artist--Bench_Album--Track_{video_id}.opus"
+    if output_template and '%(' not in output_template.replace('%(ext)s', ''):
+        # a planned output file name:
+        filename = output_template.replace('%(ext)s',
+                                           'opus').replace('%%', '%')
+    write_fake_opus(Path(filename),
+                    int(os.environ.get('GET_SONG_BENCH_SIZE', '65536')),
+                    [f'TITLE=Track {video_id}', f'PURL={url}'])
+    values = {
+        'after_move:filepath': filename,
+        'after_move:%(extractor_key)s %(id)s':
+            f"{'Youtube' if 'youtube.com/' in url else 'Bench'} {video_id}",
+        'after_move:%(format_id)s %(acodec)s': '251 opus',
+    }
+    for template, print_file in print_files:
+        with open(print_file, 'a') as f:
+            f.write(values.get(template, 'NA') + '\n')
+    return 0
+
+
+def _fake_ffprobe(argv: List[str]) -> int:
+    tags = {'title': 'Bench Track', 'purl': 'https://example.com/bench'}
+    print(json.dumps({'format': {'tags': tags}, 'streams': []}))
+    return 0
+
+
+def _fake_ffmpeg(argv: List[str]) -> int:
+    src = Path(argv[argv.index('-i') + 1])
+    dst = next(arg for arg in argv[argv.index('-i') + 2:]
+               if not arg.startswith('-') and '=' not in arg and arg != 'copy')
+    Path(dst).write_bytes(src.read_bytes())
+    return 0
+
+
+def fake_tool_main(name: str, argv: List[str]) -> int:
+    """Behave like the given tool (as far as get_song cares)."""
+    if name == 'yt-dlp':
+        return _fake_ytdlp(argv)
+    if name == 'ffprobe':
+        return _fake_ffprobe(argv)
+    if name == 'ffmpeg':
+        return _fake_ffmpeg(argv)
+    return 0
+
+
+def install_fake_tools(bin_dir: Path) -> None:
+    """Write the fake tool executables into the given directory."""
+    bench_dir = str(Path(__file__).resolve().parent)
+    for name in FAKE_TOOLS:
+        script = bin_dir / name
+        script.write_text(
+            FAKE_TOOL_SCRIPT.format(python=sys.executable,
+                                    name=name,
+                                    bench_dir=bench_dir))
+        script.chmod(0o755)
+
+
+def read_tool_log(log_path: Path) -> dict:
+    """Summarize the fake tools' invocation log."""
+    counts: dict[str, int] = {}
+    seconds: dict[str, float] = {}
+    if log_path.exists():
+        for line in log_path.read_text().splitlines():
+            name, started, ended = line.split()[:3]
+            counts[name] = counts.get(name, 0) + 1
+            seconds[name] = seconds.get(name, 0.0) + float(ended) - float(
+                started)
+    return {
+        'subprocess_count': sum(counts.values()),
+        'subprocess_counts': counts,
+        'subprocess_seconds': {k: round(v, 4) for k, v in seconds.items()},
+    }
+
+
+class LoggerTimer:
+    """Measures time spent in get_song's notification logger calls."""
+
+    def __init__(self, get_song):
+        self.cls = get_song.TermuxNotificationLogger
+        self.seconds = 0.0
+        self.calls = 0
+        self._originals = {}
+
+    def __enter__(self):
+        for method in ('log', 'finalize'):
+            original = getattr(self.cls, method)
+            self._originals[method] = original
+
+            def timed(logger, *args, _original=original, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return _original(logger, *args, **kwargs)
+                finally:
+                    self.seconds += time.perf_counter() - started
+                    self.calls += 1
+
+            setattr(self.cls, method, timed)
+        return self
+
+    def __exit__(self, *exc_info):
+        for method, original in self._originals.items():
+            setattr(self.cls, method, original)
+
+
+def peak_rss_kib() -> dict:
+    """Peak resident set sizes of this process and its children (KiB)."""
+    return {
+        'self': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'children': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    }
+
+
+class BenchEnv:
+    """Temporary environment with fake tools on PATH and private XDG dirs."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.args = args
+        self._tmp = tempfile.TemporaryDirectory(prefix='get-song-bench-')
+        self.root = Path(self._tmp.name)
+        self.bin_dir = self.root / 'bin'
+        self.bin_dir.mkdir()
+        install_fake_tools(self.bin_dir)
+        self._saved_env = dict(os.environ)
+        self._run_no = 0
+
+    def __enter__(self):
+        os.environ['PATH'] = f"{self.bin_dir}{os.pathsep}{os.environ['PATH']}"
+        os.environ['GET_SONG_BENCH_LATENCY'] = str(self.args.latency)
+        os.environ['GET_SONG_BENCH_LATENCY_YT_DLP'] = str(
+            self.args.ytdlp_latency)
+        os.environ['GET_SONG_BENCH_SIZE'] = str(self.args.size)
+        for var in ('XDG_STATE_HOME', 'XDG_CACHE_HOME', 'XDG_RUNTIME_DIR'):
+            os.environ[var] = str(self.root / var.lower())
+        os.environ.pop('TMPDIR', None)
+        return self
+
+    def __exit__(self, *exc_info):
+        os.environ.clear()
+        os.environ.update(self._saved_env)
+        self._tmp.cleanup()
+
+    def new_run(self) -> Path:
+        """Prepare a fresh target directory and tool log for a run."""
+        self._run_no += 1
+        run_dir = self.root / f'run-{self._run_no}'
+        (run_dir / 'music').mkdir(parents=True)
+        os.environ['GET_SONG_BENCH_LOG'] = str(run_dir / 'tools.log')
+        return run_dir
+
+    def make_input_files(self,
+                         run_dir: Path,
+                         count: int,
+                         size: int = 4096) -> List[str]:
+        """Create audio files with source URLs in their tags."""
+        inputs_dir = run_dir / 'inputs'
+        inputs_dir.mkdir()
+        paths = []
+        for i in range(count):
+            path = inputs_dir / f'20240101_bench-file-{i}.opus'
+            write_fake_opus(path, size,
+                            ['TITLE=Bench', f'PURL=https://example.com/f{i}'])
+            paths.append(str(path))
+        return paths
+
+
+def _import_get_song():
+    import get_song
+
+    # tool availability is cached - PATH changed:
+    get_song.utility_reg._cache.clear()
+    return get_song
+
+
+def bench_download_song(env: BenchEnv) -> dict:
+    """Measure per-song overhead of download_song() over a batch of URLs."""
+    get_song = _import_get_song()
+    run_dir = env.new_run()
+    get_song.init_logger('get-song-bench')
+    engine = get_song.get_ytdlp_engine('subprocess')
+    durations = []
+    with LoggerTimer(get_song) as logger_timer:
+        started = time.perf_counter()
+        for i in range(env.args.songs):
+            song_started = time.perf_counter()
+            get_song.download_song(f'https://example.com/watch?v=song{i}',
+                                   run_dir / 'music',
+                                   populate_album=True,
+                                   engine=engine)
+            durations.append(time.perf_counter() - song_started)
+        get_song.get_logger().finalize()
+        wall = time.perf_counter() - started
+    return {
+        'wall_seconds': round(wall, 4),
+        'per_song_seconds': {
+            'mean': round(statistics.mean(durations), 4),
+            'median': round(statistics.median(durations), 4),
+            'max': round(max(durations), 4),
+        },
+        'logger_seconds': round(logger_timer.seconds, 4),
+        'logger_calls': logger_timer.calls,
+        **read_tool_log(Path(os.environ['GET_SONG_BENCH_LOG'])),
+    }
+
+
+def bench_archive(env: BenchEnv) -> dict:
+    """
+    Check the download archive round trip: songs recorded by a download are
+    found by a lookup of their URL, and downloading them again is skipped.
+    """
+    get_song = _import_get_song()
+    run_dir = env.new_run()
+    get_song.init_logger('get-song-bench')
+    engine = get_song.get_ytdlp_engine('subprocess')
+    archive = get_song.DownloadArchive(run_dir / 'archive.sqlite3')
+    target_dir = run_dir / 'music'
+    # YouTube video IDs are case-sensitive:
+    urls = [f'https://www.youtube.com/watch?v=BenchSong{i:02d}'
+            for i in range(env.args.songs)]
+    urls.append('https://example.com/watch?v=NonYouTube')
+    for url in urls:
+        get_song.download_song(url, target_dir, engine=engine, archive=archive)
+    log_path = Path(os.environ['GET_SONG_BENCH_LOG'])
+    downloads = read_tool_log(log_path)['subprocess_counts'].get('yt-dlp', 0)
+    found = sum(archive.lookup(url, target_dir) is not None for url in urls)
+    started = time.perf_counter()
+    for url in urls:
+        get_song.download_song(url, target_dir, engine=engine, archive=archive)
+    wall = time.perf_counter() - started
+    get_song.get_logger().finalize()
+    redownloads = read_tool_log(log_path)['subprocess_counts'].get(
+        'yt-dlp', 0) - downloads
+    return {
+        'songs': len(urls),
+        'wall_seconds': round(wall, 4),
+        'lookups_found': found,
+        'redownloads': redownloads,
+        'round_trip_ok': found == len(urls) and redownloads == 0,
+    }
+
+
+def bench_errors(env: BenchEnv) -> dict:
+    """
+    Check which yt-dlp errors download_song() takes for transient (raising
+    TransientDownloadError, to be retried) and which for permanent failures.
+    """
+    get_song = _import_get_song()
+    run_dir = env.new_run()
+    get_song.init_logger('get-song-bench')
+    engine = get_song.get_ytdlp_engine('subprocess')
+    misclassified = []
+    for video_id, (_, transient) in FAKE_YTDLP_ERRORS.items():
+        try:
+            get_song.download_song(f'https://example.com/watch?v={video_id}',
+                                   run_dir / 'music',
+                                   engine=engine)
+            retried = False
+        except get_song.TransientDownloadError:
+            retried = True
+        if retried != transient:
+            misclassified.append(video_id)
+    get_song.get_logger().finalize()
+    return {
+        'errors': len(FAKE_YTDLP_ERRORS),
+        'misclassified': misclassified,
+        'classification_ok': not misclassified,
+    }
+
+
+def bench_main(env: BenchEnv) -> dict:
+    """Measure a whole get_song.main() batch of URLs and input files."""
+    get_song = _import_get_song()
+    run_dir = env.new_run()
+    inputs = [f'https://example.com/watch?v=batch{i}'
+              for i in range(env.args.songs)]
+    inputs += env.make_input_files(run_dir, env.args.files)
+    argv = [
+        '--engine', 'subprocess', '--jobs',
+        str(env.args.jobs), '--directory',
+        str(run_dir / 'music'), '--populate-empty-album', *env.args.extra_args,
+        *inputs
+    ]
+    with LoggerTimer(get_song) as logger_timer:
+        started = time.perf_counter()
+        exit_code = get_song.main(argv)
+        wall = time.perf_counter() - started
+    return {
+        'exit_code': exit_code,
+        'inputs': len(inputs),
+        'wall_seconds': round(wall, 4),
+        'songs_per_second': round(len(inputs) / wall, 4),
+        'logger_seconds': round(logger_timer.seconds, 4),
+        'logger_calls': logger_timer.calls,
+        **read_tool_log(Path(os.environ['GET_SONG_BENCH_LOG'])),
+    }
+
+
+def serve_flaky_file(path: Path,
+                     port: int = 0,
+                     drops: int = 2,
+                     drop_after: int = 65536):
+    """
+    Create an HTTP server (on localhost) serving the given file, which drops
+    the connection after `drop_after` bytes for the first `drops` requests.
+    Range requests are honoured, so that resuming clients get the rest.
+
+    Returns:
+        The server - call its serve_forever() to run it
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import re
+    import threading
+
+    data = path.read_bytes()
+    lock = threading.Lock()
+    remaining_drops = [drops]
+
+    class FlakyHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self) -> None:
+            start = 0
+            match = re.match(r'bytes=(\d+)-', self.headers.get('Range', ''))
+            if match:
+                start = min(int(match.group(1)), len(data))
+                self.send_response(206)
+                self.send_header('Content-Range',
+                                 f'bytes {start}-{len(data) - 1}/{len(data)}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', 'audio/ogg')
+            self.send_header('Content-Length', str(len(data) - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.end_headers()
+            with lock:
+                drop = remaining_drops[0] > 0
+                remaining_drops[0] -= drop
+            end = min(start + drop_after, len(data)) if drop else len(data)
+            self.wfile.write(data[start:end])
+            if drop:
+                # cut the connection short of the announced length:
+                self.wfile.flush()
+                self.close_connection = True
+
+        def log_message(self, format: str, *args) -> None:
+            print(f"flaky server: {format % args}", file=sys.stderr)
+
+    return ThreadingHTTPServer(('127.0.0.1', port), FlakyHandler)
+
+
+SYNCTHING_API_KEY = 'get-song-bench'
+
+
+def serve_syncthing(config_path: Path, folder: Path, port: int = 0):
+    """
+    Create an HTTP server (on localhost) standing in for Syncthing's REST API
+    and write a Syncthing config.xml pointing at it, sharing the given folder
+    (as 'music'). Rescan requests are printed as JSON lines to stdout.
+
+    Returns:
+        The server - call its serve_forever() to run it
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    import urllib.parse
+    from xml.sax.saxutils import quoteattr
+
+    class SyncthingHandler(BaseHTTPRequestHandler):
+
+        def do_POST(self) -> None:
+            url = urllib.parse.urlsplit(self.path)
+            if self.headers.get('X-API-Key') != SYNCTHING_API_KEY:
+                self.send_error(403)
+                return
+            if url.path != '/rest/db/scan':
+                self.send_error(404)
+                return
+            query = urllib.parse.parse_qs(url.query)
+            print(json.dumps({
+                'folder': query.get('folder', [None])[0],
+                'sub': query.get('sub', [])
+            }),
+                  flush=True)
+            self.send_response(200)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, format: str, *args) -> None:
+            print(f"syncthing stub: {format % args}", file=sys.stderr)
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), SyncthingHandler)
+    config_path.write_text(
+        '<configuration version="37">\n'
+        f'    <folder id="music" path={quoteattr(str(folder.resolve()))}>'
+        '</folder>\n'
+        '    <gui enabled="true" tls="false">\n'
+        f'        <address>127.0.0.1:{server.server_address[1]}</address>\n'
+        f'        <apikey>{SYNCTHING_API_KEY}</apikey>\n'
+        '    </gui>\n'
+        '</configuration>\n')
+    return server
+
+
+def bench_tags(env: BenchEnv) -> dict:
+    """Compare per-file latency of get_song's tag reading backends."""
+    get_song = _import_get_song()
+    run_dir = env.new_run()
+    paths = [
+        Path(path) for path in env.make_input_files(
+            run_dir, max(env.args.files, 1), env.args.size)
+    ]
+    # fresh probe - no cached tag views:
+    probe = get_song.MetadataProbe()
+    backends = {'headers': probe._read_headers}
+    if get_song.is_mutagen_available():
+        backends['mutagen'] = probe._read_with_mutagen
+    # the fake ffprobe - its process startup is what's being compared:
+    backends['ffprobe'] = probe._read_with_ffprobe
+    per_file = {}
+    started = time.perf_counter()
+    for name, read in backends.items():
+        durations = []
+        found = 0
+        for path in paths:
+            file_started = time.perf_counter()
+            tag_view = read(path)
+            durations.append(time.perf_counter() - file_started)
+            found += bool(tag_view and tag_view.source_url)
+        per_file[name] = {
+            'mean': round(statistics.mean(durations), 6),
+            'median': round(statistics.median(durations), 6),
+            'max': round(max(durations), 6),
+            'urls_found': found,
+        }
+    wall = time.perf_counter() - started
+    return {
+        'files': len(paths),
+        'file_size': env.args.size,
+        'wall_seconds': round(wall, 4),
+        'per_file_seconds': per_file,
+        **read_tool_log(Path(os.environ['GET_SONG_BENCH_LOG'])),
+    }
+
+
+def first_tool_spawn(log_path: Path) -> Optional[float]:
+    """Time the first fake tool process started (before its own imports)."""
+    if not log_path.exists():
+        return None
+    spawns = [float(line.split()[3])
+              for line in log_path.read_text().splitlines()]
+    return min(spawns, default=None)
+
+
+def _bench_python_env() -> dict:
+    """Environment for fresh interpreters importing get_song."""
+    bench_dir = str(Path(__file__).resolve().parent)
+    python_path = os.environ.get('PYTHONPATH')
+    return {
+        **os.environ, 'PYTHONPATH':
+            f"{bench_dir}{os.pathsep}{python_path}" if python_path else bench_dir
+    }
+
+
+def import_profile() -> dict:
+    """
+    Import get_song and parse a single URL's arguments in a fresh
+    interpreter with -X importtime.
+    """
+    code = ('import get_song, time\n'
+            'started = time.perf_counter()\n'
+            'get_song.build_parser().parse_args(\n'
+            '    ["--engine", "subprocess", "https://example.com/watch?v=x"])\n'
+            'print(time.perf_counter() - started)\n')
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        env=_bench_python_env(),
+        capture_output=True,
+        text=True,
+        check=True)
+    # lines are "import time: self [us] | cumulative | <indented name>",
+    # nested imports following the ones that triggered them:
+    modules = []
+    total = None
+    parse_imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if total is not None:
+            # imported while parsing the arguments:
+            if len(name) - len(name.lstrip()) == 1:
+                parse_imports.append(name.strip())
+        elif name.strip() == 'get_song':
+            total = int(cumulative)
+        elif len(name) - len(name.lstrip()) == 1:
+            # imported by the interpreter's startup (site...) instead:
+            modules = []
+        else:
+            modules.append((name, int(cumulative)))
+    # modules imported directly by get_song (nested once):
+    direct = [(name.strip(), cumulative) for name, cumulative in modules
+              if len(name) - len(name.lstrip()) == 3]
+    direct.sort(key=lambda module: module[1], reverse=True)
+    return {
+        'import_seconds': round((total or 0) / 1e6, 4),
+        'imported_modules': len(modules),
+        'heaviest_imports': {
+            name: round(cumulative / 1e6, 4) for name, cumulative in direct[:5]
+        },
+        'parse_seconds': round(float(result.stdout), 4),
+        'parse_imports': parse_imports,
+    }
+
+
+def _run_client(argv: List[str], cwd: Path) -> Tuple[float, Optional[dict]]:
+    """
+    Queue inputs in the daemon with `python3 -m get_song --client`.
+
+    Returns:
+        The client's run time and the numbers of queued & duplicate inputs
+        it reported (None if it failed)
+    """
+    import re
+
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-m', 'get_song', '--client', *argv],
+        cwd=cwd,
+        env=_bench_python_env(),
+        capture_output=True,
+        text=True)
+    seconds = time.perf_counter() - started
+    match = re.search(r'Queued (\d+) input\(s\), skipped (\d+)', result.stderr)
+    if result.returncode != 0 or not match:
+        return seconds, None
+    return seconds, {'queued': int(match[1]), 'duplicates': int(match[2])}
+
+
+def bench_daemon(env: BenchEnv) -> dict:
+    """
+    Queue batches of URLs in a get_song daemon with --client (starting the
+    daemon) and check its queueing, dropping of duplicates and replay of the
+    queue journal left by an earlier daemon.
+    """
+    run_dir = env.new_run()
+    music_dir = run_dir / 'music'
+    socket_path = run_dir / 'get-song.sock'
+    job_args = ['--engine', 'subprocess', '--directory', str(music_dir)]
+    # a job left by a daemon which got killed:
+    journal_url = 'https://example.com/watch?v=journal0'
+    state_dir = Path(os.environ['XDG_STATE_HOME']) / 'get-song'
+    state_dir.mkdir(parents=True, exist_ok=True)
+    (state_dir / 'queue.json').write_text(
+        json.dumps([{
+            'argv': [*job_args, journal_url],
+            'directory': str(music_dir),
+            'input': journal_url
+        }]))
+    urls = [f'https://example.com/watch?v=daemon{i}'
+            for i in range(env.args.songs)]
+    client_args = [
+        '--socket',
+        str(socket_path), '--idle-timeout', '1', '--jobs',
+        str(env.args.jobs), *job_args
+    ]
+    started = time.perf_counter()
+    # the first request starts the daemon - a duplicate within it is dropped:
+    first_seconds, first = _run_client([*client_args, *urls, urls[0]],
+                                       run_dir)
+    # ... and the inputs still pending when requested again:
+    second_seconds, second = _run_client([*client_args, *urls], run_dir)
+    deadline = time.monotonic() + 60 + env.args.songs * env.args.ytdlp_latency
+    while socket_path.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+    wall = time.perf_counter() - started
+    downloaded = [path.name for path in music_dir.glob('*.opus')]
+    journal = json.loads((state_dir / 'queue.json').read_text())
+    return {
+        'songs': len(urls),
+        'wall_seconds': round(wall, 4),
+        'client_seconds': {
+            'first': round(first_seconds, 4),
+            'second': round(second_seconds, 4),
+        },
+        'first_request': first,
+        'second_request': second,
+        'downloaded': len(downloaded),
+        'journal_replayed': any('journal0' in name for name in downloaded),
+        'journal_pending': len(journal),
+        'daemon_exited': not socket_path.exists(),
+        **read_tool_log(Path(os.environ['GET_SONG_BENCH_LOG'])),
+    }
+
+
+def bench_startup(env: BenchEnv) -> dict:
+    """Measure the startup of `python3 -m get_song` for a single URL."""
+    run_dir = env.new_run()
+    log_path = Path(os.environ['GET_SONG_BENCH_LOG'])
+    profile = import_profile()
+    # the import profile's interpreter ran no tools - but start afresh:
+    log_path.unlink(missing_ok=True)
+    started = time.time()
+    result = subprocess.run([
+        sys.executable, '-m', 'get_song', '--engine', 'subprocess',
+        '--directory',
+        str(run_dir / 'music'), *env.args.extra_args,
+        'https://example.com/watch?v=startup'
+    ],
+                            cwd=run_dir,
+                            env=_bench_python_env(),
+                            stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    wall = time.time() - started
+    first_spawn = first_tool_spawn(log_path)
+    return {
+        'exit_code': result.returncode,
+        'wall_seconds': round(wall, 4),
+        'first_subprocess_seconds':
+            round(first_spawn - started, 4) if first_spawn else None,
+        **profile,
+        **read_tool_log(log_path),
+    }
+
+
+def _revision() -> Optional[str]:
+    """Git revision of the benchmarked code, if available."""
+    try:
+        result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                                cwd=Path(__file__).resolve().parent,
+                                capture_output=True,
+                                text=True)
+    except FileNotFoundError:
+        return None
+    return result.stdout.strip() or None
+
+
+def run_benchmarks(args: argparse.Namespace) -> dict:
+    """Run the selected benchmark scenarios, repeated as requested."""
+    scenarios = {
+        'download_song': bench_download_song,
+        'main': bench_main,
+        'archive': bench_archive,
+        'errors': bench_errors,
+        'daemon': bench_daemon,
+        'startup': bench_startup,
+        'tags': bench_tags
+    }
+    selected = args.scenario or list(scenarios)
+    results: dict[str, list] = {name: [] for name in selected}
+    # get_song's output is not what's being looked at here:
+    stderr = sys.stderr
+    with BenchEnv(args) as env:
+        for _ in range(args.repeat):
+            for name in selected:
+                sys.stderr = open(os.devnull, 'w') if args.quiet else stderr
+                try:
+                    results[name].append(scenarios[name](env))
+                finally:
+                    if sys.stderr is not stderr:
+                        sys.stderr.close()
+                    sys.stderr = stderr
+    return {
+        'label': args.label or _revision(),
+        'python': sys.version.split()[0],
+        'params': {
+            'songs': args.songs,
+            'files': args.files,
+            'jobs': args.jobs,
+            'latency': args.latency,
+            'ytdlp_latency': args.ytdlp_latency,
+            'size': args.size,
+            'repeat': args.repeat,
+            'extra_args': args.extra_args,
+        },
+        'scenarios': results,
+        'peak_rss_kib': peak_rss_kib(),
+    }
+
+
+def _best_runs(report: dict) -> dict:
+    """Best (fastest) run of each scenario."""
+    return {
+        name: min(runs, key=lambda run: run['wall_seconds'])
+        for name, runs in report['scenarios'].items() if runs
+    }
+
+
+def compare_reports(old: dict, new: dict) -> List[str]:
+    """Describe differences of key metrics between two reports."""
+    lines = [f"{old.get('label')} -> {new.get('label')}"]
+    old_best, new_best = _best_runs(old), _best_runs(new)
+    for name in sorted(set(old_best) & set(new_best)):
+        for metric in ('wall_seconds', 'logger_seconds', 'subprocess_count',
+                       'import_seconds', 'first_subprocess_seconds'):
+            before = old_best[name].get(metric)
+            after = new_best[name].get(metric)
+            if before is None or after is None:
+                continue
+            change = f"{(after - before) / before * 100:+.1f}%" if before else 'n/a'
+            lines.append(f"{name}.{metric}: {before} -> {after} ({change})")
+    return lines
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """Main entry point."""
+    parser = argparse.ArgumentParser(
+        description='Benchmarks get_song against fake external tools.')
+    parser.add_argument('--scenario',
+                        action='append',
+                        choices=[
+                            'download_song', 'main', 'archive', 'errors',
+                            'daemon', 'startup', 'tags'
+                        ],
+                        help='Scenario to run (repeatable, default: all)')
+    parser.add_argument('--songs',
+                        metavar='N',
+                        type=int,
+                        default=10,
+                        help='Number of URLs per batch (default: 10)')
+    parser.add_argument('--files',
+                        metavar='N',
+                        type=int,
+                        default=5,
+                        help='Number of input files per main() batch (default: 5)')
+    parser.add_argument('--jobs',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help='get_song --jobs for main() batches (default: 1)')
+    parser.add_argument('--latency',
+                        metavar='SECONDS',
+                        type=float,
+                        default=0.0,
+                        help='Latency of each fake tool invocation (default: 0)')
+    parser.add_argument('--ytdlp-latency',
+                        metavar='SECONDS',
+                        type=float,
+                        default=0.1,
+                        help='Latency of each fake yt-dlp run (default: 0.1)')
+    parser.add_argument('--size',
+                        metavar='BYTES',
+                        type=int,
+                        default=65536,
+                        help='Size of downloaded files (default: 65536)')
+    parser.add_argument('--repeat',
+                        metavar='N',
+                        type=int,
+                        default=1,
+                        help='Number of runs of each scenario (default: 1)')
+    parser.add_argument('--label',
+                        help='Label of the results (default: git revision)')
+    parser.add_argument('-o',
+                        '--output',
+                        metavar='FILE',
+                        help='Write the JSON report to FILE (default: stdout)')
+    parser.add_argument('--compare',
+                        metavar='FILE',
+                        help='Compare the results with an earlier JSON report')
+    parser.add_argument('-q',
+                        '--quiet',
+                        action='store_true',
+                        help="Suppress get_song's own output")
+    parser.add_argument('--serve-flaky',
+                        metavar='FILE',
+                        help='Serve FILE over HTTP, dropping the first '
+                        'connections part-way, instead of benchmarking')
+    parser.add_argument('--serve-syncthing',
+                        metavar='CONFIG',
+                        help="Stand in for Syncthing's REST API, writing a "
+                        'config.xml pointing at it to CONFIG (for get_song '
+                        '--syncthing-config), instead of benchmarking')
+    parser.add_argument('--syncthing-folder',
+                        metavar='DIR',
+                        default='.',
+                        help='Folder --serve-syncthing shares (default: .)')
+    parser.add_argument('--port',
+                        type=int,
+                        default=0,
+                        help='Port of --serve-flaky and --serve-syncthing '
+                        '(default: any free one)')
+    parser.add_argument('--drops',
+                        metavar='N',
+                        type=int,
+                        default=2,
+                        help='Connections --serve-flaky drops (default: 2)')
+    parser.add_argument('--drop-after',
+                        metavar='BYTES',
+                        type=int,
+                        default=65536,
+                        help='Bytes --serve-flaky sends before dropping a '
+                        'connection (default: 65536)')
+    parser.add_argument('extra_args',
+                        metavar='GET-SONG-ARG',
+                        nargs='*',
+                        help='Extra get_song arguments for main() (after --)')
+    args = parser.parse_args(argv)
+
+    if args.serve_flaky:
+        path = Path(args.serve_flaky)
+        server = serve_flaky_file(path, args.port, args.drops,
+                                  args.drop_after)
+        print(f"Serving http://127.0.0.1:{server.server_address[1]}/"
+              f"{path.name}", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    if args.serve_syncthing:
+        server = serve_syncthing(Path(args.serve_syncthing),
+                                 Path(args.syncthing_folder), args.port)
+        print(f"Serving http://127.0.0.1:{server.server_address[1]}/ "
+              f"(config: {args.serve_syncthing})",
+              file=sys.stderr,
+              flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        return 0
+
+    report = run_benchmarks(args)
+    report_json = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(report_json + '\n')
+    else:
+        print(report_json)
+    if args.compare:
+        old_report = json.loads(Path(args.compare).read_text())
+        for line in compare_reports(old_report, report):
+            print(line, file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -17,6 +17,13 @@ esac
 music_dir="$HOME/storage/music/pub/prv/$year"
 mkdir -p "$music_dir"
 
+# Hand the file over to the get_song daemon (started on demand) if possible;
+# the daemon removes the input file once the song got downloaded
+if python3 -m get_song --client --remove-input-on-success --populate-empty-album \
+	--use-existing-target-file-mtime-shifted 1 --directory "$music_dir" "$file_path"; then
+	exit 0
+fi
+
 # Prepare a temporary script for termux-job-scheduler
 # The script will run get_song and delete the input file after processing
 
@@ -5,6 +5,14 @@ set -eu
 
 song_url="${1:?SONG_URL null or empty}"
 
+# hand the URL over to the get_song daemon (started on demand) if possible:
+curr_year="$(date +%Y)"
+music_dir="$HOME/storage/music/pub/prv/$curr_year"
+mkdir -p "$music_dir"
+if python3 -m get_song --client --populate-empty-album --directory "$music_dir" "$song_url"; then
+	exit 0
+fi
+
 # get_song SONG_URL - download a given song using yt-dlp
 #
 # NOTE: logic is written to a temporary script which is then run in the